@@ -25,25 +25,16 @@ E. freeze_FE = False/ freeze_gen = False / gen_wu_epochs 50 / epochs 50 (real +
 
 Generator trained epochs: gen_wu_epochs + epochs
 '''
-from torchvision.utils import save_image
 import argparse
-import os
-import wandb
-from datetime import datetime
-import numpy as np
-import random
-import torch
-import copy
+from torchvision import datasets, transforms
 
-from utils.localUpdateRaw import *
-from utils.average import *
-from utils.getData import *
-from utils.getModels import *
+from utils.localUpdateRaw import LocalUpdate_DCGAN
+from utils.getData import getDataset
+from utils.engine import FedEngine, RawFamily, GANGen, add_engine_args
+from utils.seedRunner import run_experiments
 
-from generators32.DCGAN import *
+from generators32.DCGAN import generator, discriminator
 # from generators16.DCGAN import *
-from utils.util import test_img, get_logger
-from torchsummaryX import summary
 
 parser = argparse.ArgumentParser()
 ### clients
@@ -92,248 +83,33 @@ parser.add_argument("--b1", type=float, default=0.5, help="adam: decay of first
 parser.add_argument("--b2", type=float, default=0.999, help="adam: decay of first order momentum of gradient")
 parser.add_argument('--lr', type=float, default=0.0002) # GAN lr
 parser.add_argument('--latent_dim', type=int, default=100)
+add_engine_args(parser)
 
 args = parser.parse_args()
 args.device = 'cuda:' + args.device_id
 args.img_shape = (args.output_channel, args.img_size, args.img_size)
-# args.feature_size = 32
 print(args)
 
-# def normal_init(m, mean, std):
-#     if isinstance(m, nn.ConvTranspose2d) or isinstance(m, nn.Conv2d):
-#         m.weight.data.normal_(mean, std)
-#         m.bias.data.zero_()
-
 tf = transforms.Compose([transforms.Resize(args.img_size), transforms.ToTensor(),transforms.Normalize([0.5], [0.5])]) # mnist is already normalised 0 to 1
 # tf = transforms.Compose([transforms.Resize(args.img_size), transforms.ToTensor(),]) # mnist is already normalised 0 to 1
 if args.dataset == 'mnist':
     train_data = datasets.MNIST(root='/home/hong/NeFL/.data/mnist', train=True, transform=tf, download=True) # VAE training data
 elif args.dataset == 'fmnist':
     train_data = datasets.FashionMNIST('/home/hong/NeFL/.data/fmnist', train=True, transform=tf, download=True)
+dataset_train, dataset_test = getDataset(args)
 
+def build_gen(args):
+    gen, dis = generator(args, d=256), discriminator(args, d=64)
+    gen.weight_init(mean=0.0, std=0.02)
+    dis.weight_init(mean=0.0, std=0.02)
+    return gen, dis
 
 def main():
-    dataset_train, dataset_test = getDataset(args)
-
-    if args.noniid:
-        dict_users = noniid_dir(args, args.dir_param, dataset_train)
-    else:
-        dict_users = cifar_iid(dataset_train, int(1/args.partial_data*args.num_users), args.rs)
-    # img_size = dataset_train[0][0].shape
-
-    if not args.aid_by_gen:
-        args.gen_wu_epochs = 0
-        args.local_ep_gen = 0
-        args.gen_local_ep = 0
-
-    local_models, common_net = getModel(args)
-    
-    # bs=2
-    # x = torch.zeros(bs, args.output_channel, args.img_size, args.img_size, device='cuda').to(args.device)
-    # summary(common_net, x)
-    
-    w_comm = common_net.state_dict()
-    ws_glob = []
-    for _ in range(args.num_models):
-        ws_glob.append(local_models[_].state_dict())
-
-    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-    filename = './output/gefl/'+ timestamp + str(args.name) + str(args.rs)
-    if not os.path.exists(filename):
-        os.makedirs(filename)
-    if args.wandb:
-        run = wandb.init(dir=filename, project='GeFL-DCGAN-1127', name= str(args.name)+ str(args.rs), reinit=True, settings=wandb.Settings(code_dir="."))
-        wandb.config.update(args)
-    # logger = get_logger(logpath=os.path.join(filename, 'logs'), filepath=os.path.abspath(__file__))
-    
-    loss_train = []
-    lr = 1e-1 # CNN
-
-    gen_glob = generator(args, d=256).to(args.device)
-    dis_glob = discriminator(args, d=64).to(args.device)
-    gen_glob.weight_init(mean=0.0, std=0.02)
-    dis_glob.weight_init(mean=0.0, std=0.02)
-
-    optg = torch.optim.Adam(gen_glob.parameters(), lr=args.lr, betas=(args.b1, args.b2)).state_dict()
-    optd = torch.optim.Adam(dis_glob.parameters(), lr=args.lr, betas=(args.b1, args.b2)).state_dict()
-    
-    optgs = [copy.deepcopy(optg) for _ in range(args.num_users)]
-    optds = [copy.deepcopy(optd) for _ in range(args.num_users)]
-
-    gen_w_glob = gen_glob.state_dict()
-    dis_w_glob = dis_glob.state_dict()
-    
-    for iter in range(1, args.gen_wu_epochs+1):
-        ''' ---------------------------
-        Warming up for generative model
-        --------------------------- '''
-        gen_w_local = []
-        dis_w_local = []
-        gloss_locals = []
-        dloss_locals = []
-        
-        m = max(int(args.frac * args.num_users), 1)
-        idxs_users = np.random.choice(range(args.num_users), m, replace=False)
-        
-        gen_glob.load_state_dict(gen_w_glob)
-        dis_glob.load_state_dict(dis_w_glob)
-        
-        for idx in idxs_users:
-                        
-            local = LocalUpdate_DCGAN(args, dataset=train_data, idxs=dict_users[idx])
-            g_weight, d_weight, gloss, dloss, optgs[idx], optds[idx] = local.train(gnet=copy.deepcopy(gen_glob), dnet=copy.deepcopy(dis_glob), iter=iter, optg=optgs[idx], optd=optds[idx])
-
-            gen_w_local.append(copy.deepcopy(g_weight))
-            dis_w_local.append(copy.deepcopy(d_weight))
-            
-            gloss_locals.append(gloss)
-            dloss_locals.append(dloss)
-        
-        gen_w_glob = FedAvg(gen_w_local)
-        dis_w_glob = FedAvg(dis_w_local)
-        
-        gloss_avg = sum(gloss_locals) / len(gloss_locals)
-        dloss_avg = sum(dloss_locals) / len(dloss_locals)
-
-        # print('Warm-up Gen Round {:3d}, G Avg loss {:.3f}, D Avg loss {:.3f}'.format(iter, gloss_avg, dloss_avg))
-        if args.save_imgs and (iter % args.sample_test == 0 or iter == args.gen_wu_epochs):
-            gen_glob.eval()
-            sample_num = 40
-            samples = gen_glob.sample_image_4visualization(sample_num)
-            save_image(samples.view(sample_num, args.output_channel, args.img_size, args.img_size),
-                        'imgs/imgFedDCGAN/' + str(args.name) + '_' + str(args.img_size) + '_' + str(args.rs) + '_' + str(iter) + '.png', nrow=10)
-            gen_glob.train()
-        print('Warm-up Gen Round {:3d}, G Avg loss {:.3f}, D Avg loss {:.3f}'.format(iter, gloss_avg, dloss_avg))
-
-    # torch.save(gen_w_glob, 'models/save/Fed' + '_'
-    #             + str(args.models) + '_DCGAN_G_sameSize.pt')
-    # torch.save(dis_w_glob, 'models/save/Fed' + '_'
-    #             + str(args.models) + '_DCGAN_D_sameSize.pt')
-    
-    best_perf = [0 for _ in range(args.num_models)]
-
-    for iter in range(1, args.epochs+1):
-        ''' ----------------------------------------
-        Train main networks by local sample
-        and generated samples, then update generator
-        ---------------------------------------- '''
-        ws_local = [[] for _ in range(args.num_models)]
-        gen_w_local = []
-        dis_w_local = []
-        
-        loss_locals = []
-        gen_loss_locals = []
-        
-        gloss_locals = []
-        dloss_locals = []
-        
-        m = max(int(args.frac * args.num_users), 1)
-        idxs_users = np.random.choice(range(args.num_users), m, replace=False)
-        if args.aid_by_gen:
-            gen_glob.load_state_dict(gen_w_glob)
-            dis_glob.load_state_dict(dis_w_glob)
-        
-        for idx in idxs_users:
-            dev_spec_idx = min(idx//(args.num_users//args.num_models), args.num_models-1)
-            model_idx = dev_spec_idx
-            model = local_models[model_idx]
-            model.load_state_dict(ws_glob[model_idx])
-            
-            if args.only_gen:
-                local = LocalUpdate_onlyGen(args, dataset=dataset_train, idxs=dict_users[idx])
-                weight, loss, gen_loss = local.train(net=copy.deepcopy(model).to(args.device), gennet=copy.deepcopy(gen_glob), learning_rate=lr)
-            else:
-                local = LocalUpdate(args, dataset=dataset_train, idxs=dict_users[idx])
-                # synthetic data updates header & real data updates whole target network
-                if args.aid_by_gen:
-                    weight, loss, gen_loss = local.train(net=copy.deepcopy(model).to(args.device), gennet=copy.deepcopy(gen_glob), learning_rate=lr)
-                else:
-                    weight, loss, gen_loss = local.train(net=copy.deepcopy(model).to(args.device), learning_rate=lr)
-
-            ws_local[model_idx].append(weight)
-            loss_locals.append(loss)
-            gen_loss_locals.append(gen_loss)
-
-            if args.aid_by_gen and not args.freeze_gen:
-                local_gen = LocalUpdate_DCGAN(args, dataset=train_data, idxs=dict_users[idx])
-                g_weight, d_weight, gloss, dloss, optgs[idx], optds[idx] = local_gen.train(gnet=copy.deepcopy(gen_glob), dnet=copy.deepcopy(dis_glob), iter=args.gen_wu_epochs+iter, optg=optgs[idx], optd=optds[idx])
-
-                gen_w_local.append(copy.deepcopy(g_weight))
-                dis_w_local.append(copy.deepcopy(d_weight))
-
-                gloss_locals.append(gloss)
-                dloss_locals.append(dloss)
-                
-        if  args.aid_by_gen and not args.freeze_gen:
-            gloss_avg = sum(gloss_locals) / len(gloss_locals)
-            dloss_avg = sum(dloss_locals) / len(dloss_locals)
-            
-            gen_w_glob = FedAvg(gen_w_local)
-            dis_w_glob = FedAvg(dis_w_local)
-            if args.save_imgs and (iter % args.sample_test == 0 or iter == args.epochs):
-                gen_glob.eval()
-                sample_num = 40
-                samples = gen_glob.sample_image_4visualization(sample_num)
-                save_image(samples.view(sample_num, args.output_channel, args.img_size, args.img_size),
-                            'imgs/imgFedDCGAN/' + str(args.name) + str(args.rs) + '_' + str(args.gen_wu_epochs+iter) + '.png', nrow=10)
-                gen_glob.train()
-            print('Gen Round {:3d}, G Avg loss {:.3f}, D Avg loss {:.3f}'.format(args.gen_wu_epochs+iter, gloss_avg, dloss_avg))
-        else:
-            gloss_avg = -1
-            dloss_avg = -1
-
-        if args.avg_FE: # LG-FedAVG
-            ws_glob, w_comm = FedAvg_FE(args, ws_glob, ws_local, w_comm) # main net, feature extractor weight update
-        else: # FedAVG
-            ws_glob = FedAvg_FE_raw(args, ws_glob, ws_local)
-
-        loss_avg = sum(loss_locals) / len(loss_locals)
-        try:
-            gen_loss_avg = sum(gen_loss_locals) / len(gen_loss_locals)
-        except:
-            gen_loss_avg = -1
-        print('Round {:3d}, Avg loss {:.3f}, Avg loss by Gen samples {:.3f}, G Avg loss {:.3f}, D Avg loss {:.3f}'.format(iter, loss_avg, gen_loss_avg, gloss_avg, dloss_avg))
-
-        loss_train.append(loss_avg)
-        if iter == 1 or iter % args.sample_test == 0 or iter == args.epochs:
-            acc_test_tot = []
-
-            for i in range(args.num_models):
-                model_e = local_models[i]
-                model_e.load_state_dict(ws_glob[i])
-                model_e.eval()
-                acc_test, loss_test = test_img(model_e, dataset_test, args)
-                if acc_test > best_perf[i]:
-                    best_perf[i] = float(acc_test)
-
-                acc_test_tot.append(acc_test)
-                print("Testing accuracy " + str(i) + ": {:.2f}".format(acc_test))
-                if args.wandb:
-                    wandb.log({
-                        "Communication round": iter,
-                        "Local model " + str(i) + " test accuracy": acc_test
-                    })
-            if args.wandb:
-                wandb.log({
-                    "Communication round": iter,
-                    "Mean test accuracy": sum(acc_test_tot) / len(acc_test_tot)
-                })
-                                    
-    # print(best_perf, 'AVG'+str(args.rs), sum(best_perf)/len(best_perf))
-    torch.save(gen_w_glob, 'checkpoint/FedDCGAN' + str(args.name) + str(args.rs) + '.pt')
-
-    if args.wandb:
-        run.finish()
+    gen = GANGen(LocalUpdate_DCGAN, build_gen, lr=args.lr, betas=(args.b1, args.b2), pass_iter=True, feature=False, img_dir='imgs/imgFedDCGAN/')
+    engine = FedEngine(args, dataset_train, dataset_test, RawFamily(), gen, gen_data=train_data, lr=1e-1, project='GeFL-DCGAN-1127',
+                       gen_path='checkpoint/FedDCGAN', test_first=True)
+    return engine.run()
 
 
 if __name__ == "__main__":
-    for i in range(args.num_experiment):
-        torch.manual_seed(args.rs)
-        torch.cuda.manual_seed(args.rs)
-        torch.cuda.manual_seed_all(args.rs) # if use multi-GPU
-        # torch.backends.cudnn.deterministic = True
-        # torch.backends.cudnn.benchmark = False
-        np.random.seed(args.rs)
-        random.seed(args.rs)
-        main()
-        args.rs = args.rs+1
\ No newline at end of file
+    run_experiments(main, args, table='./output/gefl/' + str(args.name) + '_seeds.csv')
@@ -1,23 +1,11 @@
 import argparse
-import os
-import wandb
-from datetime import datetime
-import numpy as np
-import random
-import torch
-import copy
 
-import torch.utils.data
-from torchvision import datasets, transforms
-from torchvision.utils import save_image
+from utils.localUpdate import LocalUpdate_VAE
+from utils.getData import getDataset
+from utils.engine import FedEngine, FeatureFamily, VAEGen, add_engine_args
+from utils.seedRunner import run_experiments
 
-from utils.localUpdate import *
-from utils.average import *
-from utils.getData import *
-from utils.getModels import *
-
-from mlp_generators.VAE import *
-from utils.util import test_img
+from mlp_generators.VAE import CVAE
 
 parser = argparse.ArgumentParser()
 ### clients
@@ -62,257 +50,25 @@ parser.add_argument('--wandb', type=bool, default=True)
 parser.add_argument('--name', type=str, default='under_dev') # L-A: bad character
 ### VAE parameters
 parser.add_argument("--latent_size", type=int, default=20, help="dimensionality of the latent space")
+add_engine_args(parser)
 
 args = parser.parse_args()
 args.img_shape = (args.output_channel, args.img_size, args.img_size)
 args.device = 'cuda:' + args.device_id
-# cuda = True if torch.cuda.is_available() else False
-# kwargs = {'num_workers': 4, 'pin_memory': True} 
+
 dataset_train, dataset_test = getDataset(args)
 
 '''
 no normalized dataset needed for VAE
 '''
 print(args)
-def main():
-    
-    dict_users = cifar_iid(dataset_train, int(1/args.partial_data*args.num_users), args.rs)
-    
-    if not args.aid_by_gen:
-        args.gen_wu_epochs = 0
-        args.local_ep_gen = 0
-        args.gen_local_ep = 0
-
-    local_models, common_net = getModel(args)
-    ws_glob = []
-    for _ in range(args.num_models):
-        ws_glob.append(local_models[_].state_dict())
-
-    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-    filename = './output/gefl/'+ timestamp + str(args.name) + str(args.rs)
-    if not os.path.exists(filename):
-        os.makedirs(filename)
-    if args.wandb:
-        run = wandb.init(dir=filename, project='GeFL-VAEF14-1028-2', name= str(args.name)+ str(args.rs), reinit=True, settings=wandb.Settings(code_dir="."))
-        wandb.config.update(args)
-
-    loss_train = []
-    lr = 1e-1
-
-    if not args.load_trained_FE:
-        w_comm = common_net.state_dict()
-
-        for iter in range(1, args.wu_epochs+1):
-            ''' ------------------------
-            Warming up for main networks
-            ------------------------ '''
-            ws_local = [[] for _ in range(args.num_models)]
-            loss_locals = []
-            
-            m = max(int(args.frac * args.num_users), 1)
-            idxs_users = np.random.choice(range(args.num_users), m, replace=False)
-            
-            for idx in idxs_users:
-                dev_spec_idx = min(idx//(args.num_users//args.num_models), args.num_models-1)
-                model_idx = dev_spec_idx
-                model = local_models[model_idx]
-                model.load_state_dict(ws_glob[model_idx])
-
-                local = LocalUpdate(args, dataset=dataset_train, idxs=dict_users[idx])
-                weight, loss, _ = local.train(net=copy.deepcopy(model).to(args.device), learning_rate=lr)
-
-                ws_local[model_idx].append(copy.deepcopy(weight))
-                loss_locals.append(loss)
-            
-            if args.avg_FE: # LG-FedAvg
-                ws_glob, w_comm = FedAvg_FE(args, ws_glob, ws_local, w_comm) # main net, feature extractor weight update
-            else: # FedAvG
-                ws_glob = FedAvg_FE_raw(args, ws_glob, ws_local)
-
-            loss_avg = sum(loss_locals) / len(loss_locals)
-            print('Warm-up TargetNet Round {:3d}, Avg loss {:.3f}'.format(iter, loss_avg))
-            loss_train.append(loss_avg)
-            if iter % 5 == 0 or iter == args.wu_epochs:
-                acc_test_tot = []
-
-                for i in range(args.num_models):
-                    model_e = local_models[i]
-                    model_e.load_state_dict(ws_glob[i])
-                    model_e.eval()
-                    acc_test, loss_test = test_img(model_e, dataset_test, args)
-                    acc_test_tot.append(acc_test)
-                    print("Testing accuracy " + str(i) + ": {:.2f}".format(acc_test))
-                    if args.wandb:
-                        wandb.log({
-                            "Communication round": iter,
-                            "Local model " + str(i) + " test accuracy": acc_test
-                        })
-                if args.wandb:
-                    wandb.log({
-                        "Communication round": iter,
-                        "Mean test accuracy": sum(acc_test_tot) / len(acc_test_tot)
-                    })
-        torch.save(w_comm, 'models/save/Fed' + '_'
-                    + str(args.models) + '14_common_net.pt')                   
-    else:
-        w_comm = torch.load('models/save/Fed_mlp_common_net.pt') # common_net = FE_MLP.to(args.device)
-            
-    common_net.load_state_dict(w_comm)
-
-    if args.freeze_FE:
-        common_net.eval()
 
-    gen_glob = CVAE(args).to(args.device)
-    opt = torch.optim.Adam(gen_glob.parameters(), lr=1e-3).state_dict()
-    opts = [copy.deepcopy(opt) for _ in range(args.num_users)]
-
-    gen_w_glob = gen_glob.state_dict()
-    for iter in range(1, args.gen_wu_epochs+1):
-        ''' ---------------------------
-        Warming up for generative model
-        --------------------------- '''
-        gen_w_local = []
-        gloss_locals = []
-        
-        m = max(int(args.frac * args.num_users), 1)
-        idxs_users = np.random.choice(range(args.num_users), m, replace=False)
-        
-        gen_glob.load_state_dict(gen_w_glob)
-        for idx in idxs_users:
-                        
-            local = LocalUpdate_VAE(args, net_com=common_net, dataset=dataset_train, idxs=dict_users[idx])
-            g_weight, gloss, opts[idx] = local.train(net=copy.deepcopy(gen_glob), opt=opts[idx])
-
-            gen_w_local.append(copy.deepcopy(g_weight))
-            gloss_locals.append(gloss)
-        
-        gen_w_glob = FedAvg(gen_w_local)
-        gloss_avg = sum(gloss_locals) / len(gloss_locals)
-
-        if args.save_imgs and (iter % args.sample_test == 0 or iter == args.gen_wu_epochs):
-            sample_num = 40
-            samples = gen_glob.sample_image_4visualization(sample_num)
-            save_image(samples.view(sample_num, args.output_channel, args.img_size, args.img_size),
-                        'imgFedVAEF/' + str(args.name)+ str(args.rs) +'SynFeat14_' + str(iter) + '.png', nrow=10, normalize=True)
-        print('Warm-up GEN Round {:3d}, G Avg loss {:.3f}'.format(iter, gloss_avg))
-
-    best_perf = [0 for _ in range(args.num_models)]
-    
-    for iter in range(1, args.epochs+1):
-        ws_local = [[] for _ in range(args.num_models)]
-        gen_w_local = []
-        
-        loss_locals = []
-        gen_loss_locals = []
-        
-        gloss_locals = []
-        
-        m = max(int(args.frac * args.num_users), 1)
-        idxs_users = np.random.choice(range(args.num_users), m, replace=False)
-        if args.aid_by_gen:
-            gen_glob.load_state_dict(gen_w_glob)
-        
-        for idx in idxs_users:
-            dev_spec_idx = min(idx//(args.num_users//args.num_models), args.num_models-1)
-            model_idx = dev_spec_idx
-            model = local_models[model_idx]
-            model.load_state_dict(ws_glob[model_idx])    
-            if args.freeze_FE:
-                if args.only_gen:
-                    # update (header; layers after FE) only by synthetic data
-                    local = LocalUpdate_onlyGen(args, dataset=dataset_train, idxs=dict_users[idx])
-                    weight, loss, gen_loss = local.train(net=copy.deepcopy(model).to(args.device), feature_start=True, gennet=copy.deepcopy(gen_glob), learning_rate=lr)
-                else:
-                    # update header by syn+real data
-                    local = LocalUpdate_header(args, dataset=dataset_train, idxs=dict_users[idx])
-                    if args.aid_by_gen:
-                        weight, loss, gen_loss = local.train(net=copy.deepcopy(model).to(args.device), feature_extractor=common_net, gennet=copy.deepcopy(gen_glob), learning_rate=lr)
-                    else:
-                        weight, loss, gen_loss = local.train(net=copy.deepcopy(model).to(args.device), feature_extractor=common_net, learning_rate=lr) # weights of models
-            else:
-                local = LocalUpdate(args, dataset=dataset_train, idxs=dict_users[idx])
-                # synthetic data updates header & real data updates whole target network
-                if args.aid_by_gen:
-                    weight, loss, gen_loss = local.train(net=copy.deepcopy(model).to(args.device), gennet=copy.deepcopy(gen_glob), learning_rate=lr)
-                else:
-                    weight, loss, gen_loss = local.train(net=copy.deepcopy(model).to(args.device), learning_rate=lr)
-
-            ws_local[model_idx].append(weight)
-            loss_locals.append(loss)
-            gen_loss_locals.append(gen_loss)
-            
-            if args.aid_by_gen and not args.freeze_gen: # update GEN
-                local_gen = LocalUpdate_VAE(args, net_com=common_net, dataset=dataset_train, idxs=dict_users[idx])
-                g_weight, gloss, opts[idx] = local_gen.train(net=copy.deepcopy(gen_glob), opt=opts[idx])
-
-                gen_w_local.append(copy.deepcopy(g_weight))
-                gloss_locals.append(gloss)
-                
-        if args.aid_by_gen and not args.freeze_gen:
-            gloss_avg = sum(gloss_locals) / len(gloss_locals)
-            gen_w_glob = FedAvg(gen_w_local)
-            if args.save_imgs and (iter % args.sample_test == 0 or iter == args.epochs):
-                sample_num = 40
-                samples = gen_glob.sample_image_4visualization(sample_num)
-                save_image(samples.view(sample_num, args.output_channel, args.img_size, args.img_size),
-                            'imgFedVAEF/' + str(args.name)+ str(args.rs) +'SynFeat14_' + str(args.gen_wu_epochs+iter) + '.png', nrow=10, normalize=True)            
-            print('GEN Round {:3d}, G Avg loss {:.3f}'.format(args.gen_wu_epochs +iter, gloss_avg))
-
-        else:
-            gloss_avg = -1
-
-        if args.freeze_FE: # LocalUpdate_header does not update w_comm, so this is redundant code
-            ws_glob, w_comm = FedAvg_frozen_FE(args, ws_glob, ws_local, w_comm) # main net, feature extractor weight update            
-        else:
-            if args.avg_FE: # LG-FedAvg
-                ws_glob, w_comm = FedAvg_FE(args, ws_glob, ws_local, w_comm) # main net, feature extractor weight update
-            else: # FedAvg
-                ws_glob = FedAvg_FE_raw(args, ws_glob, ws_local)
-
-        loss_avg = sum(loss_locals) / len(loss_locals)
-        try:
-            gen_loss_avg = sum(gen_loss_locals) / len(gen_loss_locals)
-        except:
-            gen_loss_avg = -1
-        print('Round {:3d}, Avg loss {:.3f}, Avg loss by Gen samples {:.3f}, G Avg loss {:.3f}'.format(iter, loss_avg, gen_loss_avg, gloss_avg))
-
-        loss_train.append(loss_avg)
-        if iter % args.sample_test == 0 or iter == args.epochs:
-            acc_test_tot = []
-
-            for i in range(args.num_models):
-                model_e = local_models[i]
-                model_e.load_state_dict(ws_glob[i])
-                model_e.eval()
-                acc_test, loss_test = test_img(model_e, dataset_test, args)
-                if acc_test > best_perf[i]:
-                    best_perf[i] = float(acc_test)
-
-                acc_test_tot.append(acc_test)
-                print("Testing accuracy " + str(i) + ": {:.2f}".format(acc_test))
-                if args.wandb:
-                    wandb.log({
-                        "Communication round": args.wu_epochs+iter,
-                        "Local model " + str(i) + " test accuracy": acc_test
-                    })
-            if args.wandb:
-                wandb.log({
-                    "Communication round": args.wu_epochs+iter,
-                    "Mean test accuracy": sum(acc_test_tot) / len(acc_test_tot)
-                })
+def main():
+    gen = VAEGen(LocalUpdate_VAE, CVAE, lr=1e-3, name='VAE', img_dir='imgs/imgFedVAEF/', img_tag='SynFeat14_', normalize=True)
+    engine = FedEngine(args, dataset_train, dataset_test, FeatureFamily(), gen, lr=1e-1, project='GeFL-VAEF14-1028-2',
+                       fe_path='models/save/Fed_' + str(args.models) + '14_common_net')
+    return engine.run()
 
-    if args.wandb:
-        run.finish()
-        
 
 if __name__ == "__main__":
-    for i in range(args.num_experiment):
-        torch.manual_seed(args.rs)
-        torch.cuda.manual_seed(args.rs)
-        torch.cuda.manual_seed_all(args.rs) # if use multi-GPU
-        # torch.backends.cudnn.deterministic = True
-        # torch.backends.cudnn.benchmark = False
-        np.random.seed(args.rs)
-        random.seed(args.rs)
-        main()
-        args.rs = args.rs+1
\ No newline at end of file
+    run_experiments(main, args, table='./output/gefl/' + str(args.name) + '_seeds.csv')
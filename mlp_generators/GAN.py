@@ -18,6 +18,8 @@ from torch.autograd import Variable
 
 
 class Generator(nn.Module):
+    numpy_rng = True # sample_image draws z from rng (np.random or a RandomState of the caller, utils/prefetch.py)
+
     def __init__(self, args):
         super(Generator, self).__init__()
 
@@ -47,9 +49,9 @@ class Generator(nn.Module):
         # img = img.view(img.size(0), *img_shape)
         return img
     
-    def sample_image(self, args, sample_num=0):
+    def sample_image(self, args, sample_num=0, rng=np.random):
         with torch.no_grad():
-            z = Variable(FloatTensor(np.random.normal(0, 1, (sample_num, self.args.latent_dim)))).to(self.args.device)
+            z = Variable(FloatTensor(rng.normal(0, 1, (sample_num, self.args.latent_dim)))).to(self.args.device)
             # z = torch.randn((sample_num, args.latent_dim)).to(args.device)
             c = torch.randint(10, (sample_num, )).to(args.device) # MAX_NUM, (SIZE, )
             input = torch.cat((self.label_emb(c), z), -1)
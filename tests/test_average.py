@@ -0,0 +1,165 @@
+import copy
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from utils.average import FedAvg, FedAvg_FE, FedAvg_FE_raw, FedAvg_frozen_FE, RunningAvg, RunningAvg_FE, AggPlan, layout_of, rebase
+
+
+'''
+baseline (loop) aggregation, as before the flat buffers
+'''
+def ref_FedAvg(ws):
+    w_avg = copy.deepcopy(ws[0])
+    for k in w_avg.keys():
+        for i in range(1, len(ws)):
+            w_avg[k] += ws[i][k]
+        w_avg[k] = torch.div(w_avg[k], len(ws))
+    return w_avg
+
+
+def ref_FedAvg_FE(args, wg, ws, wc):
+    num = sum(len(ws[j]) for j in range(args.num_models))
+    w_com = OrderedDict()
+    for k in wc.keys():
+        w_com[k] = 0*copy.deepcopy(wc[k])
+        for j in range(args.num_models):
+            for i in range(len(ws[j])):
+                w_com[k] += ws[j][i][k]
+        w_com[k] = torch.div(w_com[k], num)
+    w_avg = [None for _ in range(args.num_models)]
+    for j in range(args.num_models):
+        w_avg[j] = ref_FedAvg(ws[j]) if ws[j] else copy.deepcopy(wg[j])
+        for k in wc.keys():
+            w_avg[j][k] = w_com[k]
+    return w_avg, w_com
+
+
+def ref_FedAvg_frozen_FE(args, wg, ws, wc):
+    w_avg = [None for _ in range(args.num_models)]
+    for j in range(args.num_models):
+        w_avg[j] = ref_FedAvg(ws[j]) if ws[j] else copy.deepcopy(wg[j])
+        for k in wc.keys():
+            w_avg[j][k] = wc[k]
+    return w_avg, wc
+
+
+def ref_FedAvg_FE_raw(args, wg, ws):
+    return [ref_FedAvg(ws[j]) if ws[j] else copy.deepcopy(wg[j]) for j in range(args.num_models)]
+
+
+def common():
+    return OrderedDict([('fe.weight', torch.randn(6, 4)), ('fe.bias', torch.randn(6)),
+                        ('bn.num_batches_tracked', torch.randint(0, 100, ()))])
+
+
+def model(hidden):
+    w = common()
+    w['head.weight'] = torch.randn(hidden, 6)
+    w['head.bias'] = torch.randn(hidden)
+    return w
+
+
+def setup(counts=(3, 0, 2)):
+    '''
+    three architectures (the second without participants) sharing the common entries of wc
+    '''
+    torch.manual_seed(0)
+    args = SimpleNamespace(num_models=len(counts))
+    hidden = [3, 5, 7]
+    wg = [model(h) for h in hidden]
+    wc = common()
+    ws = [[model(hidden[j]) for _ in range(n)] for j, n in enumerate(counts)]
+    return args, wg, ws, wc
+
+
+def assert_state_close(a, b):
+    assert list(a.keys()) == list(b.keys())
+    for k in a.keys():
+        torch.testing.assert_close(a[k].to(b[k].dtype), b[k], msg=k)
+
+
+def test_fedavg_matches_baseline():
+    _, _, ws, _ = setup()
+    assert_state_close(FedAvg(ws[0]), ref_FedAvg(ws[0]))
+
+
+@pytest.mark.parametrize('frozen', [False, True])
+def test_fedavg_fe_matches_baseline(frozen):
+    args, wg, ws, wc = setup()
+    fn, ref = (FedAvg_frozen_FE, ref_FedAvg_frozen_FE) if frozen else (FedAvg_FE, ref_FedAvg_FE)
+    w_avg, w_com = fn(args, wg, ws, wc)
+    ref_avg, ref_com = ref(args, wg, ws, wc)
+    assert_state_close(w_com, ref_com)
+    for a, b in zip(w_avg, ref_avg):
+        assert_state_close(a, b)
+
+
+def test_fedavg_fe_raw_matches_baseline():
+    args, wg, ws, _ = setup()
+    for a, b in zip(FedAvg_FE_raw(args, wg, ws), ref_FedAvg_FE_raw(args, wg, ws)):
+        assert_state_close(a, b)
+
+
+def test_running_avg_weighted():
+    _, _, ws, _ = setup()
+    avg = RunningAvg()
+    for w, weight in zip(ws[0], (1, 2, 3)):
+        avg.add(w, weight)
+    out = avg.finalize()
+    for k in ['head.weight', 'fe.bias']:
+        torch.testing.assert_close(out[k], sum(c * w[k] for c, w in zip((1, 2, 3), ws[0])) / 6)
+    assert avg.finalize() is None # reset after finalize
+
+
+def reference(mode, args, wg, ws, wc):
+    if mode == 'fe':
+        return ref_FedAvg_FE(args, wg, ws, wc)
+    if mode == 'frozen':
+        return ref_FedAvg_frozen_FE(args, wg, ws, wc)
+    return ref_FedAvg_FE_raw(args, wg, ws), wc
+
+
+@pytest.mark.parametrize('mode', ['fe', 'frozen', 'raw'])
+def test_running_avg_fe_matches_baseline(mode):
+    args, wg, ws, wc = setup()
+    avg = RunningAvg_FE(args, wg, wc, mode=mode)
+    for _ in range(2): # finalize() resets the running sums
+        for j, group in enumerate(ws):
+            for w in group:
+                avg.add(w, model_idx=j)
+        w_avg, w_com = avg.finalize()
+        ref_avg, ref_com = reference(mode, args, wg, ws, wc)
+        assert_state_close(w_com, ref_com)
+        for a, b in zip(w_avg, ref_avg):
+            assert_state_close(a, b)
+
+
+def test_agg_plan():
+    args, wg, ws, wc = setup()
+    plan = AggPlan(wg, wc) # built once, shared by the rounds of every mode
+    assert plan.common == list(wc.keys())
+    for w in wg: # flat positions of the common entries of each architecture
+        layout = layout_of(w)
+        torch.testing.assert_close(layout.flatten(w)[plan.common_index(layout)], plan.com_layout.flatten(w))
+    for mode in ('fe', 'frozen'):
+        avg = RunningAvg_FE(args, wg, wc, mode=mode, plan=plan)
+        for j, group in enumerate(ws):
+            for w in group:
+                avg.add(w, model_idx=j)
+        w_avg, w_com = avg.finalize()
+        ref_avg, ref_com = reference(mode, args, wg, ws, wc)
+        assert_state_close(w_com, ref_com)
+        for a, b in zip(w_avg, ref_avg):
+            assert_state_close(a, b)
+
+
+def test_rebase():
+    _, wg, ws, _ = setup()
+    base, cur, w = wg[0], ws[0][0], ws[0][1]
+    assert rebase(w, base, base) is w
+    out = rebase(w, base, cur, scale=0.5) # staleness-discounted update applied to newer weights
+    torch.testing.assert_close(out['head.weight'], cur['head.weight'] + 0.5 * (w['head.weight'] - base['head.weight']))
+    assert out['bn.num_batches_tracked'] == cur['bn.num_batches_tracked'] + w['bn.num_batches_tracked'] - base['bn.num_batches_tracked']
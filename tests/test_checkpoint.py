@@ -0,0 +1,115 @@
+import argparse
+
+import pytest
+import torch
+from torch.utils.data import TensorDataset
+
+from utils.checkpoint import PHASES, load_checkpoint, save_checkpoint, start_round
+from utils.engine import FedEngine, FeatureFamily, VAEGen, add_engine_args
+from utils.localUpdate import LocalUpdate_VAE
+
+from mainNetModels.mlp import MLP2, MLP3, FE_MLP
+from mlp_generators.VAE import CVAE
+
+
+class Crash(Exception):
+    pass
+
+
+def make_args(**kwargs):
+    parser = argparse.ArgumentParser()
+    add_engine_args(parser)
+    args = parser.parse_args([])
+    args.__dict__.update(num_users=4, frac=0.5, partial_data=1., models='mlp', output_channel=1, img_size=14,
+                         dataset='mnist', num_classes=10, bs=32, local_bs=16, momentum=0, weight_decay=0, rs=0,
+                         device='cpu', wu_epochs=2, gen_wu_epochs=2, epochs=2, local_ep=1, local_ep_gen=1,
+                         gen_local_ep=1, aid_by_gen=True, freeze_FE=False, freeze_gen=False, only_gen=False,
+                         load_trained_FE=False, avg_FE=True, sample_test=100, save_imgs=False, wandb=False,
+                         name='ckpt_test', latent_size=4, ckpt_every=1)
+    args.__dict__.update(kwargs)
+    args.img_shape = (args.output_channel, args.img_size, args.img_size)
+    return args
+
+
+def build_models(args):
+    torch.manual_seed(args.rs)
+    args.num_models = 2
+    return [MLP2(), MLP3()], FE_MLP()
+
+
+def datasets():
+    g = torch.Generator().manual_seed(0)
+    train = TensorDataset(torch.rand(64, 1, 28, 28, generator=g), torch.randint(0, 10, (64,), generator=g))
+    test = TensorDataset(torch.rand(32, 1, 28, 28, generator=g), torch.randint(0, 10, (32,), generator=g))
+    return train, test
+
+
+def run(args, crash_at=None):
+    '''
+    runs the engine (crash_at: (phase, round) at whose start the run stops), returns the engine
+    '''
+    dataset_train, dataset_test = datasets()
+    gen = VAEGen(LocalUpdate_VAE, CVAE, lr=1e-3, name='VAE') if args.aid_by_gen else None
+    engine = FedEngine(args, dataset_train, dataset_test, FeatureFamily(build=build_models), gen, lr=1e-1)
+
+    def crash(engine, phase, round, **info):
+        if (phase, round) == crash_at:
+            raise Crash()
+
+    engine.on('round_start', crash)
+    try:
+        engine.run()
+    except Crash:
+        engine.executor.close()
+        engine.codec.close()
+    return engine
+
+
+def assert_weights_equal(a, b):
+    assert a.keys() == b.keys()
+    for k in a.keys():
+        torch.testing.assert_close(a[k], b[k], rtol=0, atol=0, msg=k)
+
+
+def check_resume(tmp_path, crash_at, **kwargs):
+    '''
+    a run stopped after a round and resumed from its checkpoint ends with the state of an uninterrupted run
+    '''
+    ref = run(make_args(ckpt_dir=str(tmp_path / 'ref'), **kwargs))
+
+    run(make_args(ckpt_dir=str(tmp_path / 'resumed'), **kwargs), crash_at=crash_at)
+    ckpt = load_checkpoint(str(tmp_path / 'resumed' / 'ckpt_test0.pt'))
+    assert (ckpt['phase'], ckpt['round']) == (crash_at[0], crash_at[1]-1)
+    resumed = run(make_args(ckpt_dir=str(tmp_path / 'resumed'), resume=True, **kwargs))
+
+    for a, b in zip(ref.ws_glob, resumed.ws_glob):
+        assert_weights_equal(a, b)
+    assert_weights_equal(ref.w_comm, resumed.w_comm)
+    if ref.gen is not None:
+        assert_weights_equal(ref.gen.w_glob['gen'], resumed.gen.w_glob['gen'])
+    assert ref.loss_train == resumed.loss_train
+    assert ref.comm.totals == resumed.comm.totals
+
+
+@pytest.mark.parametrize('crash_at', [('main_wu', 2), ('joint', 2)])
+@pytest.mark.parametrize('codec', ['none', 'q8'])
+def test_resume_equivalence(crash_at, codec, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    check_resume(tmp_path, crash_at, codec=codec, aid_by_gen=False)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='generator updates use CUDA tensor types')
+@pytest.mark.parametrize('crash_at', [('gen_wu', 2), ('joint', 2)])
+def test_resume_equivalence_gen(crash_at, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    check_resume(tmp_path, crash_at, codec='q8', device='cuda:0')
+
+
+def test_start_round(tmp_path):
+    path = str(tmp_path / 'a' / 'ckpt.pt')
+    assert load_checkpoint(path) is None
+    save_checkpoint(path, 'gen_wu', 3, best_perf=[1.])
+    ckpt = load_checkpoint(path)
+    assert ckpt['best_perf'] == [1.] and ckpt['phase'] == 'gen_wu'
+    assert [start_round(ckpt, phase, 10) for phase in PHASES] == [11, 4, 1]
+    assert start_round(None, 'joint', 10) == 1
@@ -0,0 +1,93 @@
+from collections import OrderedDict
+
+import pytest
+import torch
+
+from utils.average import RunningAvg, layout_of
+from utils.codec import ResidualStore, UpdateCodec, dequantize, quantize, sparsify
+
+
+def weights(scale=1.):
+    return OrderedDict([('a.weight', scale * torch.randn(50, 40)), ('a.bias', scale * torch.randn(50)),
+                        ('bn.num_batches_tracked', torch.tensor(7))])
+
+
+@pytest.mark.parametrize('bits', [8, 4])
+def test_quantize_round_trip(bits):
+    torch.manual_seed(0)
+    x = torch.randn(5000)
+    block = 256
+    data, approx = quantize(x, bits, block)
+    torch.testing.assert_close(dequantize(data, x.numel(), bits, block), approx)
+    # stochastic rounding: within one quantization step of the block's scale
+    levels = 2**(bits-1) - 1
+    scale = torch.nn.functional.pad(x, (0, (-x.numel()) % block)).view(-1, block).abs().amax(1)
+    step = (scale / levels).repeat_interleave(block)[:x.numel()]
+    assert ((x - approx).abs() <= step + 1e-6).all()
+    if bits == 4:
+        assert data[0].dtype == torch.uint8 and data[0].numel() == (x.numel() + (-x.numel()) % block) // 2
+
+
+def test_quantize_unbiased():
+    torch.manual_seed(0)
+    x = torch.randn(512)
+    mean = sum(quantize(x, 4, 512)[1] for _ in range(2000)) / 2000
+    assert (mean - x).abs().max() < 0.02
+
+
+def test_sparsify_keeps_largest():
+    torch.manual_seed(0)
+    x = torch.randn(1000)
+    (index, values), approx = sparsify(x, 0.05)
+    assert index.numel() == 50
+    top = x.abs().topk(50).indices
+    assert set(index.tolist()) == set(top.tolist())
+    torch.testing.assert_close(approx[index.long()], x[index.long()])
+    assert (approx != 0).sum() == 50
+
+
+def decode(codec, out):
+    avg = RunningAvg()
+    avg.add(codec.receive(out)[0])
+    return avg.finalize()
+
+
+@pytest.mark.parametrize('mode', ['q8', 'q4', 'topk'])
+@pytest.mark.parametrize('shared', [False, True])
+def test_error_feedback(mode, shared):
+    '''
+    what a client's uploads dropped is carried as its residual: decoded + residual == sent delta, round after round
+    '''
+    torch.manual_seed(0)
+    codec = UpdateCodec(mode, topk_ratio=0.05, block=256, shared=shared)
+    try:
+        ref = weights()
+        codec.set_ref('gen', ref)
+        layout = layout_of(ref)
+        sent, received = torch.zeros(layout.numel), torch.zeros(layout.numel)
+        for _ in range(3):
+            w = OrderedDict((k, v + 0.1 * torch.randn_like(v) if v.is_floating_point() else v + 1) for k, v in ref.items())
+            encode = codec.encoder(3, {0: 'gen'})
+            w_hat = decode(codec, encode((w,)))
+            sent += layout.flatten(w) - layout.flatten(ref)
+            received += layout.flatten(w_hat) - layout.flatten(ref)
+            torch.testing.assert_close(received + codec.residuals.get(3, 'gen'), sent, rtol=0, atol=1e-5)
+            assert w_hat['bn.num_batches_tracked'] == w['bn.num_batches_tracked'] # non-floating entries as they are
+        assert codec.residuals.get(4, 'gen') is None
+    finally:
+        codec.close()
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_residual_store_state(shared, tmp_path):
+    store = ResidualStore(str(tmp_path / 'a') if shared else None)
+    if shared:
+        (tmp_path / 'a').mkdir()
+    store.put(1, 'gen', torch.arange(4.))
+    store.put(2, 0, torch.ones(3))
+    restored = ResidualStore(str(tmp_path / 'b') if shared else None)
+    if shared:
+        (tmp_path / 'b').mkdir()
+    restored.load_state(store.state())
+    torch.testing.assert_close(restored.get(1, 'gen'), torch.arange(4.))
+    torch.testing.assert_close(restored.get(2, 0), torch.ones(3))
@@ -0,0 +1,48 @@
+from math import exp, log
+
+import pytest
+
+from utils.dpsgd import ORDERS, RDPAccountant, rdp_sgm
+
+
+def test_rdp_gaussian_mechanism():
+    # q = 1: the Gaussian mechanism, RDP order / (2 sigma^2)
+    for order in (2, 7, 64):
+        assert rdp_sgm(1., 1.3, order) == pytest.approx(order / (2 * 1.3**2))
+    assert rdp_sgm(0., 1.3, 5) == 0.
+
+
+@pytest.mark.parametrize('q', [1e-3, 0.01, 0.3])
+def test_rdp_order_two(q):
+    # closed form at order 2 (Mironov et al., 2019): log(1 + q^2 (exp(1/sigma^2) - 1))
+    sigma = 0.9
+    assert rdp_sgm(q, sigma, 2) == pytest.approx(log(1 + q**2 * (exp(1 / sigma**2) - 1)))
+
+
+@pytest.mark.parametrize('sigma, epochs, eps', [(1.1, 60, 3.01), (0.7, 45, 7.10)])
+def test_epsilon_mnist(sigma, epochs, eps):
+    # DP-SGD on MNIST (60000 samples, batch 256, delta 1e-5), as reported by the TF Privacy tutorial
+    acc = RDPAccountant(sigma, delta=1e-5)
+    acc.record(0, 256 / 60000, int(epochs * 60000 / 256))
+    assert acc.epsilon(0) == pytest.approx(eps, abs=0.05)
+
+
+def test_epsilon_gaussian_closed_form():
+    # q = 1: min over the orders of steps * order / (2 sigma^2) + log(1/delta) / (order - 1)
+    acc = RDPAccountant(4., delta=1e-5)
+    acc.record(0, 1., 10)
+    expected = min(10 * a / (2 * 16.) + log(1e5) / (a - 1) for a in ORDERS)
+    assert acc.epsilon(0) == pytest.approx(expected)
+
+
+def test_epsilon_per_client():
+    acc = RDPAccountant(1., delta=1e-5)
+    assert acc.epsilon() == 0.
+    acc.record(0, 0.01, 100)
+    acc.record(1, 0.01, 50)
+    acc.record(1, 0.01, 50) # composition over rounds
+    assert acc.epsilon(1) == pytest.approx(acc.epsilon(0))
+    acc.record(2, 0.02, 100)
+    assert acc.epsilon(2) > acc.epsilon(0)
+    assert acc.epsilon() == acc.epsilon(2) # the largest over the clients
+    assert acc.epsilon(3) == 0.
@@ -0,0 +1,67 @@
+import copy
+import pickle
+
+import pytest
+import torch
+
+from utils.optStore import MOMENTS, OptStateStore
+
+
+def trained_state(net, seed, steps=2):
+    '''
+    Adam state of net after a few steps on random data
+    '''
+    torch.manual_seed(seed)
+    opt = torch.optim.Adam(net.parameters(), lr=1e-2)
+    for _ in range(steps):
+        opt.zero_grad()
+        net(torch.randn(8, 4)).pow(2).mean().backward()
+        opt.step()
+    return copy.deepcopy(opt.state_dict())
+
+
+def assert_state_equal(a, b, dtype=None):
+    assert a['param_groups'] == b['param_groups']
+    assert a['state'].keys() == b['state'].keys()
+    for pid in a['state']:
+        for k, v in a['state'][pid].items():
+            if k in MOMENTS and dtype is not None:
+                v = v.to(dtype)
+            torch.testing.assert_close(b['state'][pid][k], v)
+
+
+@pytest.fixture
+def net():
+    return torch.nn.Sequential(torch.nn.Linear(4, 5), torch.nn.Linear(5, 2))
+
+
+@pytest.mark.parametrize('compress', [None, 'fp16', 'bf16'])
+def test_spill_and_reload(net, compress, tmp_path):
+    init = torch.optim.Adam(net.parameters(), lr=1e-2).state_dict()
+    store = OptStateStore(init, num_users=6, capacity=2, compress=compress, spill_dir=str(tmp_path))
+    states = {idx: trained_state(net, idx) for idx in range(5)}
+    for idx, s in states.items():
+        store[idx] = s
+    assert list(store.mem.keys()) == [3, 4] and set(store.meta) == {0, 1, 2} # LRU: the oldest are spilled
+    dtype = {None: None, 'fp16': torch.float16, 'bf16': torch.bfloat16}[compress]
+    for idx in [0, 2, 1, 4, 3]:
+        assert_state_equal(states[idx], store[idx], dtype)
+        assert idx in store.mem
+    assert len(store.mem) == 2
+    assert store[5] == init and store[5] is not init # never trained: a copy of the initial state
+
+    # reloaded (compressed) states load into an optimizer
+    opt = torch.optim.Adam(net.parameters(), lr=1e-2)
+    opt.load_state_dict(store[0])
+
+
+def test_pickle_keeps_spilled(net, tmp_path):
+    init = torch.optim.Adam(net.parameters(), lr=1e-2).state_dict()
+    store = OptStateStore(init, num_users=4, capacity=1, spill_dir=str(tmp_path))
+    states = {idx: trained_state(net, idx) for idx in range(3)}
+    for idx, s in states.items():
+        store[idx] = s
+    restored = pickle.loads(pickle.dumps(store))
+    assert list(restored.mem.keys()) == [2] and set(restored.meta) == {0, 1}
+    for idx in range(3):
+        assert_state_equal(states[idx], restored[idx])
@@ -0,0 +1,90 @@
+'''
+Content-addressed cache of warm-up artifacts (common FE / main nets, generator)
+
+An artifact is stored under the hash of everything that determines it
+(dataset, partition, net classes, epochs, learning rates, ... and the key of the FE it was trained on).
+On a hit the warm-up phase is skipped: the stored weights and the RNG state at the end of the phase
+are restored, so the rest of the run is the same as after a miss.
+'''
+import os
+import json
+import hashlib
+import torch
+
+from utils.checkpoint import get_rng_state, set_rng_state
+
+
+def artifact_key(**fields):
+    blob = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()[:20]
+
+
+def file_key(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()[:20]
+
+
+def data_fields(args):
+    '''
+    dataset and partition of the clients' data
+    '''
+    return dict(dataset=args.dataset, orig_img_size=getattr(args, 'orig_img_size', None),
+                noniid=args.noniid, dir_param=args.dir_param, partial_data=args.partial_data, num_users=args.num_users, rs=args.rs)
+
+
+def fe_fields(args, local_models, common_net, lr):
+    '''
+    everything that determines the main-net warm-up (ws_glob, w_comm)
+    '''
+    return dict(kind='FE', **data_fields(args), models=args.models, FE=type(common_net).__name__, main_nets=[type(net).__name__ for net in local_models],
+                wu_epochs=args.wu_epochs, local_ep=args.local_ep, local_bs=args.local_bs, frac=args.frac,
+                lr=lr, momentum=args.momentum, weight_decay=args.weight_decay, avg_FE=args.avg_FE)
+
+
+def gen_fields(args, fe_key, gen_glob, gen_lr, opt_kwargs=None, **extra):
+    '''
+    everything that determines the generator warm-up (gen_w_glob, opts) given the FE
+    (raw generators: fe_key is the key of data_fields)
+    opt_kwargs: other arguments of the generator optimizer, extra: settings of the generator adapter (e.g., guide_w)
+    '''
+    return dict(kind='gen', FE=fe_key, gen=type(gen_glob).__name__, gen_wu_epochs=args.gen_wu_epochs,
+                local_ep=args.local_ep, opt=sorted((opt_kwargs or {}).items()), extra=sorted(extra.items()),
+                freeze_gen=args.freeze_gen, epochs=args.epochs, # DDPMGen's lr decay
+                dp=args.dp, dp_clip=args.dp_clip, dp_noise=args.dp_noise, dp_delta=args.dp_delta,
+                gen_local_ep=args.gen_local_ep, gen_lr=gen_lr, local_bs=args.local_bs, frac=args.frac,
+                img_size=args.img_size, output_channel=args.output_channel,
+                latent=getattr(args, 'latent_size', getattr(args, 'latent_dim', None)),
+                n_feat=getattr(args, 'n_feat', None), n_T=getattr(args, 'n_T', None))
+
+
+class ArtifactCache(object):
+    def __init__(self, cache_dir, enabled=True):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.pt')
+
+    def load(self, key, device='cpu'):
+        '''
+        returns the stored artifact (and restores the RNG state), or None on a miss
+        '''
+        if not self.enabled or not os.path.exists(self.path(key)):
+            return None
+        artifact = torch.load(self.path(key), map_location=device, weights_only=False)
+        set_rng_state(artifact.pop('rng'))
+        print('Artifact cache hit: {} ({})'.format(self.path(key), artifact.pop('kind')))
+        return artifact
+
+    def save(self, key, kind, **artifact):
+        if not self.enabled:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        artifact['kind'] = kind
+        artifact['rng'] = get_rng_state()
+        tmp = self.path(key) + '.tmp'
+        torch.save(artifact, tmp)
+        os.replace(tmp, self.path(key))
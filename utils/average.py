@@ -1,6 +1,77 @@
 import copy
 from collections import OrderedDict
 import torch
+import torch.distributed as dist
+
+'''
+Flat-buffer aggregation
+The floating tensors of a state dict are packed into one contiguous buffer (FlatLayout: keys, shapes, offsets).
+N clients of the same architecture are stacked into an [N, numel] buffer and averaged by one reduction;
+the result is handed out as views of the averaged buffer (load_state_dict copies from them).
+Non-floating entries (e.g., BN num_batches_tracked) are averaged one by one as before.
+'''
+class FlatLayout(object):
+    def __init__(self, w):
+        self.keys, self.shapes, self.offsets = [], [], [0]
+        self.others = []
+        self.order = list(w.keys())
+        self.dtype = torch.float32
+        for k, v in w.items():
+            if torch.is_floating_point(v):
+                if not self.keys:
+                    self.dtype = v.dtype
+                self.keys.append(k)
+                self.shapes.append(v.shape)
+                self.offsets.append(self.offsets[-1] + v.numel())
+            else:
+                self.others.append(k)
+        self.numel = self.offsets[-1]
+        self.slices = {k: (self.offsets[i], self.offsets[i+1], self.shapes[i]) for i, k in enumerate(self.keys)}
+
+    def device_of(self, w):
+        return w[self.keys[0]].device if self.keys else torch.device('cpu')
+
+    def flatten(self, w, out=None):
+        return torch.cat([w[k].reshape(-1).to(self.dtype) for k in self.keys], out=out)
+
+    def view(self, flat, k):
+        start, end, shape = self.slices[k]
+        return flat[start:end].view(shape)
+
+    def unflatten(self, flat, others):
+        '''
+        state dict of views into flat (+ others: non-floating entries)
+        '''
+        return OrderedDict((k, self.view(flat, k) if k in self.slices else others[k]) for k in self.order)
+
+
+_layouts = {}
+
+def layout_of(w):
+    sig = tuple((k, tuple(v.shape), v.dtype) for k, v in w.items())
+    if sig not in _layouts:
+        _layouts[sig] = FlatLayout(w)
+    return _layouts[sig]
+
+
+def stack_weights(ws):
+    '''
+    returns (layout, [len(ws), numel] buffer of the flattened state dicts)
+    '''
+    layout = layout_of(ws[0])
+    buf = torch.empty(len(ws), layout.numel, dtype=layout.dtype, device=layout.device_of(ws[0]))
+    for i, w in enumerate(ws):
+        layout.flatten(w, out=buf[i])
+    return layout, buf
+
+
+def mean_weights(ws):
+    '''
+    average of state dicts of one architecture by a single stacked reduction
+    '''
+    layout, buf = stack_weights(ws)
+    others = {k: torch.div(sum(w[k] for w in ws), len(ws)) for k in layout.others}
+    return layout.unflatten(buf.mean(0), others)
 
 def FedAvg_frozen_FE(args, wg, ws, wc):
     '''
@@ -16,18 +87,11 @@ def FedAvg_frozen_FE(args, wg, ws, wc):
     w_avg = [None for _ in range(args.num_models)]
     for j in range(args.num_models):
         if ws[j]:
-            w_avg[j] = copy.deepcopy(ws[j][0])
-            for k in w_avg[j].keys():
-                if k not in wc.keys():
-                    for i in range(1, len(ws[j])):
-                        w_avg[j][k] += ws[j][i][k]
-                    w_avg[j][k] = torch.div(w_avg[j][k], len(ws[j]))
-                else:
-                    w_avg[j][k] = w_com[k]
+            w_avg[j] = mean_weights(ws[j])
         else:
             w_avg[j] = copy.deepcopy(wg[j]) # get weights from previous
-            for k in wc.keys():
-                w_avg[j][k] = w_com[k]
+        for k in wc.keys():
+            w_avg[j][k] = w_com[k]
      
     return w_avg, w_com
 
@@ -38,42 +102,30 @@ def FedAvg_FE(args, wg, ws, wc):
     ws: local weights (ws_local)
     wc: common weights (w_comm)
     '''
-    w_com = OrderedDict()
-    for k in wc.keys(): # initialization - debugged
-        w_com[k] = 0*copy.deepcopy(wc[k])
-
     num = 0
     for j in range(args.num_models):
         num += len(ws[j])
-    
-    '''
-    Averaging common feature extractor
-    '''
-    for k in wc.keys():
-        for j in range(args.num_models):
-            if ws[j]:
-                for i in range(len(ws[j])):
-                    w_com[k] += ws[j][i][k]
-        w_com[k] = torch.div(w_com[k], num)
 
     '''
-    Averaging non-common weights
+    Averaging non-common weights (per model group)
     '''
     w_avg = [None for _ in range(args.num_models)]
     for j in range(args.num_models):
         if ws[j]:
-            w_avg[j] = copy.deepcopy(ws[j][0])
-            for k in w_avg[j].keys():
-                if k not in wc.keys():
-                    for i in range(1, len(ws[j])):
-                        w_avg[j][k] += ws[j][i][k]
-                    w_avg[j][k] = torch.div(w_avg[j][k], len(ws[j]))
-                else:
-                    w_avg[j][k] = w_com[k]
-        else:
+            w_avg[j] = mean_weights(ws[j])
+
+    '''
+    Averaging common feature extractor (group means weighted by group sizes)
+    '''
+    w_com = OrderedDict()
+    for k in wc.keys():
+        w_com[k] = torch.div(sum(len(ws[j]) * w_avg[j][k] for j in range(args.num_models) if ws[j]), num)
+
+    for j in range(args.num_models):
+        if not ws[j]:
             w_avg[j] = copy.deepcopy(wg[j]) # get weights from previous
-            for k in wc.keys():
-                w_avg[j][k] = w_com[k]
+        for k in wc.keys():
+            w_avg[j][k] = w_com[k]
      
     return w_avg, w_com
 
@@ -90,11 +142,7 @@ def FedAvg_FE_raw(args, wg, ws):
     w_avg = [None for _ in range(args.num_models)]
     for j in range(args.num_models):
         if ws[j]:
-            w_avg[j] = copy.deepcopy(ws[j][0])
-            for k in w_avg[j].keys():
-                for i in range(1, len(ws[j])):
-                    w_avg[j][k] += ws[j][i][k]
-                w_avg[j][k] = torch.div(w_avg[j][k], len(ws[j]))
+            w_avg[j] = mean_weights(ws[j])
         else:
             w_avg[j] = copy.deepcopy(wg[j]) # get weights from previous
      
@@ -102,9 +150,176 @@ def FedAvg_FE_raw(args, wg, ws):
 
 
 def FedAvg(ws):
-    w_avg = copy.deepcopy(ws[0])
-    for k in w_avg.keys():
-        for i in range(1, len(ws)):
-            w_avg[k] += ws[i][k]
-        w_avg[k] = torch.div(w_avg[k], len(ws))
-    return w_avg
\ No newline at end of file
+    return mean_weights(ws)
+
+def rebase(w, base, cur, scale=1.):
+    '''
+    cur + scale * (w - base): a client's update (trained from base) applied to newer global weights cur
+    scale: staleness discount of the update (integer buffers, e.g. num_batches_tracked, are not scaled)
+    '''
+    if base is cur and scale == 1:
+        return w
+    return OrderedDict((k, cur[k] + (w[k] - base[k]) * scale if cur[k].is_floating_point() else cur[k] + (w[k] - base[k]))
+                       for k in w.keys())
+
+
+'''
+Streaming aggregation
+Client updates are folded into a running (weighted) sum as soon as they finish,
+so memory does not grow with the number of participants of a round.
+'''
+class RunningAvg(object):
+    '''
+    running average of state dicts of one architecture (flat buffer, see FlatLayout)
+    '''
+    def __init__(self):
+        self.layout = None
+        self.sum = None
+        self.scratch = None
+        self.reset()
+
+    def reset(self):
+        if self.sum is not None:
+            self.sum.zero_()
+        self.others = {}
+        self.total = 0
+
+    def prepare(self, layout, device):
+        if layout is not self.layout or self.sum.device != device:
+            self.layout = layout
+            self.sum = torch.zeros(layout.numel, dtype=layout.dtype, device=device)
+            self.scratch = torch.empty_like(self.sum)
+
+    def add_others(self, others, weight=1):
+        for k, v in others.items():
+            self.others[k] = self.others.get(k, 0) + weight * v
+        self.total += weight
+
+    def add(self, update, weight=1):
+        '''
+        update: state dict, or an encoded update (utils/codec.py Payload) decoded straight into the sum
+        '''
+        if not isinstance(update, dict):
+            update.fold(self, weight)
+            return
+        layout = layout_of(update)
+        self.prepare(layout, layout.device_of(update))
+        self.sum.add_(layout.flatten(update, out=self.scratch), alpha=weight)
+        self.add_others({k: update[k] for k in layout.others}, weight)
+
+    def all_reduce(self, w_ref):
+        '''
+        sums the running sums of all ranks (utils/distributed.py)
+        w_ref: a state dict of the architecture, for ranks without an update of it
+        '''
+        layout = layout_of(w_ref)
+        self.prepare(layout, layout.device_of(w_ref))
+        dist.all_reduce(self.sum)
+        total = torch.tensor([float(self.total)], dtype=torch.float64)
+        dist.all_reduce(total)
+        self.total = total.item()
+        for k in layout.others:
+            v = self.others.get(k, torch.zeros_like(w_ref[k])).to(torch.float64)
+            dist.all_reduce(v)
+            self.others[k] = v
+
+    def finalize(self):
+        '''
+        returns the average (None if nothing was added) and resets the running sum
+        '''
+        if not self.total:
+            return None
+        w_avg = self.layout.unflatten(self.sum / self.total, {k: torch.div(v, self.total) for k, v in self.others.items()})
+        self.reset()
+        return w_avg
+
+
+class AggPlan(object):
+    '''
+    one-time aggregation plan of the heterogeneous main nets sharing a common FE
+    local_models, common_net: from getModel() (modules or state dicts)
+    For every architecture, the flat positions of the common (FE) entries are recorded once,
+    so a round gathers / scatters the common FE of each model group with one index op instead of checking every key.
+    Serves trainable-FE ('fe') and frozen-FE ('frozen') aggregation alike.
+    '''
+    def __init__(self, local_models, common_net):
+        wc = common_net.state_dict() if isinstance(common_net, torch.nn.Module) else common_net
+        self.common = list(wc.keys())
+        self.com_layout = layout_of(wc)
+        self.index = {}
+        for m in local_models:
+            w = m.state_dict() if isinstance(m, torch.nn.Module) else m
+            layout = layout_of(w)
+            self.common_index(layout, layout.device_of(w))
+
+    def common_index(self, layout, device='cpu'):
+        '''
+        positions of the common floating entries in layout's flat buffer, in the order of com_layout
+        '''
+        key = (layout, str(device))
+        if key not in self.index:
+            pos = [torch.arange(*layout.slices[k][:2]) for k in self.com_layout.keys]
+            self.index[key] = (torch.cat(pos) if pos else torch.zeros(0, dtype=torch.long)).to(device)
+        return self.index[key]
+
+
+class RunningAvg_FE(object):
+    '''
+    streaming version of the main-net aggregations
+    mode: 'fe' (FedAvg_FE, the common FE is averaged over all clients),
+          'frozen' (FedAvg_frozen_FE, the common FE stays wc), 'raw' (FedAvg_FE_raw, no common FE)
+    wg: global (previous) weights (ws_glob), taken by model groups without participants
+    wc: common weights (w_comm)
+    plan: AggPlan of the models (built from wg, wc if not given)
+    add(update, weight, model_idx) / finalize() -> (w_avg, w_com) / reset()
+    '''
+    def __init__(self, args, wg, wc, mode='fe', plan=None):
+        self.num_models = args.num_models
+        self.wg = wg
+        self.wc = wc
+        self.mode = mode
+        self.plan = plan if plan is not None or mode == 'raw' else AggPlan(wg, wc)
+        self.groups = [RunningAvg() for _ in range(args.num_models)]
+
+    def reset(self):
+        for g in self.groups:
+            g.reset()
+
+    def add(self, update, weight=1, model_idx=0):
+        self.groups[model_idx].add(update, weight)
+
+    def all_reduce(self):
+        for j, g in enumerate(self.groups):
+            g.all_reduce(self.wg[j])
+
+    def finalize(self):
+        '''
+        one pass over the model groups: the common FE is gathered from (fe) / scattered into (fe, frozen)
+        each group's flat average; groups without participants share the previous private weights (copy-on-write)
+        '''
+        plan = self.plan
+        trained = [(j, g) for j, g in enumerate(self.groups) if g.total]
+        w_com, com = self.wc, None
+        if self.mode == 'fe':
+            num = sum(g.total for _, g in trained)
+            com = torch.div(sum(g.sum.index_select(0, plan.common_index(g.layout, g.sum.device)) for _, g in trained), num)
+            w_com = plan.com_layout.unflatten(com, {k: torch.div(sum(g.others[k] for _, g in trained), num)
+                                                    for k in plan.com_layout.others})
+        elif self.mode == 'frozen':
+            com = plan.com_layout.flatten(self.wc)
+
+        w_avg = [None for _ in range(self.num_models)]
+        for j, g in trained:
+            flat = torch.div(g.sum, g.total)
+            others = {k: torch.div(v, g.total) for k, v in g.others.items()}
+            if com is not None:
+                flat.index_copy_(0, plan.common_index(g.layout, flat.device), com.to(flat.device))
+                others.update((k, w_com[k]) for k in plan.com_layout.others)
+            w_avg[j] = g.layout.unflatten(flat, others)
+            g.reset()
+        for j in range(self.num_models):
+            if w_avg[j] is None:
+                w_avg[j] = OrderedDict(self.wg[j]) # get weights from previous (copy-on-write: tensors are shared, not copied)
+                if com is not None:
+                    w_avg[j].update((k, w_com[k]) for k in plan.common)
+        return w_avg, w_com
@@ -0,0 +1,83 @@
+'''
+Round-level checkpoint / resume
+
+A checkpoint stores the global state of a run at the end of a round of one of the phases
+    'main_wu' (main net warm-up) -> 'gen_wu' (generator warm-up) -> 'joint'
+together with the RNG states, so a resumed run continues with the next round as if it had not stopped.
+Besides the global weights (and generator weights / optimizer states / DP accountant, GenAdapter.state) FedEngine.save
+stores the cumulative communication totals, the codec error-feedback residuals, the versions clients hold
+(utils/versionedState.py) and the edge weights / counts between cloud syncs (utils/topology.py).
+A shared sample bank (utils/sampleBank.py) is rebuilt from the restored generator.
+Files are written atomically (temporary file + os.replace).
+'''
+import os
+import random
+import numpy as np
+import torch
+
+PHASES = ['main_wu', 'gen_wu', 'joint']
+
+
+def checkpoint_path(args):
+    return os.path.join(args.ckpt_dir, str(args.name) + str(args.rs) + '.pt')
+
+
+def get_rng_state():
+    rng = {
+        'numpy': np.random.get_state(),
+        'random': random.getstate(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        rng['cuda'] = torch.cuda.get_rng_state_all()
+    return rng
+
+
+def set_rng_state(rng):
+    np.random.set_state(rng['numpy'])
+    random.setstate(rng['random'])
+    torch.set_rng_state(rng['torch'])
+    if 'cuda' in rng and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng['cuda'])
+
+
+def save_checkpoint(path, phase, round, **state):
+    '''
+    state: ws_glob, w_comm, gen_w_glob, opts, best_perf, ... (anything torch.save can pickle)
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    state['phase'] = phase
+    state['round'] = round
+    state['rng'] = get_rng_state()
+    tmp = path + '.tmp'
+    torch.save(state, tmp)
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path, device='cpu'):
+    if not os.path.exists(path):
+        return None
+    return torch.load(path, map_location=device, weights_only=False)
+
+
+def start_round(ckpt, phase, last):
+    '''
+    first round of phase to run: 1 without checkpoint, round+1 for the checkpointed phase,
+    and last+1 (nothing to run) for phases already finished
+    '''
+    if ckpt is None:
+        return 1
+    done, cur = PHASES.index(ckpt['phase']), PHASES.index(phase)
+    if cur < done:
+        return last + 1
+    if cur == done:
+        return ckpt['round'] + 1
+    return 1
+
+
+def is_resumed_phase(ckpt, phase):
+    return ckpt is not None and ckpt['phase'] == phase
+
+
+def should_save(args, iter, last):
+    return args.ckpt_every > 0 and (iter % args.ckpt_every == 0 or iter == last)
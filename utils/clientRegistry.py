@@ -0,0 +1,65 @@
+'''
+Lazy client registry for large federations
+
+dict_users (sets / lists of sample indices) is packed into one int32 buffer + offsets.
+registry[idx] returns a ClientShard (a view of the client's indices) that is only created for sampled clients;
+its DataLoaders are built on first use and reused in later rounds (LocalUpdate* get them through get_loader).
+At most max_cached shards (and their loaders) are kept.
+'''
+from collections import OrderedDict
+import numpy as np
+from torch.utils.data import DataLoader
+
+from utils.localUpdate import DatasetSplit
+
+
+class ClientShard(object):
+    def __init__(self, idxs):
+        self.idxs = idxs # int32 array
+        self.loaders = {}
+
+    def __len__(self):
+        return len(self.idxs)
+
+    def __iter__(self):
+        return iter(self.idxs.tolist())
+
+    def loader(self, dataset, batch_size, shuffle=False, drop_last=False):
+        key = (id(dataset), batch_size, shuffle, drop_last)
+        if key not in self.loaders:
+            self.loaders[key] = DataLoader(DatasetSplit(dataset, self.idxs), batch_size=batch_size, shuffle=shuffle, drop_last=drop_last)
+        return self.loaders[key]
+
+
+class ClientRegistry(object):
+    def __init__(self, dict_users, max_cached=1024):
+        keys = sorted(dict_users.keys())
+        sizes = np.array([len(dict_users[k]) for k in keys], dtype=np.int64)
+        self.pos = {k: i for i, k in enumerate(keys)}
+        self.offsets = np.concatenate(([0], np.cumsum(sizes)))
+        self.buffer = np.empty(self.offsets[-1], dtype=np.int32)
+        for i, k in enumerate(keys):
+            self.buffer[self.offsets[i]:self.offsets[i+1]] = np.fromiter(dict_users[k], dtype=np.int32, count=sizes[i])
+        self.max_cached = max_cached
+        self.shards = OrderedDict()
+
+    def __len__(self):
+        return len(self.pos)
+
+    def __contains__(self, idx):
+        return int(idx) in self.pos
+
+    def keys(self):
+        return self.pos.keys()
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        if idx in self.shards:
+            self.shards.move_to_end(idx)
+            return self.shards[idx]
+        i = self.pos[idx]
+        shard = ClientShard(self.buffer[self.offsets[i]:self.offsets[i+1]])
+        self.shards[idx] = shard
+        if len(self.shards) > self.max_cached:
+            self.shards.popitem(last=False)
+        return shard
@@ -0,0 +1,246 @@
+'''
+Compressed client-to-server updates
+
+A client uploads the delta of its trained weights to the global weights it started from instead of the full state dict
+- q8 / q4: stochastic quantization (unbiased rounding) of the delta in blocks, one fp32 scale per block, 4-bit packed in pairs
+- topk: only the largest-magnitude fraction (--topk_ratio) of the delta is sent (int32 index + fp32 value)
+Per-client error feedback: what the encoding dropped is kept as a residual and added to the client's next delta.
+Residuals stay where updates are encoded (ResidualStore): in memory with a serial executor, as .npy files
+of a directory shared by the worker processes with a pool; they are never part of a payload.
+Encoding runs right after LocalUpdate*.train() in the process of the job (so only payloads leave workers),
+payloads are decoded straight into the running aggregate (RunningAvg.add(payload), utils/average.py).
+Non-floating entries (e.g., BN num_batches_tracked) are sent as they are.
+'''
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from utils.average import layout_of
+
+MODES = ('none', 'q8', 'q4', 'topk')
+
+
+def quantize(x, bits, block):
+    '''
+    returns (codes, scales) and the dequantized approximation of x
+    '''
+    levels = 2**(bits-1) - 1
+    n = x.numel()
+    xb = F.pad(x, (0, (-n) % block)).view(-1, block)
+    scale = xb.abs().amax(1, keepdim=True).clamp_min(1e-12)
+    q = torch.floor(xb / scale * levels + torch.rand_like(xb)).clamp_(-levels, levels).to(torch.int8)
+    approx = (q.float() * (scale / levels)).view(-1)[:n]
+    if bits == 4:
+        u = (q + 8).to(torch.uint8).view(-1, 2)
+        q = u[:, 0] | (u[:, 1] << 4)
+    return (q, scale.view(-1)), approx
+
+
+def dequantize(data, n, bits, block):
+    q, scale = data
+    levels = 2**(bits-1) - 1
+    if bits == 4:
+        q = torch.stack((q & 15, q >> 4), 1).view(-1).to(torch.int8) - 8
+    return (q.float().view(-1, block) * (scale / levels).unsqueeze(1)).view(-1)[:n]
+
+
+def sparsify(x, ratio):
+    '''
+    returns (index, values) of the top-k entries and the dense approximation of x
+    '''
+    k = max(1, int(ratio * x.numel()))
+    index = x.abs().topk(k, sorted=False).indices
+    values = x[index]
+    approx = torch.zeros_like(x).index_copy_(0, index, values)
+    return (index.to(torch.int32), values), approx
+
+
+class Payload(object):
+    '''
+    encoded update of one state dict (idx: client, key: model_idx of a main net / 'gen' / 'dis')
+    ref: flat global weights the delta applies to, attached by UpdateCodec.receive() on the server
+    '''
+    def __init__(self, idx, key, layout, mode, data, others, bits=8, block=2048):
+        self.idx = idx
+        self.key = key
+        self.layout = layout
+        self.mode = mode
+        self.data = data
+        self.others = others
+        self.bits = bits
+        self.block = block
+        self.ref = None
+
+    def nbytes(self, keys=None):
+        '''
+        uploaded bytes of the entries of keys (None: all); scales of quantized blocks are shared by element count
+        '''
+        layout = self.layout
+        if keys is None:
+            floats, others = layout.keys, layout.others
+        else:
+            floats = [k for k in keys if k in layout.slices]
+            others = [k for k in keys if k in self.others]
+        n = sum(t.numel() * t.element_size() for k in others for t in [self.others[k]])
+        if self.mode == 'topk':
+            index, values = self.data
+            per_entry = index.element_size() + values.element_size()
+            if keys is None:
+                return n + index.numel() * per_entry
+            count = sum(int(((index >= layout.slices[k][0]) & (index < layout.slices[k][1])).sum()) for k in floats)
+            return n + count * per_entry
+        q, scale = self.data
+        total = q.numel() * q.element_size() + scale.numel() * scale.element_size()
+        if keys is None:
+            return n + total
+        numel = sum(layout.slices[k][1] - layout.slices[k][0] for k in floats)
+        return n + int(round(total * numel / max(layout.numel, 1)))
+
+    def fold(self, avg, weight=1):
+        '''
+        adds weight * (ref + decoded delta) to the running sum of avg (RunningAvg)
+        '''
+        avg.prepare(self.layout, self.ref.device)
+        avg.sum.add_(self.ref, alpha=weight)
+        if self.mode == 'topk':
+            index, values = self.data
+            avg.sum.index_add_(0, index.to(avg.sum.device, torch.long), values.to(avg.sum), alpha=weight)
+        else:
+            data = tuple(t.to(avg.sum.device) for t in self.data)
+            avg.sum.add_(dequantize(data, self.layout.numel, self.bits, self.block), alpha=weight)
+        avg.add_others(self.others, weight)
+
+
+class ResidualStore(object):
+    '''
+    error-feedback residuals of the clients, (client, key) -> flat fp32 tensor
+    path: directory shared by the worker processes (None: in memory, the encoders run in this process)
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.residuals = {}
+
+    def file(self, idx, key):
+        return os.path.join(self.path, re.sub(r'\W+', '_', '{}_{}'.format(idx, key)) + '.npy')
+
+    def get(self, idx, key):
+        if self.path is None:
+            return self.residuals.get((idx, key))
+        f = self.file(idx, key)
+        return torch.from_numpy(np.load(f)) if os.path.exists(f) else None
+
+    def put(self, idx, key, residual):
+        if self.path is None:
+            self.residuals[(idx, key)] = residual
+            return
+        f = self.file(idx, key)
+        np.save(f[:-len('.npy')] + '.tmp.npy', residual.cpu().numpy())
+        os.replace(f[:-len('.npy')] + '.tmp.npy', f)
+
+    def state(self):
+        '''
+        all residuals (checkpoint), by (client, key) in memory or by file name
+        '''
+        if self.path is None:
+            return dict(self.residuals)
+        return {f: torch.from_numpy(np.load(os.path.join(self.path, f))) for f in os.listdir(self.path) if not f.endswith('.tmp.npy')}
+
+    def load_state(self, state):
+        if self.path is None:
+            self.residuals = dict(state)
+            return
+        for f, residual in state.items():
+            np.save(os.path.join(self.path, f), residual.numpy())
+
+    def __getstate__(self):
+        assert self.path is not None, 'in-memory residuals cannot be shared with worker processes'
+        return dict(path=self.path, residuals={})
+
+    def close(self):
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+class ClientEncoder(object):
+    '''
+    encodes the weights of one client's train() output, keys: {position in the output: key}
+    '''
+    def __init__(self, idx, mode, keys, refs, residuals, ratio, block):
+        self.idx = idx
+        self.mode = mode
+        self.keys = keys
+        self.refs = refs
+        self.residuals = residuals
+        self.ratio = ratio
+        self.block = block
+
+    def __call__(self, out):
+        out = list(out)
+        for pos, key in self.keys.items():
+            w = out[pos]
+            layout, ref = self.refs[key]
+            delta = layout.flatten(w).sub_(ref.to(layout.device_of(w)))
+            residual = self.residuals.get(self.idx, key)
+            if residual is not None:
+                delta.add_(residual.to(delta.device))
+            bits = 4 if self.mode == 'q4' else 8
+            if self.mode == 'topk':
+                data, approx = sparsify(delta, self.ratio)
+            else:
+                data, approx = quantize(delta, bits, self.block)
+            others = {k: w[k].clone() for k in layout.others}
+            self.residuals.put(self.idx, key, delta.sub_(approx))
+            out[pos] = Payload(self.idx, key, layout, self.mode, data, others, bits=bits, block=self.block)
+        return tuple(out)
+
+
+class UpdateCodec(object):
+    def __init__(self, mode='none', topk_ratio=0.01, block=2048, shared=False):
+        '''
+        shared: updates are encoded by worker processes (residuals in a temporary directory)
+        '''
+        assert mode in MODES, 'codec: one of ' + str(MODES)
+        self.mode = mode
+        self.ratio = topk_ratio
+        self.block = block
+        self.refs = {}
+        self.residuals = ResidualStore(tempfile.mkdtemp(prefix='codec_') if shared and self.enabled else None)
+
+    @property
+    def enabled(self):
+        return self.mode != 'none'
+
+    def set_ref(self, key, w):
+        '''
+        global weights w of key the clients of this round start from (flattened once per state dict)
+        '''
+        cached = self.refs.get(key)
+        if cached is None or cached[0] is not w:
+            layout = layout_of(w)
+            self.refs[key] = (w, layout, layout.flatten(w))
+
+    def encoder(self, idx, keys):
+        '''
+        keys: {position in the client's train() output: key}, None when updates are not compressed
+        '''
+        if not self.enabled:
+            return None
+        return ClientEncoder(idx, self.mode, keys, {k: self.refs[k][1:] for k in keys.values()},
+                             self.residuals, self.ratio, self.block)
+
+    def receive(self, out):
+        '''
+        server side of a client's output: attaches the references to its payloads
+        '''
+        for o in out:
+            if isinstance(o, Payload):
+                _, o.layout, o.ref = self.refs[o.key] # the server's layout object (payloads from workers carry a copy)
+        return out
+
+    def close(self):
+        self.residuals.close()
@@ -0,0 +1,105 @@
+'''
+Per-round communication accounting
+
+Counts the bytes every participating client downloads ('down') and uploads ('up') in a round,
+by payload type:
+    'header': main-net entries outside the common FE, 'fe': common FE (w_comm), 'gen': generator (gen_w_glob), 'dis': discriminator
+Uploads compressed by utils/codec.py are counted by their encoded size (Payload.nbytes),
+downloads by the tensors a client does not hold yet (utils/versionedState.py).
+Rows (phase, round, client, direction, payload, bytes, tier) are appended to <output dir>/comm.csv,
+round totals go to 'round_end' hooks, and the cumulative totals are logged with the test accuracies.
+Tiers: 'client' (a client and its aggregator, the server or its edge) and, with a hierarchical topology
+(utils/topology.py), 'cloud' (an edge and the cloud, client = edge id; round totals keyed 'cloud/direction/payload').
+With several ranks (utils/distributed.py) each rank writes its own clients' rows; the totals are summed over the ranks.
+'''
+import csv
+import threading
+from collections import OrderedDict
+
+PAYLOADS = ('header', 'fe', 'gen', 'dis')
+DIRECTIONS = ('down', 'up')
+TIERS = ('client', 'cloud')
+
+
+def nbytes(w, keys=None):
+    '''
+    bytes of the entries of keys (None: all) of a state dict or an encoded update (utils/codec.py Payload)
+    '''
+    if not isinstance(w, dict):
+        return w.nbytes(keys)
+    return sum(w[k].numel() * w[k].element_size() for k in (w.keys() if keys is None else keys) if k in w)
+
+
+class CommMeter(object):
+    def __init__(self, path=None, common=(), reduce=None):
+        '''
+        path: csv file of the per-client rows (None: not written)
+        common: keys of the common FE, the rest of a main net is its header
+        reduce: sums a list of numbers over ranks (DistContext.sum)
+        '''
+        self.path = path
+        self.common = list(common)
+        self.reduce = reduce
+        self.rows = []
+        self.totals = OrderedDict((t, OrderedDict((d, 0) for d in DIRECTIONS)) for t in TIERS)
+        self.total = self.totals['client']
+        self.phase, self.round = None, None
+        self.lock = threading.Lock() # clients of the 'main' and 'gen' lanes report concurrently
+        if path is not None:
+            with open(path, 'w', newline='') as f:
+                csv.writer(f).writerow(['phase', 'round', 'client', 'direction', 'payload', 'bytes', 'tier'])
+
+    def load_totals(self, totals):
+        '''
+        cumulative totals of a resumed run
+        '''
+        for tier, directions in totals.items():
+            self.totals[tier].update(directions)
+
+    def start_round(self, phase, round):
+        self.phase, self.round = phase, round
+        self.rows = []
+
+    def add(self, client, direction, payload, n, tier='client'):
+        with self.lock:
+            self.rows.append((self.phase, self.round, int(client), direction, payload, int(n), tier))
+
+    def add_main(self, client, direction, w, keys=None, tier='client'):
+        '''
+        main-net weights (entries of keys, None: all) split into common FE and header
+        '''
+        if keys is None:
+            common = self.common
+        else:
+            keys = set(keys)
+            common = [k for k in self.common if k in keys]
+        fe = nbytes(w, common) if common else 0
+        self.add(client, direction, 'fe', fe, tier)
+        self.add(client, direction, 'header', nbytes(w, keys) - fe, tier)
+
+    def round_totals(self):
+        totals = OrderedDict()
+        for _, _, _, direction, payload, n, tier in self.rows:
+            key = direction + '/' + payload if tier == 'client' else tier + '/' + direction + '/' + payload
+            totals[key] = totals.get(key, 0) + n
+        return totals
+
+    def end_round(self):
+        '''
+        writes the round's rows, adds them to the cumulative totals, returns the round's totals by direction/payload
+        '''
+        if self.path is not None and self.rows:
+            with open(self.path, 'a', newline='') as f:
+                csv.writer(f).writerows(self.rows)
+        totals = self.round_totals()
+        keys = [d + '/' + p for d in DIRECTIONS for p in PAYLOADS] + ['cloud/' + d + '/' + p for d in DIRECTIONS for p in PAYLOADS]
+        values = [totals.get(k, 0) for k in keys]
+        if self.reduce is not None:
+            values = self.reduce(values)
+        totals = OrderedDict((k, int(v)) for k, v in zip(keys, values) if v)
+        for k, v in totals.items():
+            parts = k.split('/')
+            tier = parts[0] if len(parts) == 3 else 'client'
+            self.totals[tier][parts[-2]] += v
+        self.rows = []
+        return totals
@@ -0,0 +1,65 @@
+'''
+Multi-process client simulation with torch.distributed (gloo)
+
+Every rank runs the same script (--dist True). Per round
+- rank 0 samples the clients and broadcasts them,
+- each rank trains the clients it owns (idx % world_size == rank; optimizer states and codec residuals stay on the owner)
+  and folds them into its running aggregates (utils/average.py),
+- the partial sums (flat buffers, weights, non-floating entries) are combined by all_reduce before finalize(),
+  so common FE / private weights are averaged exactly as by FedAvg_FE / FedAvg_frozen_FE.
+Only rank 0 tests, logs (wandb) and saves checkpoints, cached artifacts, models and images.
+Launch
+    one machine: torchrun --nproc_per_node N GeFL_CVAE-F.py --dist True ...
+    several nodes: torchrun --nnodes M --nproc_per_node N --rdzv_backend c10d --rdzv_endpoint host:port GeFL_CVAE-F.py --dist True ...
+    without torchrun: --dist_init tcp://host:port --world_size W --rank R in every process
+'''
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+class DistContext(object):
+    def __init__(self, args):
+        if not dist.is_initialized():
+            if args.dist_init:
+                dist.init_process_group(args.dist_backend, init_method=args.dist_init, world_size=args.world_size, rank=args.rank)
+            else: # env:// (set by torchrun)
+                dist.init_process_group(args.dist_backend)
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+
+    @property
+    def is_main(self):
+        return self.rank == 0
+
+    def share_users(self, idxs_users):
+        '''
+        the clients sampled by rank 0 (ranks' RNG streams diverge during local training)
+        '''
+        users = torch.as_tensor(np.asarray(idxs_users), dtype=torch.long)
+        dist.broadcast(users, 0)
+        return users.numpy()
+
+    def owned(self, idxs_users):
+        return [idx for idx in idxs_users if idx % self.world_size == self.rank]
+
+    def sum(self, values):
+        '''
+        element-wise sum of a list of numbers over the ranks
+        '''
+        t = torch.tensor(values, dtype=torch.float64)
+        dist.all_reduce(t)
+        return t.tolist()
+
+    def max(self, value):
+        t = torch.tensor([value], dtype=torch.float64)
+        dist.all_reduce(t, op=dist.ReduceOp.MAX)
+        return t.item()
+
+    def mean(self, values, empty=-1):
+        s, n = self.sum([sum(values), len(values)])
+        return s / n if n else empty
+
+    def close(self):
+        if dist.is_initialized():
+            dist.destroy_process_group()
@@ -0,0 +1,115 @@
+'''
+Differentially private generator training (DP-SGD, Abadi et al., 2016)
+
+DPSGD.step replaces loss.backward() of a LocalUpdate_* generator update (--dp True)
+- per-sample gradients of the whole batch by torch.func.vmap(grad(...)) (one vectorized pass, no microbatch loop),
+  chunked by --dp_chunk if memory is short
+- each sample's gradient is clipped to L2 norm --dp_clip, the sum gets N(0, (dp_noise*dp_clip)^2) noise,
+  and the mean is written to .grad, so the optimizer step is unchanged
+- BatchNorm layers normalize with their running statistics during the per-sample pass
+  (batch statistics would mix samples; the statistics are not updated from private data)
+- random ops of the model (reparameterization, diffusion noise / timesteps) draw per sample
+RDPAccountant: Renyi-DP of the sampled Gaussian mechanism (Mironov et al., 2019) per client,
+q = local_bs / shard size per step (shuffled batches, accounted as Poisson sampling), steps rounded up.
+'''
+from contextlib import contextmanager
+from functools import lru_cache
+from math import exp, lgamma, log, log1p
+
+import torch
+from torch import nn
+from torch.func import functional_call, grad_and_value, vmap
+
+ORDERS = tuple(range(2, 65)) + (80, 96, 128, 256)
+
+
+@contextmanager
+def running_stats(net):
+    '''
+    BatchNorm layers use (and keep) their running statistics inside the block
+    '''
+    bns = [m for m in net.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training]
+    for m in bns:
+        m.eval()
+    try:
+        yield
+    finally:
+        for m in bns:
+            m.train()
+
+
+class DPSGD(object):
+    def __init__(self, clip=1.0, noise_multiplier=1.0, chunk_size=None):
+        self.clip = clip
+        self.noise_multiplier = noise_multiplier
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_args(cls, args):
+        '''
+        None without --dp
+        '''
+        if not getattr(args, 'dp', False):
+            return None
+        return cls(args.dp_clip, args.dp_noise, args.dp_chunk or None)
+
+    def step(self, net, loss_fn, *batch):
+        '''
+        loss_fn(call, *sample) -> loss of one sample (a batch of one), call(*inputs) runs net
+        sets .grad of net's trainable parameters to the clipped, noised mean gradient, returns the mean loss
+        '''
+        named = {k: p for k, p in net.named_parameters() if p.requires_grad}
+        params = {k: p.detach() for k, p in named.items()}
+        buffers = dict(net.named_buffers())
+
+        def sample_loss(params, *sample):
+            call = lambda *inputs: functional_call(net, (params, buffers), inputs)
+            return loss_fn(call, *[s.unsqueeze(0) for s in sample])
+
+        with running_stats(net):
+            grads, losses = vmap(grad_and_value(sample_loss), in_dims=(None,) + (0,) * len(batch),
+                                 randomness='different', chunk_size=self.chunk_size)(params, *batch)
+        n = losses.shape[0]
+        norms = torch.stack([g.reshape(n, -1).norm(dim=1) for g in grads.values()], 1).norm(dim=1)
+        scale = (self.clip / (norms + 1e-6)).clamp(max=1.0)
+        for k, g in grads.items():
+            g = torch.tensordot(scale, g, dims=1)
+            g.add_(torch.randn_like(g), alpha=self.noise_multiplier * self.clip)
+            named[k].grad = g.div_(n)
+        return losses.mean()
+
+
+@lru_cache(maxsize=None)
+def rdp_sgm(q, sigma, order):
+    '''
+    RDP of one step of the sampled Gaussian mechanism at an integer order
+    '''
+    if q == 0:
+        return 0.
+    if q >= 1:
+        return order / (2 * sigma**2)
+    terms = [lgamma(order+1) - lgamma(k+1) - lgamma(order-k+1) + (order-k) * log1p(-q) + k * log(q) + (k*k - k) / (2 * sigma**2)
+             for k in range(order+1)]
+    m = max(terms)
+    return (m + log(sum(exp(t - m) for t in terms))) / (order - 1)
+
+
+class RDPAccountant(object):
+    def __init__(self, noise_multiplier, delta=1e-5, orders=ORDERS):
+        self.sigma = noise_multiplier
+        self.delta = delta
+        self.orders = orders
+        self.rdp = {} # client -> RDP per order
+
+    def record(self, client, q, steps):
+        rdp = self.rdp.setdefault(client, [0.] * len(self.orders))
+        for i, order in enumerate(self.orders):
+            rdp[i] += steps * rdp_sgm(round(q, 6), self.sigma, order)
+
+    def epsilon(self, client=None):
+        '''
+        (epsilon, delta)-DP of a client's data (None: the largest over the clients)
+        '''
+        clients = self.rdp.keys() if client is None else [client]
+        eps = [min(r + log(1 / self.delta) / (order - 1) for r, order in zip(self.rdp[c], self.orders)) for c in clients if c in self.rdp]
+        return max(eps) if eps else 0.
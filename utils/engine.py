@@ -0,0 +1,1113 @@
+'''
+Federated round engine of the GeFL scripts
+
+Every GeFL_*.py runs the same loop
+    main-net warm-up ('main_wu') -> generator warm-up ('gen_wu') -> joint rounds ('joint')
+FedEngine implements it once; a script only picks
+- a model family: how main nets are built, trained by a client and averaged
+    FeatureFamily: generators sample features of the common FE (utils/localUpdate.py, LG-FedAvg / frozen FE)
+    RawFamily: generators sample images (utils/localUpdateRaw.py)
+- a generator adapter: how the generator is built, trained by a client (LocalUpdate_* of the variant),
+  averaged, sampled and checkpointed
+    VAEGen (CCVAE / CVAE / VAE), DDPMGen (lr decay over the rounds), GANGen (GAN / DCGAN with a discriminator)
+- hooks called at round / phase boundaries (engine.on(event, fn), fn(engine, **info))
+- optionally a hierarchical topology (utils/topology.py): clients -> edges -> cloud
+Client execution (utils/executor.py), workspaces, vmapped groups, checkpoints, the warm-up cache,
+the client registry and the optimizer-state stores live here, so every variant gets them.
+'''
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+import torch
+import wandb
+from torchvision.utils import save_image
+
+import utils.localUpdate as localFeat
+import utils.localUpdateRaw as localRaw
+from utils.average import AggPlan, RunningAvg, RunningAvg_FE, rebase
+from utils.getData import cifar_iid, noniid_dir
+from utils.getModels import getModel
+from utils.util import test_img
+from utils.executor import ClientExecutor
+from utils.workspace import ModelWorkspace, snapshot
+from utils.versionedState import VersionedState
+from utils.groupUpdate import LocalUpdate_group, group_clients
+from utils.checkpoint import *
+from utils.artifactCache import ArtifactCache, artifact_key, data_fields, file_key, fe_fields, gen_fields
+from utils.optStore import OptStateStore
+from utils.clientRegistry import ClientRegistry
+from utils.codec import UpdateCodec
+from utils.commMeter import CommMeter, nbytes
+from utils.distributed import DistContext
+from utils.topology import EdgeTier, Topology
+from utils.dpsgd import RDPAccountant
+from utils.tensorData import tensorize
+from utils.sampleBank import SampleBank
+from utils.fusedUpdate import FusedEncoder, LocalUpdate_fused, fusable
+
+EVENTS = ('round_start', 'round_end', 'phase_end', 'test', 'run_end')
+
+# arguments not every script defines
+DEFAULTS = dict(wu_epochs=0, gen_wu_epochs=0, freeze_FE=False, freeze_gen=True, only_gen=False, load_trained_FE=False,
+                avg_FE=True, fedprox=False, noniid=False, dir_param=0.3, save_imgs=False, wandb=False)
+
+
+def add_engine_args(parser):
+    '''
+    options of the engine shared by all GeFL scripts
+    '''
+    ### parallel clients
+    parser.add_argument('--num_workers', type=int, default=0, help='worker processes for client training (<=1: serial)')
+    parser.add_argument('--worker_threads', type=int, default=0, help='intra-op threads per worker (0: cores/num_workers)')
+    parser.add_argument('--vmap_groups', type=bool, default=False, help='train clients of the same model group by one vmapped step')
+    parser.add_argument('--overlap_gen', type=bool, default=False, help='train main nets and generator concurrently in joint rounds')
+    ### checkpoint
+    parser.add_argument('--ckpt_every', type=int, default=0, help='save a checkpoint every n rounds of each phase (0: off)')
+    parser.add_argument('--ckpt_dir', type=str, default='./checkpoint/gefl/')
+    parser.add_argument('--resume', type=bool, default=False)
+    ### warm-up artifact cache
+    parser.add_argument('--artifact_cache', type=bool, default=False, help='reuse warmed-up FE/main nets and generator')
+    parser.add_argument('--cache_dir', type=str, default='./cache/')
+    ### client registry
+    parser.add_argument('--client_registry', type=bool, default=False, help='compact client indices, loaders built lazily and reused')
+    parser.add_argument('--registry_cache', type=int, default=1024, help='clients whose loaders are kept')
+    ### per-user optimizer states
+    parser.add_argument('--opt_capacity', type=int, default=0, help='optimizer states kept in memory, the rest is spilled to disk (0: all in memory)')
+    parser.add_argument('--opt_compress', type=str, default='', help='fp16 / bf16 moments')
+    parser.add_argument('--opt_spill_dir', type=str, default='')
+    ### compressed uploads
+    parser.add_argument('--codec', type=str, default='none', help='none / q8 / q4 / topk (client-to-server deltas with error feedback)')
+    parser.add_argument('--topk_ratio', type=float, default=0.01, help='fraction of the delta sent by topk')
+    parser.add_argument('--codec_gen', type=bool, default=True, help='also compress generator (and discriminator) uploads')
+    ### versioned global state
+    parser.add_argument('--delta_download', type=bool, default=True, help='clients keep the last global version they saw and download changed tensors only')
+    ### buffered asynchronous joint rounds (FedBuff)
+    parser.add_argument('--async_buffer', type=int, default=0, help='apply the buffered aggregate every K client arrivals (0: synchronous rounds)')
+    parser.add_argument('--async_concurrency', type=int, default=0, help='clients in flight (0: frac*num_users)')
+    parser.add_argument('--staleness_alpha', type=float, default=0.5, help='staleness discount (1+staleness)^-alpha of an arrival update')
+    ### torch.distributed (gloo) ranks
+    parser.add_argument('--dist', type=bool, default=False, help='clients and aggregation split over torch.distributed ranks')
+    parser.add_argument('--dist_backend', type=str, default='gloo')
+    parser.add_argument('--dist_init', type=str, default='', help='init method, e.g. tcp://host:port (default: env:// of torchrun)')
+    parser.add_argument('--world_size', type=int, default=1)
+    parser.add_argument('--rank', type=int, default=0)
+    ### hierarchical (edge / cloud) aggregation
+    parser.add_argument('--num_edges', type=int, default=0, help='clients split into contiguous blocks of edges (0: flat)')
+    parser.add_argument('--edge_sync', type=int, default=1, help='edge rounds between cloud syncs')
+    parser.add_argument('--topology', type=str, default='', help='json {"edges": [[client, ...], ...], "sync_period": P}')
+    ### pre-tensorized datasets
+    parser.add_argument('--tensor_data', type=bool, default=False, help='datasets transformed once into tensors, batches by indexing')
+    parser.add_argument('--tensor_data_half', type=bool, default=False, help='tensorized images stored as fp16')
+    ### synthetic-sample bank
+    parser.add_argument('--sample_bank', type=int, default=0, help='generator outputs pooled per generator version and shared by the clients of joint rounds (0: off)')
+    parser.add_argument('--bank_batch', type=int, default=1000, help='samples per generator call when the bank is built')
+    parser.add_argument('--bank_refresh', type=int, default=0, help='rebuild the bank every n rounds (0: on a new generator version only)')
+    ### fused joint client step
+    parser.add_argument('--fused_step', type=bool, default=False, help='main net and generator of a client trained by one pass over its data (freeze_gen False)')
+    ### generator batch prefetch
+    parser.add_argument('--gen_prefetch', type=int, default=0, help='synthetic batches sampled ahead on a background thread during local training (0: off)')
+    ### common-FE feature cache
+    parser.add_argument('--feature_cache', type=bool, default=False, help='FE outputs of a shard computed once per FE version')
+    parser.add_argument('--feature_cache_half', type=bool, default=False, help='cached features stored as fp16')
+    parser.add_argument('--feature_cache_dir', type=str, default='', help='memmapped .npy features (default: in memory)')
+    ### differentially private generator training
+    parser.add_argument('--dp', type=bool, default=False, help='DP-SGD for generator updates (vmapped per-sample gradients)')
+    parser.add_argument('--dp_clip', type=float, default=1.0, help='per-sample gradient L2 bound')
+    parser.add_argument('--dp_noise', type=float, default=1.0, help='noise multiplier (std = dp_noise*dp_clip)')
+    parser.add_argument('--dp_delta', type=float, default=1e-5)
+    parser.add_argument('--dp_chunk', type=int, default=0, help='samples per vmapped chunk (0: whole batch)')
+    ### concurrent seeds
+    parser.add_argument('--parallel_seeds', type=int, default=0, help='seeds (experiments) run concurrently (<=1: serial)')
+    parser.add_argument('--seed_threads', type=int, default=0, help='intra-op threads per seed (0: cores/parallel_seeds)')
+    return parser
+
+
+def model_index(args, idx):
+    return min(idx//(args.num_users//args.num_models), args.num_models-1)
+
+
+def sample_users(args):
+    m = max(int(args.frac * args.num_users), 1)
+    return np.random.choice(range(args.num_users), m, replace=False)
+
+
+'''
+Model families
+'''
+class ModelFamily(object):
+    '''
+    local: module of the main-net LocalUpdate* classes
+    build: args -> (local_models, common_net) (default getModel)
+    '''
+    local = None
+
+    def __init__(self, build=None):
+        self._build = build or getModel
+
+    def build(self, args):
+        return self._build(args)
+
+    def warmup_job(self, engine):
+        '''
+        returns (LocalUpdate* class, train kwargs without net / learning_rate)
+        '''
+        return self.local.LocalUpdate, {}
+
+    def joint_job(self, engine, gennet):
+        raise NotImplementedError
+
+    def group_kwargs(self, engine, gennet):
+        '''
+        LocalUpdate_group.train kwargs of a joint round (None: the mode cannot be vmapped)
+        '''
+        raise NotImplementedError
+
+    def aggregator(self, engine, phase, wg=None, wc=None):
+        '''
+        returns the running aggregate of a round's main nets (finalize() -> ws_glob, w_comm)
+        wg, wc: previous weights (default engine.ws_glob, w_comm; an edge's with a hierarchical topology)
+        '''
+        args = engine.args
+        wg = engine.ws_glob if wg is None else wg
+        wc = engine.w_comm if wc is None else wc
+        if args.avg_FE: # LG-FedAvg, main net and feature extractor weight update
+            return RunningAvg_FE(args, wg, wc, mode='fe', plan=engine.agg_plan)
+        return RunningAvg_FE(args, wg, wc, mode='raw') # FedAvg
+
+
+class FeatureFamily(ModelFamily):
+    '''
+    main nets share a common FE; generators are trained on / sample its features
+    freeze_FE: after the warm-up only headers (layers after the FE) are trained
+    joint_avg_FE: joint rounds without freeze_FE always aggregate LG-FedAvg style (FedAvg_FE), whatever avg_FE
+    '''
+    local = localFeat
+
+    def __init__(self, build=None, joint_avg_FE=False):
+        super(FeatureFamily, self).__init__(build)
+        self.joint_avg_FE = joint_avg_FE
+
+    def joint_job(self, engine, gennet):
+        args = engine.args
+        if args.freeze_FE:
+            if args.only_gen: # update header only by synthetic data (necessarily aid_by_gen=True)
+                return self.local.LocalUpdate_onlyGen, dict(feature_start=True, gennet=gennet)
+            return self.local.LocalUpdate_header, dict(feature_extractor=engine.common_net, gennet=gennet) # header by syn+real data
+        return self.local.LocalUpdate, dict(gennet=gennet) # synthetic data updates header & real data updates whole target network
+
+    def group_kwargs(self, engine, gennet):
+        args = engine.args
+        if args.freeze_FE and args.only_gen:
+            return None
+        return dict(gennet=gennet, feature_extractor=engine.common_net if args.freeze_FE else None)
+
+    def aggregator(self, engine, phase, wg=None, wc=None):
+        if phase == 'joint' and engine.args.freeze_FE: # frozen feature extractor
+            return RunningAvg_FE(engine.args, engine.ws_glob if wg is None else wg, engine.w_comm if wc is None else wc,
+                                 mode='frozen', plan=engine.agg_plan)
+        if phase == 'joint' and self.joint_avg_FE:
+            return RunningAvg_FE(engine.args, engine.ws_glob if wg is None else wg, engine.w_comm if wc is None else wc,
+                                 mode='fe', plan=engine.agg_plan)
+        return super(FeatureFamily, self).aggregator(engine, phase, wg, wc)
+
+
+class RawFamily(ModelFamily):
+    '''
+    generators are trained on / sample images (fed to the whole main net)
+    '''
+    local = localRaw
+
+    def joint_job(self, engine, gennet):
+        args = engine.args
+        if args.only_gen:
+            return self.local.LocalUpdate_onlyGen, dict(gennet=gennet)
+        if args.fedprox:
+            return self.local.LocalUpdate, {}
+        return self.local.LocalUpdate, dict(gennet=gennet)
+
+    def group_kwargs(self, engine, gennet):
+        args = engine.args
+        if args.only_gen:
+            return None
+        return dict(gennet=None if args.fedprox else gennet, feature_start=False)
+
+
+'''
+Generator adapters
+'''
+class GenAdapter(object):
+    '''
+    update: LocalUpdate_* class of the generator
+    build: args -> generator module (GANGen: (generator, discriminator))
+    lr, opt_kwargs: Adam of the per-user optimizer states
+    feature: trained on FE features (update(args, common_net, ...)), else on images of the engine's gen_data
+    img_dir: where sampled images are saved (None: not saved)
+    img_tag: file name part between the seed and the round
+    '''
+    keys = ('gen',)
+    positions = {0: 'gen'} # weights in the train() output
+
+    def __init__(self, update, build, lr=1e-3, feature=True, name='GEN', img_dir=None, img_tag='_', normalize=False,
+                 **opt_kwargs):
+        self.update = update
+        self.build = build
+        self.lr = lr
+        self.feature = feature
+        self.name = name
+        self.img_dir = img_dir
+        self.img_tag = img_tag
+        self.normalize = normalize
+        self.opt_kwargs = opt_kwargs
+
+    def setup(self, engine):
+        args = self.args = engine.args
+        self.nets = self.build_nets(args)
+        self.w_glob = {k: net.state_dict() for k, net in self.nets.items()}
+        self.opts = {k: OptStateStore(self.optimizer(net).state_dict(), args.num_users, capacity=args.opt_capacity,
+                                      compress=args.opt_compress or None, spill_dir=args.opt_spill_dir or None)
+                     for k, net in self.nets.items()}
+        self.net_com = engine.common_net if self.feature else None
+        self.comm = engine.comm
+        self.versions = engine.versions
+        self.workspace = engine.workspace
+        self.dist = engine.dist
+        self.is_main = engine.is_main
+        self.dict_users = engine.dict_users
+        self.data = None if self.feature else 'gen'
+        assert not args.dp or getattr(self.update, 'supports_dp', False), self.update.__name__ + ' has no DP-SGD mode'
+        self.accountant = RDPAccountant(args.dp_noise, args.dp_delta) if args.dp else None
+        self.epsilon = None
+        self.reset()
+
+    def build_nets(self, args):
+        return OrderedDict(gen=self.build(args).to(args.device))
+
+    def optimizer(self, net):
+        return torch.optim.Adam(net.parameters(), lr=self.lr, **self.opt_kwargs)
+
+    @property
+    def gen_glob(self):
+        return self.nets['gen']
+
+    def reset(self):
+        self.w_sum = {k: RunningAvg() for k in self.keys}
+        self.losses = OrderedDict()
+
+    def load(self):
+        for k, net in self.nets.items():
+            self.workspace.load(net, self.w_glob[k], ('gen', k)) # unchanged (e.g., frozen) tensors are not copied
+
+    def train_kwargs(self, nets, opts, phase, iter):
+        return dict(net=nets['gen'], opt=opts['gen'])
+
+    def unpack(self, out):
+        '''
+        returns ({key: weight}, {loss name: loss}, {key: optimizer state}) of a client's train() output
+        '''
+        weight, loss, opt = out
+        return {'gen': weight}, {self.name: loss}, {'gen': opt}
+
+    def job(self, engine, idx, phase, iter):
+        '''
+        returns train() kwargs of a client's generator update (the download is accounted here)
+        '''
+        nets = {k: engine.workspace.lazy(k, net, self.w_glob[k], ('gen', k)) for k, net in self.nets.items()}
+        opts = {k: self.opts[k][idx] for k in self.keys}
+        for k in self.keys:
+            self.download(idx, k)
+        return self.train_kwargs(nets, opts, phase, iter)
+
+    def download(self, idx, k):
+        '''
+        accounts the tensors of w_glob[k] client idx does not hold yet
+        '''
+        keys = self.versions.fetch(idx, ('gen', k), self.w_glob[k])
+        self.comm.add(idx, 'down', k, nbytes(self.w_glob[k], keys))
+
+    def encoder(self, engine, idx):
+        '''
+        encoder of the client's upload (None: uncompressed)
+        '''
+        codec = engine.codec
+        if not (codec.enabled and self.args.codec_gen):
+            return None
+        for k in self.keys:
+            codec.set_ref(k, self.w_glob[k])
+        return codec.encoder(idx, self.positions)
+
+    def submit(self, engine, idx, phase, iter, lane=None):
+        '''
+        the client's output is folded into the running aggregate (collect) as soon as it finishes
+        '''
+        kwargs = self.job(engine, idx, phase, iter)
+        engine.executor.submit(self.update, engine.dict_users[idx], self.net_com, lane=lane, data=self.data, encode=self.encoder(engine, idx),
+                               done=lambda out: self.collect(idx, engine.codec.receive(out)), **kwargs)
+
+    def submit_fused(self, engine, idx, iter, net, update, collect, **kwargs):
+        '''
+        main net (update, kwargs) and generator of the client by one LocalUpdate_fused pass (utils/fusedUpdate.py)
+        '''
+        gen_kwargs = self.job(engine, idx, 'joint', iter)
+        gen_net, gen_opt = gen_kwargs.pop('net'), gen_kwargs.pop('opt')
+        codec = engine.codec
+
+        def done(out):
+            main_out, gen_out = out
+            collect(idx, codec.receive(main_out))
+            self.collect(idx, codec.receive(gen_out))
+        engine.executor.submit(LocalUpdate_fused, engine.dict_users[idx], self.net_com, lane='main',
+                               encode=FusedEncoder(engine._encoder(idx), self.encoder(engine, idx)), done=done,
+                               net=net, learning_rate=engine.lr, gen_update=self.update, gen_net=gen_net, gen_opt=gen_opt,
+                               **dict(kwargs, **gen_kwargs))
+
+    def start(self, engine, idx, phase, iter, version):
+        '''
+        asynchronous update (FedEngine.joint_async), tagged with the version and global weights it starts from
+        '''
+        kwargs = self.job(engine, idx, phase, iter)
+        engine.executor.start(self.update, engine.dict_users[idx], self.net_com, data=self.data,
+                              tag=('gen', idx, (version, dict(self.w_glob))), **kwargs)
+
+    def local_epochs(self):
+        return self.args.gen_local_ep
+
+    def account(self, idx):
+        '''
+        privacy spent on client idx's shard by one local update (DP-SGD steps of local_bs samples)
+        '''
+        n, bs = len(self.dict_users[idx]), self.args.local_bs
+        self.accountant.record(idx, min(bs / n, 1.), self.local_epochs() * -(-n // bs))
+
+    def collect(self, idx, out, base=None, weight=1, scale=1.):
+        '''
+        base: global weights the client started from (asynchronous arrivals are applied to the current ones,
+        their update discounted by scale)
+        '''
+        ws, losses, opts = self.unpack(out)
+        if self.accountant is not None:
+            self.account(idx)
+        for k in self.keys:
+            self.comm.add(idx, 'up', k, nbytes(ws[k]))
+            self.w_sum[k].add(ws[k] if base is None else rebase(ws[k], base[k], self.w_glob[k], scale), weight)
+            self.opts[k][idx] = opts[k]
+        for name, loss in losses.items():
+            self.losses.setdefault(name, []).append(loss)
+
+    def aggregate(self):
+        '''
+        FedAvg of the collected clients, returns the average losses
+        '''
+        for k in self.keys:
+            if self.dist is not None:
+                self.w_sum[k].all_reduce(self.w_glob[k])
+            self.w_glob[k] = self.w_sum[k].finalize()
+        if self.dist is not None:
+            losses = OrderedDict((name, self.dist.mean(self.losses.get(name, []))) for name in self.loss_names())
+        else:
+            losses = OrderedDict((name, sum(l) / len(l)) for name, l in self.losses.items())
+        if self.accountant is not None:
+            self.epsilon = self.accountant.epsilon()
+            if self.dist is not None:
+                self.epsilon = self.dist.max(self.epsilon)
+        self.reset()
+        return losses
+
+    def loss_names(self):
+        return (self.name,)
+
+    def sample(self, sample_num):
+        return self.gen_glob.sample_image_4visualization(sample_num)
+
+    def save_samples(self, tag):
+        args = self.args
+        if not (args.save_imgs and self.img_dir and self.is_main):
+            return
+        os.makedirs(self.img_dir, exist_ok=True)
+        self.gen_glob.eval()
+        sample_num = 40
+        samples = self.sample(sample_num)
+        save_image(samples.view(sample_num, -1, args.img_size, args.img_size),
+                   self.img_dir + str(args.name) + str(args.rs) + self.img_tag + str(tag) + '.png', nrow=10, normalize=self.normalize)
+        self.gen_glob.train()
+
+    def state(self):
+        state = {}
+        for k in self.keys:
+            state[k + '_w_glob'] = self.w_glob[k]
+            state[k + '_opts'] = self.opts[k]
+        if self.accountant is not None: # privacy already spent by every client
+            state['accountant_rdp'] = self.accountant.rdp
+        return state
+
+    def load_state(self, state):
+        for k in self.keys:
+            self.w_glob[k] = state[k + '_w_glob']
+            self.opts[k] = state[k + '_opts']
+        if self.accountant is not None:
+            self.accountant.rdp = state['accountant_rdp']
+            self.epsilon = self.accountant.epsilon()
+        self.load()
+
+    def fields(self, args, fe_key):
+        return gen_fields(args, fe_key if self.feature else artifact_key(kind='raw', **data_fields(args)),
+                          self.gen_glob, gen_lr=self.lr, opt_kwargs=self.opt_kwargs, update=self.update.__name__,
+                          **self.key_fields())
+
+    def key_fields(self):
+        '''
+        constructor settings of the adapter that change the trained generator (part of its artifact key)
+        '''
+        return {}
+
+
+class VAEGen(GenAdapter):
+    '''
+    CCVAE / CVAE / VAE: train(net, opt) -> (weight, loss, opt)
+    '''
+
+
+class DDPMGen(GenAdapter):
+    '''
+    DDPM: train(net, lr_decay_rate, opt); the learning rate decays linearly over all generator rounds
+    '''
+    def __init__(self, update, build, lr=1e-4, guide_w=0.0, **kwargs):
+        super(DDPMGen, self).__init__(update, build, lr=lr, **kwargs)
+        self.guide_w = guide_w
+
+    def lr_decay(self, phase, iter):
+        args = self.args
+        if phase == 'gen_wu':
+            if args.freeze_gen:
+                return 1-iter/args.gen_wu_epochs
+            return 1-iter/(args.gen_wu_epochs+args.epochs)
+        return 1-(iter+args.gen_wu_epochs)/(args.gen_wu_epochs+args.epochs)
+
+    def train_kwargs(self, nets, opts, phase, iter):
+        return dict(net=nets['gen'], lr_decay_rate=self.lr_decay(phase, iter), opt=opts['gen'])
+
+    def local_epochs(self):
+        return self.args.local_ep # LocalUpdate_DDPM trains local_ep epochs
+
+    def key_fields(self):
+        return dict(guide_w=self.guide_w)
+
+    def sample(self, sample_num):
+        return self.gen_glob.sample_image_4visualization(sample_num, guide_w=self.guide_w)
+
+
+class GANGen(GenAdapter):
+    '''
+    GAN / DCGAN: train(gnet, dnet, [iter,] optg, optd) -> (g_weight, d_weight, gloss, dloss, optg, optd)
+    pass_iter: the update takes the generator round (DCGAN)
+    '''
+    keys = ('gen', 'dis')
+    positions = {0: 'gen', 1: 'dis'}
+
+    def __init__(self, update, build, lr=2e-4, pass_iter=False, **kwargs):
+        super(GANGen, self).__init__(update, build, lr=lr, **kwargs)
+        self.pass_iter = pass_iter
+
+    def build_nets(self, args):
+        gen, dis = self.build(args)
+        return OrderedDict(gen=gen.to(args.device), dis=dis.to(args.device))
+
+    def train_kwargs(self, nets, opts, phase, iter):
+        kwargs = dict(gnet=nets['gen'], dnet=nets['dis'], optg=opts['gen'], optd=opts['dis'])
+        if self.pass_iter:
+            kwargs['iter'] = iter if phase == 'gen_wu' else self.args.gen_wu_epochs+iter
+        return kwargs
+
+    def loss_names(self):
+        return ('G', 'D')
+
+    def key_fields(self):
+        return dict(pass_iter=self.pass_iter)
+
+    def unpack(self, out):
+        g_weight, d_weight, gloss, dloss, optg, optd = out
+        return {'gen': g_weight, 'dis': d_weight}, {'G': gloss, 'D': dloss}, {'gen': optg, 'dis': optd}
+
+
+'''
+Engine
+'''
+class FedEngine(object):
+    def __init__(self, args, dataset_train, dataset_test, family, gen=None, gen_data=None, lr=None,
+                 project='GeFL', run_name=None, fe_path=None, gen_path=None, test_first=False):
+        '''
+        family: ModelFamily of the main nets
+        gen: GenAdapter (None: no generator)
+        gen_data: dataset raw generators are trained on (default dataset_train)
+        lr: learning rate of the main nets (default args.lr)
+        project, run_name: wandb project / run name (default name+rs)
+        fe_path: prefix of the saved common FE after the warm-up (+rs.pt), gen_path: of the final generator (+name+rs.pt)
+        test_first: also test after the first joint round
+        '''
+        for k, v in DEFAULTS.items():
+            if not hasattr(args, k):
+                setattr(args, k, v)
+        self.args = args
+        self.dataset_train = dataset_train
+        self.dataset_test = dataset_test
+        self.family = family
+        self.gen = gen
+        self.gen_data = gen_data if gen_data is not None else dataset_train
+        self.lr = args.lr if lr is None else lr
+        self.project = project
+        self.run_name = run_name if run_name is not None else str(args.name) + str(args.rs)
+        self.fe_path = fe_path
+        self.gen_path = gen_path
+        self.test_first = test_first
+        self.hooks = {event: [] for event in EVENTS}
+
+    def on(self, event, fn):
+        self.hooks[event].append(fn)
+        return fn
+
+    def _hook(self, event, **info):
+        for fn in self.hooks[event]:
+            fn(self, **info)
+
+    def setup(self):
+        args = self.args
+        self.dist = DistContext(args) if args.dist else None
+        self.is_main = self.dist is None or self.dist.is_main
+        if args.noniid:
+            dict_users = noniid_dir(args, args.dir_param, self.dataset_train)
+        else:
+            dict_users = cifar_iid(self.dataset_train, int(1/args.partial_data*args.num_users), args.rs)
+        if args.client_registry:
+            dict_users = ClientRegistry(dict_users, max_cached=args.registry_cache)
+        self.dict_users = dict_users
+        if args.tensor_data: # after the split (noniid_dir reads the original targets)
+            gen_is_train = self.gen_data is self.dataset_train
+            self.dataset_train = tensorize(self.dataset_train, args.tensor_data_half)
+            self.dataset_test = tensorize(self.dataset_test, args.tensor_data_half)
+            self.gen_data = self.dataset_train if gen_is_train else tensorize(self.gen_data, args.tensor_data_half)
+
+        self.local_models, self.common_net = self.family.build(args)
+        self.agg_plan = AggPlan(self.local_models, self.common_net) # common / private slices of every model, built once
+        if not args.aid_by_gen:
+            args.gen_wu_epochs = 0
+            args.local_ep_gen = 0
+            args.gen_local_ep = 0
+            self.gen = None
+        self.ws_glob = [self.local_models[i].state_dict() for i in range(args.num_models)]
+        self.w_comm = self.common_net.state_dict()
+        self.loss_train = []
+        self.best_perf = [0 for _ in range(args.num_models)]
+
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        filename = './output/gefl/'+ timestamp + str(args.name) + str(args.rs)
+        if not os.path.exists(filename):
+            os.makedirs(filename)
+        self.comm = CommMeter(os.path.join(filename, 'comm.csv' if self.is_main else 'comm_rank{}.csv'.format(self.dist.rank)),
+                              common=self.agg_plan.common, reduce=self.dist.sum if self.dist is not None else None)
+        self.wandb_run = None
+        if args.wandb and self.is_main:
+            self.wandb_run = wandb.init(dir=filename, project=self.project, name=self.run_name, reinit=True, settings=wandb.Settings(code_dir="."))
+            wandb.config.update(args)
+
+        self.ckpt_path = checkpoint_path(args)
+        if not self.is_main: # every rank keeps its own clients' optimizer states and RNG state
+            self.ckpt_path = self.ckpt_path[:-len('.pt')] + '_rank{}.pt'.format(self.dist.rank)
+        self.ckpt = load_checkpoint(self.ckpt_path, args.device) if args.resume else None
+        if self.ckpt is not None:
+            print('Resume from {} ({} round {})'.format(self.ckpt_path, self.ckpt['phase'], self.ckpt['round']))
+            self.ws_glob, self.w_comm, self.loss_train = self.ckpt['ws_glob'], self.ckpt['w_comm'], self.ckpt['loss_train']
+            self.best_perf = self.ckpt.get('best_perf', self.best_perf)
+        # cached artifacts hold the optimizer states of one process only, not used with several ranks
+        self.cache = ArtifactCache(args.cache_dir, enabled=args.artifact_cache and self.ckpt is None and self.dist is None)
+        self.codec = UpdateCodec(args.codec, args.topk_ratio, shared=args.num_workers > 1)
+        self.executor = ClientExecutor(args, self.dataset_train, args.num_workers, args.worker_threads, overlap=args.overlap_gen,
+                                       datasets={'gen': self.gen_data})
+        self.versions = VersionedState(args.delta_download)
+        self.workspace = ModelWorkspace(args.device, enabled=self.executor.serial, versions=self.versions)
+        assert not (args.async_buffer > 0 and self.dist is not None), 'asynchronous rounds run on one process'
+        topology = Topology.from_args(args)
+        self.edges = EdgeTier(self, topology) if topology is not None else None
+        assert not (args.async_buffer > 0 and self.edges is not None), 'asynchronous rounds with a flat topology only'
+        if self.ckpt is not None and 'comm' in self.ckpt: # edge-tier state is restored when its phase starts
+            self.comm.load_totals(self.ckpt['comm'])
+            self.codec.residuals.load_state(self.ckpt['residuals'])
+            self.versions.load_state(self.ckpt['versions'])
+        self.t_start = time.time()
+
+    def save(self, phase, iter, last):
+        if should_save(self.args, iter, last):
+            state = self.gen.state() if self.gen is not None and phase != 'main_wu' else {}
+            save_checkpoint(self.ckpt_path, phase, iter, ws_glob=self.ws_glob, w_comm=self.w_comm,
+                            best_perf=self.best_perf, loss_train=self.loss_train, comm=self.comm.totals,
+                            residuals=self.codec.residuals.state(), versions=self.versions.state(self._published(phase)),
+                            edges=self.edges.state() if self.edges is not None else None, **state)
+
+    def _published(self, phase):
+        '''
+        {versioned name: weights} of the global components clients download (the generator's after the main-net warm-up)
+        '''
+        current = OrderedDict((('main', j), w) for j, w in enumerate(self.ws_glob))
+        if self.edges is not None:
+            for e, ws in enumerate(self.edges.ws):
+                current.update((('main', e, j), w) for j, w in enumerate(ws))
+        if self.gen is not None and phase != 'main_wu':
+            current.update((('gen', k), w) for k, w in self.gen.w_glob.items())
+        return current
+
+    def _reset_edges(self, phase):
+        '''
+        edges start a phase from the cloud weights, or from their checkpointed state when it is resumed
+        '''
+        if is_resumed_phase(self.ckpt, phase) and self.ckpt.get('edges') is not None:
+            self.edges.load_state(self.ckpt['edges'])
+        else:
+            self.edges.reset()
+
+    def test(self, round, track_best=True):
+        args = self.args
+        if not self.is_main:
+            return None
+        acc_test_tot = []
+        for i in range(args.num_models):
+            model_e = self.local_models[i]
+            self.workspace.load(model_e, self.ws_glob[i], ('main', i))
+            model_e.eval()
+            acc_test, loss_test = test_img(model_e, self.dataset_test, args)
+            if track_best and acc_test > self.best_perf[i]:
+                self.best_perf[i] = float(acc_test)
+            acc_test_tot.append(acc_test)
+            print("Testing accuracy " + str(i) + ": {:.2f}".format(acc_test))
+            if args.wandb:
+                wandb.log({
+                    "Communication round": round,
+                    "Local model " + str(i) + " test accuracy": acc_test
+                })
+        elapsed = time.time() - self.t_start
+        print('Communication: uplink {:.2f} MB, downlink {:.2f} MB, wall clock {:.1f}s'.format(self.comm.total['up'] / 2**20, self.comm.total['down'] / 2**20, elapsed))
+        if getattr(self.gen, 'epsilon', None) is not None: # set after the first DP generator round
+            print('Generator privacy: ({:.2f}, {})-DP per client'.format(self.gen.epsilon, args.dp_delta))
+            if args.wandb:
+                wandb.log({"Communication round": round, "DP epsilon": self.gen.epsilon})
+        cloud = self.comm.totals['cloud']
+        if self.edges is not None:
+            print('Edge-cloud: uplink {:.2f} MB, downlink {:.2f} MB'.format(cloud['up'] / 2**20, cloud['down'] / 2**20))
+        if args.wandb:
+            wandb.log({
+                "Communication round": round,
+                "Mean test accuracy": sum(acc_test_tot) / len(acc_test_tot),
+                "Uplink MB": self.comm.total['up'] / 2**20,
+                "Downlink MB": self.comm.total['down'] / 2**20,
+                "Edge-cloud uplink MB": cloud['up'] / 2**20,
+                "Edge-cloud downlink MB": cloud['down'] / 2**20,
+                "Wall clock (s)": elapsed
+            })
+        self._hook('test', round=round, acc=acc_test_tot, time=elapsed)
+        return acc_test_tot
+
+    def _train_groups(self, idxs_users, done, **kwargs):
+        '''
+        trains the main nets of idxs_users by vmapped groups, done(idx, (weight, loss, gen_loss)) per client
+        returns the trained users
+        '''
+        args = self.args
+        trained = set()
+        for model_idx, users in group_clients(args, idxs_users, self.dict_users):
+            local = LocalUpdate_group(args, dataset=self.dataset_train, idxs_group=[self.dict_users[idx] for idx in users])
+            net = self.workspace.checkout(model_idx, self.local_models[model_idx], self.ws_glob[model_idx], ('main', model_idx))
+            for idx, out in zip(users, local.train(net=net, learning_rate=self.lr, **kwargs)):
+                encode = self._encoder(idx)
+                done(idx, self.codec.receive(encode(out) if encode is not None else out))
+            trained.update(users)
+        return trained
+
+    def _sample(self):
+        '''
+        returns (sampled users, users trained by this rank)
+        '''
+        idxs_users = sample_users(self.args)
+        if self.dist is None:
+            return idxs_users, idxs_users
+        idxs_users = self.dist.share_users(idxs_users)
+        return idxs_users, self.dist.owned(idxs_users)
+
+    def _mean(self, values, empty=-1):
+        if self.dist is not None:
+            return self.dist.mean(values, empty)
+        return sum(values) / len(values) if values else empty
+
+    def _global(self, idx, model_idx):
+        '''
+        returns (versioned name, weights) of the main net client idx starts from: ws_glob, or its edge's
+        '''
+        if self.edges is None:
+            return ('main', model_idx), self.ws_glob[model_idx]
+        return self.edges.name(idx, model_idx), self.edges.weights(idx, model_idx)
+
+    def _download(self, idx, model_idx):
+        '''
+        accounts the tensors of the main net client idx does not hold yet
+        '''
+        name, w = self._global(idx, model_idx)
+        self.comm.add_main(idx, 'down', w, self.versions.fetch(idx, name, w))
+
+    def _encoder(self, idx):
+        '''
+        encoder of a client's main-net upload (None: uncompressed)
+        '''
+        model_idx = model_index(self.args, idx)
+        self._download(idx, model_idx)
+        name, w = self._global(idx, model_idx)
+        key = model_idx if self.edges is None else name
+        if self.codec.enabled:
+            self.codec.set_ref(key, w)
+        return self.codec.encoder(idx, {0: key})
+
+    def _aggregator(self, phase):
+        '''
+        the round's running aggregate (EdgeTier: per-edge aggregates)
+        '''
+        if self.edges is not None:
+            return self.edges.start_round(phase)
+        return self.family.aggregator(self, phase)
+
+    def _finalize(self, agg, iter, last):
+        if self.dist is not None:
+            agg.all_reduce()
+        if self.edges is not None:
+            self.edges.finalize(iter, last)
+        else:
+            self.ws_glob, self.w_comm = agg.finalize()
+
+    def _collector(self, agg, loss_locals, gen_loss_locals):
+        '''
+        folds a client's main-net output into the round's running aggregate
+        '''
+        def done(idx, out):
+            weight, loss, gen_loss = out
+            self.comm.add_main(idx, 'up', weight)
+            model_idx = model_index(self.args, idx)
+            (agg if self.edges is None else agg.aggregator(idx, model_idx)).add(weight, model_idx=model_idx)
+            loss_locals.append(loss)
+            if gen_loss is not None:
+                gen_loss_locals.append(gen_loss)
+        return done
+
+    def main_warmup(self):
+        ''' ------------------------
+        Warming up for main networks
+        ------------------------ '''
+        args, ckpt = self.args, self.ckpt
+        if args.load_trained_FE:
+            path = 'models/save/Fed_' + str(args.models) + '_common_net.pt'
+            self.w_comm = torch.load(path)
+            self.fe_key = file_key(path)
+            return
+
+        if is_resumed_phase(ckpt, 'main_wu'):
+            set_rng_state(ckpt['rng'])
+        self.fe_key = artifact_key(**fe_fields(args, self.local_models, self.common_net, self.lr))
+        fe_hit = self.cache.load(self.fe_key, args.device) if args.wu_epochs > 0 else None
+        if fe_hit is not None:
+            self.ws_glob, self.w_comm, self.loss_train = fe_hit['ws_glob'], fe_hit['w_comm'], fe_hit['loss_train']
+            wu_start = args.wu_epochs+1
+        else:
+            wu_start = start_round(ckpt, 'main_wu', args.wu_epochs)
+
+        update, kwargs = self.family.warmup_job(self)
+        if self.edges is not None:
+            self._reset_edges('main_wu')
+        for iter in range(wu_start, args.wu_epochs+1):
+            agg = self._aggregator('main_wu')
+            loss_locals = []
+            collect = self._collector(agg, loss_locals, [])
+            idxs_users, local_users = self._sample()
+            self.comm.start_round('main_wu', iter)
+            self._hook('round_start', phase='main_wu', round=iter, users=idxs_users)
+
+            grouped = self._train_groups(local_users, collect) if args.vmap_groups and self.edges is None else set()
+            for idx in local_users:
+                if idx not in grouped:
+                    model_idx = model_index(args, idx)
+                    name, w = self._global(idx, model_idx)
+                    net = self.workspace.checkout(model_idx, self.local_models[model_idx], w, name)
+                    self.executor.submit(update, self.dict_users[idx], encode=self._encoder(idx),
+                                         done=lambda out, idx=idx: collect(idx, self.codec.receive(out)),
+                                         net=net, learning_rate=self.lr, **kwargs)
+            self.executor.run()
+
+            self._finalize(agg, iter, args.wu_epochs)
+            loss_avg = self._mean(loss_locals)
+            comm = self.comm.end_round()
+            if self.is_main:
+                print('Warm-up TargetNet Round {:3d}, Avg loss {:.3f}'.format(iter, loss_avg))
+            self.loss_train.append(loss_avg)
+            if iter % 5 == 0 or iter == args.wu_epochs:
+                self.test(iter, track_best=False)
+            self._hook('round_end', phase='main_wu', round=iter, loss=loss_avg, comm=comm)
+            self.save('main_wu', iter, args.wu_epochs)
+
+        if args.wu_epochs > 0:
+            if fe_hit is None:
+                self.cache.save(self.fe_key, 'FE', ws_glob=self.ws_glob, w_comm=self.w_comm, loss_train=self.loss_train)
+            if self.fe_path and self.is_main:
+                torch.save(self.w_comm, self.fe_path + str(args.rs) + '.pt')
+        self._hook('phase_end', phase='main_wu')
+
+    def gen_warmup(self):
+        ''' ---------------------------
+        Warming up for generative model
+        --------------------------- '''
+        args, ckpt, gen = self.args, self.ckpt, self.gen
+        if gen is None:
+            return
+        gen.setup(self)
+        if ckpt is not None and ckpt['phase'] != 'main_wu':
+            gen.load_state(ckpt)
+        if is_resumed_phase(ckpt, 'gen_wu'):
+            set_rng_state(ckpt['rng'])
+
+        gen_key = artifact_key(**gen.fields(args, self.fe_key))
+        gen_hit = self.cache.load(gen_key, args.device) if args.gen_wu_epochs > 0 else None
+        if gen_hit is not None:
+            gen.load_state(gen_hit)
+            gen_wu_start = args.gen_wu_epochs+1
+        else:
+            gen_wu_start = start_round(ckpt, 'gen_wu', args.gen_wu_epochs)
+
+        for iter in range(gen_wu_start, args.gen_wu_epochs+1):
+            idxs_users, local_users = self._sample()
+            self.comm.start_round('gen_wu', iter)
+            self._hook('round_start', phase='gen_wu', round=iter, users=idxs_users)
+            gen.load()
+            for idx in local_users:
+                gen.submit(self, idx, 'gen_wu', iter)
+            self.executor.run()
+            losses = gen.aggregate()
+            if self.edges is not None:
+                self.edges.forward_gen(idxs_users, gen.w_glob)
+            comm = self.comm.end_round()
+
+            if iter % args.sample_test == 0 or iter == args.gen_wu_epochs:
+                gen.load()
+                gen.save_samples(iter)
+            if self.is_main:
+                print('Warm-up Gen Round {:3d}, '.format(iter) + ', '.join('{} Avg loss {:.3f}'.format(k, v) for k, v in losses.items()))
+            self._hook('round_end', phase='gen_wu', round=iter, loss=losses, comm=comm)
+            self.save('gen_wu', iter, args.gen_wu_epochs)
+
+        if gen_hit is None and args.gen_wu_epochs > 0:
+            self.cache.save(gen_key, 'gen', **gen.state()) # per-user optimizer states of this rank's clients
+        self._hook('phase_end', phase='gen_wu')
+
+    def joint(self):
+        ''' ----------------------------------------
+        Train main networks by local sample
+        and generated samples, then update generator
+        ---------------------------------------- '''
+        args, ckpt, gen = self.args, self.ckpt, self.gen
+        if is_resumed_phase(ckpt, 'joint'):
+            set_rng_state(ckpt['rng'])
+        train_gen = gen is not None and not args.freeze_gen
+        gennet = gen.gen_glob if gen is not None else None
+        bank = SampleBank(args.sample_bank, args.bank_batch, args.bank_refresh) if gen is not None and args.sample_bank > 0 else None
+        if self.edges is not None:
+            self._reset_edges('joint')
+
+        for iter in range(start_round(ckpt, 'joint', args.epochs), args.epochs+1):
+            agg = self._aggregator('joint')
+            loss_locals = []
+            gen_loss_locals = []
+            collect = self._collector(agg, loss_locals, gen_loss_locals)
+
+            idxs_users, local_users = self._sample()
+            self.comm.start_round('joint', iter)
+            self._hook('round_start', phase='joint', round=iter, users=idxs_users)
+            if gen is not None:
+                gen.load()
+            if bank is not None: # clients sample the pool of the current generator version
+                self.versions.publish(('gen', 'gen'), gen.w_glob['gen'])
+                gennet = bank.update(gen.gen_glob, args, self.versions.digest(('gen', 'gen')), iter)
+
+            group_kwargs = self.family.group_kwargs(self, gennet) if args.vmap_groups and self.edges is None else None
+            grouped = self._train_groups(local_users, collect, **group_kwargs) if group_kwargs is not None else set() # main nets trained by vmapped groups
+            update, kwargs = self.family.joint_job(self, gennet)
+            fused = train_gen and fusable(args, update, gen.update) # one pass over a client's data for both nets
+            for idx in local_users:
+                if idx not in grouped:
+                    model_idx = model_index(args, idx)
+                    name, w = self._global(idx, model_idx)
+                    net = self.workspace.lazy(model_idx, self.local_models[model_idx], w, name)
+                    if fused:
+                        gen.submit_fused(self, idx, iter, net, update, collect, **kwargs)
+                        continue
+                    self.executor.submit(update, self.dict_users[idx], lane='main', encode=self._encoder(idx),
+                                         done=lambda out, idx=idx: collect(idx, self.codec.receive(out)),
+                                         net=net, learning_rate=self.lr, **kwargs)
+                if train_gen:
+                    gen.submit(self, idx, 'joint', iter, lane='gen')
+                elif kwargs.get('gennet') is not None and bank is None: # frozen generator, sent for sampling (a bank is sampled in place)
+                    gen.download(idx, 'gen')
+            self.executor.run()
+
+            gen_losses = {}
+            if train_gen:
+                gen_losses = gen.aggregate()
+                if self.edges is not None:
+                    self.edges.forward_gen(idxs_users, gen.w_glob)
+                if iter % args.sample_test == 0 or iter == args.epochs:
+                    gen.load()
+                    gen.save_samples(args.gen_wu_epochs+iter)
+                if self.is_main:
+                    print('Gen Round {:3d}, '.format(args.gen_wu_epochs+iter) + ', '.join('{} Avg loss {:.3f}'.format(k, v) for k, v in gen_losses.items()))
+            elif self.edges is not None and kwargs.get('gennet') is not None and bank is None:
+                self.edges.forward_gen([], {'gen': gen.w_glob['gen']})
+
+            self._finalize(agg, iter, args.epochs)
+            loss_avg = self._mean(loss_locals)
+            gen_loss_avg = self._mean(gen_loss_locals)
+            comm = self.comm.end_round()
+            if self.is_main:
+                print('Round {:3d}, Average loss {:.3f}, Average loss by Gen {:.3f}'.format(iter, loss_avg, gen_loss_avg)
+                      + ''.join(', {} Avg loss {:.3f}'.format(k, v) for k, v in gen_losses.items()))
+
+            self.loss_train.append(loss_avg)
+            if (self.test_first and iter == 1) or iter % args.sample_test == 0 or iter == args.epochs:
+                self.test(args.wu_epochs+iter)
+            self._hook('round_end', phase='joint', round=iter, loss=loss_avg, gen_loss=gen_losses, comm=comm)
+            self.save('joint', iter, args.epochs)
+        self._hook('phase_end', phase='joint')
+
+    def joint_async(self):
+        ''' ----------------------------------------
+        Buffered asynchronous joint training (FedBuff)
+        args.async_concurrency clients are in flight; each pulls the current ws_glob / gen_w_glob version,
+        trains, and its arrival is applied to the current global weights discounted by its staleness,
+        cur + s * (w - base) with s = (1+staleness)^-staleness_alpha (main nets and generator).
+        Every async_buffer arrivals the buffer is averaged (RunningAvg_FE / generator RunningAvg) into a new version,
+        ws_glob + sum(s_i * (w_i - base_i)) / K.
+        The same number of client updates as args.epochs synchronous rounds is run; a version counts as a round.
+        ---------------------------------------- '''
+        args, gen = self.args, self.gen
+        train_gen = gen is not None and not args.freeze_gen
+        gennet = gen.gen_glob if gen is not None else None
+        update, kwargs = self.family.joint_job(self, gennet)
+        m = max(int(args.frac * args.num_users), 1)
+        budget = args.epochs * m
+        concurrency = min(args.async_concurrency or m, budget)
+        # bases of in-flight clients must not alias modules that are loaded in place later
+        self.ws_glob = [snapshot(w) for w in self.ws_glob]
+        if gen is not None:
+            gen.w_glob = {k: snapshot(w) for k, w in gen.w_glob.items()}
+        state = dict(version=0, tested=0, agg=self.family.aggregator(self, 'joint'), loss=[], gen_loss=[], staleness=[])
+        busy = {} # client -> jobs started for it that have not arrived (it is not pulled again before)
+
+        def pull():
+            idx = np.random.choice([i for i in range(args.num_users) if i not in busy])
+            busy[idx] = 2 if train_gen else 1
+            model_idx = model_index(args, idx)
+            self._download(idx, model_idx)
+            net = self.workspace.lazy(model_idx, self.local_models[model_idx], self.ws_glob[model_idx], ('main', model_idx))
+            self.executor.start(update, self.dict_users[idx], tag=('main', idx, (state['version'], self.ws_glob[model_idx])),
+                                net=net, learning_rate=self.lr, **kwargs)
+            if train_gen:
+                gen.start(self, idx, 'joint', args.gen_wu_epochs+state['version']+1, state['version'])
+            elif kwargs.get('gennet') is not None:
+                gen.download(idx, 'gen')
+            return 2 if train_gen else 1
+
+        def flush(final):
+            state['version'] += 1
+            version = state['version']
+            gen_losses = {}
+            if train_gen and gen.w_sum['gen'].total:
+                gen_losses = gen.aggregate()
+                gen.load()
+            if state['loss']:
+                self.ws_glob, self.w_comm = state['agg'].finalize()
+                state['agg'] = self.family.aggregator(self, 'joint')
+            loss_avg = self._mean(state['loss'])
+            print('Version {:3d}, avg staleness {:.2f}, Average loss {:.3f}, Average loss by Gen {:.3f}'.format(
+                  version, self._mean(state['staleness'], 0), loss_avg, self._mean(state['gen_loss']))
+                  + ''.join(', {} Avg loss {:.3f}'.format(k, v) for k, v in gen_losses.items()))
+            self.loss_train.append(loss_avg)
+            comm = self.comm.end_round()
+            if (self.test_first and version == 1) or version % args.sample_test == 0 or final:
+                self.test(args.wu_epochs+version)
+                state['tested'] = version
+                if train_gen:
+                    gen.save_samples(args.gen_wu_epochs+version)
+            self._hook('round_end', phase='joint', round=version, loss=loss_avg, gen_loss=gen_losses, comm=comm)
+            state.update(loss=[], gen_loss=[], staleness=[])
+            self.comm.start_round('joint', version+1)
+
+        self.comm.start_round('joint', 1)
+        started, arrived, in_flight, owed = 0, 0, 0, 0
+        while started < concurrency:
+            in_flight += pull()
+            started += 1
+
+        while in_flight > 0:
+            (kind, idx, info), out = self.executor.wait()
+            in_flight -= 1
+            busy[idx] -= 1
+            if busy[idx] == 0:
+                del busy[idx]
+            pulled, base = info
+            lag = state['version'] - pulled
+            scale = (1 + lag) ** -args.staleness_alpha
+            if kind == 'gen':
+                gen.collect(idx, out, base=base, scale=scale)
+            else:
+                weight, loss, gen_loss = out
+                model_idx = model_index(args, idx)
+                self.comm.add_main(idx, 'up', weight)
+                state['agg'].add(rebase(weight, base, self.ws_glob[model_idx], scale), model_idx=model_idx)
+                state['loss'].append(loss)
+                state['staleness'].append(lag)
+                if gen_loss is not None:
+                    state['gen_loss'].append(gen_loss)
+                owed += 1
+                arrived += 1
+                if arrived % args.async_buffer == 0 and arrived < budget:
+                    flush(False)
+            # a client is pulled again only once all its jobs have arrived
+            while owed > 0 and started < budget and len(busy) < args.num_users:
+                in_flight += pull()
+                started += 1
+                owed -= 1
+
+        if state['loss'] or (train_gen and gen.w_sum['gen'].total) or state['tested'] != state['version']:
+            flush(True)
+        self._hook('phase_end', phase='joint')
+
+    def finish(self):
+        args = self.args
+        if self.is_main:
+            print(self.best_perf, 'AVG'+str(args.rs), sum(self.best_perf)/len(self.best_perf))
+            print('Communication: uplink {:.2f} MB, downlink {:.2f} MB ({})'.format(self.comm.total['up'] / 2**20, self.comm.total['down'] / 2**20, self.comm.path))
+            if self.gen is not None and self.gen_path:
+                torch.save(self.gen.w_glob['gen'], self.gen_path + str(args.name) + str(args.rs) + '.pt')
+        self.executor.close()
+        self.codec.close()
+        if self.edges is not None:
+            self.edges.close()
+        self._hook('run_end')
+        if self.wandb_run is not None:
+            self.wandb_run.finish()
+        if self.dist is not None:
+            self.dist.close()
+        return sum(self.best_perf)/len(self.best_perf)
+
+    def run(self):
+        self.setup()
+        self.main_warmup()
+        self.common_net.load_state_dict(self.w_comm)
+        if self.args.freeze_FE:
+            self.common_net.eval()
+        self.gen_warmup()
+        if self.args.async_buffer > 0:
+            self.joint_async()
+        else:
+            self.joint()
+        return self.finish()
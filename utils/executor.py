@@ -0,0 +1,186 @@
+'''
+Process-pool execution of client local updates
+
+Each job is a LocalUpdate* class + client indices + keyword arguments of its train().
+- num_workers <= 1: jobs run eagerly in the calling process (same behaviour as the plain loop)
+- num_workers > 1: jobs run on a pool of worker processes, each with its own intra-op thread budget.
+  Tensors (nets passed to train() and returned state dicts) move through shared memory
+  (torch.multiprocessing reductions), so run() returns what local.train() would have returned.
+Returned model weights are snapshotted once (see utils/workspace.py), so they stay valid when the
+net passed to train() is a live workspace module reused by the next client.
+- overlap=True (serial only): jobs are grouped into lanes (e.g., 'main' / 'gen') that run concurrently on threads,
+  jobs of a lane run in order, and lanes only join in run() (i.e., at aggregation).
+  The intra-op thread budget is split between the lanes once, when the executor is built (torch's pool is process-wide).
+  Every lane draws from a random stream of its own (utils/threadRNG.py), seeded from the process RNG when run() starts,
+  so shuffling and noise do not depend on how the lanes interleave.
+- encode: a job's output can be encoded (utils/codec.py) in the process that ran it, before it is returned
+- done: a job's output can be handed to a callback as soon as it is available (e.g., folded into a running
+  aggregate, utils/average.py) instead of being kept until run() returns.
+- start() / wait(): asynchronous jobs (buffered asynchronous aggregation): start() returns at once,
+  wait() hands out finished jobs in completion order (in start order when jobs run in this process).
+'''
+import random
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from utils.workspace import snapshot, resolve
+from utils.threadRNG import ThreadRNG, thread_kwargs
+
+_args = None
+_datasets = None
+
+
+def _init_worker(args, datasets, num_threads):
+    global _args, _datasets
+    _args = args
+    _datasets = datasets
+    torch.set_num_threads(num_threads)
+
+
+def _run_client(job):
+    update, net_com, idxs, data, train_kwargs, encode, seed = job
+    # forked workers share the parent's RNG state, reseed per job
+    np.random.seed(seed)
+    random.seed(seed)
+    torch.manual_seed(seed)
+    out = run_client(_args, _datasets[data], update, idxs, net_com, **train_kwargs)
+    return encode(out) if encode is not None else out
+
+
+def run_client(args, dataset, update, idxs, net_com=None, rng=None, **train_kwargs):
+    '''
+    rng: ThreadRNG the job runs under (its numpy RandomState replaces np.random of the update and generator)
+    '''
+    if net_com is None:
+        local = update(args, dataset=dataset, idxs=idxs)
+    else:
+        local = update(args, net_com, dataset=dataset, idxs=idxs)
+    if rng is not None:
+        local.np_rng = rng.numpy
+        train_kwargs = thread_kwargs(rng, train_kwargs)
+    return local.train(**train_kwargs)
+
+
+def _is_weights(o):
+    return isinstance(o, dict) and len(o) > 0 and all(torch.is_tensor(v) for v in o.values())
+
+
+class ClientExecutor(object):
+    def __init__(self, args, dataset, num_workers=0, num_threads=0, overlap=False, datasets=None):
+        '''
+        num_workers: number of worker processes (<= 1: serial)
+        num_threads: intra-op threads per worker (0: split the cores of this process evenly)
+        overlap: run lanes of a serial executor concurrently
+        datasets: other datasets jobs can train on, by name (e.g., {'gen': train_data} of raw generators)
+        '''
+        self.args = args
+        self.datasets = {None: dataset}
+        self.datasets.update(datasets or {})
+        self.num_workers = num_workers
+        self.pool = None
+        self.serial = num_workers <= 1
+        self.overlap = overlap and self.serial
+        if self.overlap: # set once: changing the process-wide budget while lanes run would race
+            torch.set_num_threads(max(1, torch.get_num_threads() // 2)) # 'main' / 'gen' lanes
+        self.lanes = OrderedDict()
+        self.jobs = []
+        self.dones = []
+        self.results = []
+        self.finished = queue.Queue()
+
+        if not self.serial:
+            if num_threads <= 0:
+                num_threads = max(1, torch.get_num_threads() // num_workers)
+            # CUDA cannot be re-initialised in a forked child
+            ctx = mp.get_context('spawn' if 'cuda' in str(args.device) else 'fork')
+            self.pool = ctx.Pool(num_workers, initializer=_init_worker, initargs=(args, self.datasets, num_threads))
+
+    def submit(self, update, idxs, net_com=None, lane=None, data=None, done=None, encode=None, **train_kwargs):
+        '''
+        update: LocalUpdate* class, constructed as update(args, [net_com,] dataset=datasets[data], idxs=idxs)
+        lane: jobs of different lanes are independent (only used with overlap)
+        done: called with the job's output when it is available (on the lane's thread with overlap);
+              the output is then not returned by run()
+        encode: applied to the job's output where the job runs (e.g., utils/codec.py ClientEncoder)
+        train_kwargs: passed to update.train() (lazy workspace checkouts are resolved when the job runs)
+        '''
+        if self.overlap:
+            self.lanes.setdefault(lane, []).append((len(self.results), update, idxs, net_com, data, train_kwargs, encode, done))
+            self.results.append(None)
+        elif self.serial:
+            self.results.append(None)
+            self._deliver(len(self.results)-1, self._run(update, idxs, net_com, data, train_kwargs, encode), done)
+        else:
+            seed = np.random.randint(2**31 - 1)
+            self.jobs.append((update, net_com, list(idxs), data, resolve(train_kwargs), encode, seed))
+            self.dones.append(done)
+            self.results.append(None)
+
+    def start(self, update, idxs, net_com=None, data=None, tag=None, **train_kwargs):
+        '''
+        asynchronous job, wait() returns (tag, output) once it is finished
+        '''
+        if self.pool is None:
+            self.finished.put((tag, self._run(update, idxs, net_com, data, train_kwargs)))
+        else:
+            seed = np.random.randint(2**31 - 1)
+            job = (update, net_com, list(idxs), data, resolve(train_kwargs), None, seed)
+            self.pool.apply_async(_run_client, (job,), callback=lambda out: self.finished.put((tag, out)),
+                                  error_callback=lambda e: self.finished.put((tag, e)))
+
+    def wait(self):
+        tag, out = self.finished.get()
+        if isinstance(out, BaseException):
+            raise out
+        return tag, out
+
+    def _deliver(self, pos, out, done):
+        if done is None:
+            self.results[pos] = out
+        else:
+            done(out)
+
+    def _run(self, update, idxs, net_com, data, train_kwargs, encode=None, rng=None):
+        out = run_client(self.args, self.datasets[data], update, idxs, net_com, rng=rng, **resolve(train_kwargs))
+        if encode is not None: # encoded before the live module is reused, no snapshot needed
+            out = encode(out)
+        return tuple(snapshot(o) if _is_weights(o) else o for o in out)
+
+    def _run_lane(self, jobs, seed):
+        with ThreadRNG(seed) as rng:
+            for pos, update, idxs, net_com, data, train_kwargs, encode, done in jobs:
+                self._deliver(pos, self._run(update, idxs, net_com, data, train_kwargs, encode, rng), done)
+
+    def _run_lanes(self):
+        seeds = [np.random.randint(2**31 - 1) for _ in self.lanes] # in lane order, before any lane runs
+        try:
+            with ThreadPoolExecutor(len(self.lanes)) as pool:
+                futures = [pool.submit(self._run_lane, jobs, seed) for jobs, seed in zip(self.lanes.values(), seeds)]
+                for f in futures:
+                    f.result()
+        finally:
+            self.lanes = OrderedDict()
+
+    def run(self):
+        '''
+        returns the outputs of train() in submission order (jobs with a done callback are left out)
+        '''
+        if self.pool is not None:
+            for pos, out in enumerate(self.pool.imap(_run_client, self.jobs, chunksize=1)):
+                self._deliver(pos, out, self.dones[pos])
+            self.jobs = []
+            self.dones = []
+        elif self.lanes:
+            self._run_lanes()
+        results, self.results = [out for out in self.results if out is not None], []
+        return results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,142 @@
+'''
+Versioned cache of common-FE features
+
+--feature_cache True: a client's FE outputs are computed once per FE version, by batched inference over its shard,
+and LocalUpdate_header / LocalUpdate_VAE / LocalUpdate_CCVAE / LocalUpdate_DDPM / LocalUpdate_GAN / LocalUpdate_DCGAN
+train on them (feature_loader) instead of calling feature_extractor(images) every batch of every local epoch.
+- keyed by a hash of the FE weights (fe_digest) and the shard, so a trained FE (freeze_FE False) is never served stale;
+  entries of older FE versions are dropped
+- --feature_cache_half: stored as fp16 (served as fp32)
+- --feature_cache_dir: stored as .npy memmaps (shared by worker processes and reused by later runs), else in memory
+Shards of datasets with random train transforms (e.g., cifar10 crop / flip) are not cached.
+'''
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from torch.utils.data import RandomSampler, TensorDataset
+
+_digests = {} # (id, version) of the live FE tensors -> (the tensors, digest)
+_caches = {} # settings -> FeatureCache of this process
+
+
+def fe_digest(net):
+    '''
+    hash of a module's weights (recomputed only when a tensor is replaced or modified in place)
+    '''
+    state = net.state_dict(keep_vars=True) # the live parameters / buffers, not per-call detached views
+    key = tuple((id(t), t._version) for t in state.values())
+    if key not in _digests:
+        h = hashlib.sha1()
+        for k, t in state.items():
+            h.update(k.encode())
+            h.update(t.detach().cpu().contiguous().numpy().tobytes())
+        _digests.clear()
+        _digests[key] = (tuple(state.values()), h.hexdigest()[:16]) # the references keep the ids from being reused
+    return _digests[key][1]
+
+
+def cacheable(dataset):
+    transform = getattr(dataset, 'transform', None)
+    return not any(type(t).__name__.startswith('Random') for t in getattr(transform, 'transforms', [transform]))
+
+
+class FeatureLoader(object):
+    '''
+    batches of cached features: one permutation per epoch and a gather per batch
+    '''
+    def __init__(self, feats, labels, batch_size, shuffle=False, drop_last=False):
+        self.feats = feats
+        self.labels = labels
+        self.dataset = TensorDataset(labels) # len(loader.dataset) of the update classes
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        n = len(self.labels)
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+    def __iter__(self):
+        n = len(self.labels)
+        order = torch.randperm(n) if self.shuffle else torch.arange(n)
+        for b in range(len(self)):
+            idx = order[b*self.batch_size:(b+1)*self.batch_size]
+            yield torch.as_tensor(self.feats[idx.numpy()]).float(), self.labels[idx]
+
+
+class FeatureCache(object):
+    def __init__(self, half=False, cache_dir=None, versions=2):
+        self.half = half
+        self.cache_dir = cache_dir
+        self.versions = versions
+        self.entries = OrderedDict() # digest -> {shard key: (feats, labels)}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def shard_key(self, dataset, idxs):
+        h = hashlib.sha1(repr((type(dataset).__name__, len(dataset), getattr(dataset, 'root', None))).encode())
+        h.update(np.asarray(idxs, dtype=np.int64).tobytes())
+        return h.hexdigest()[:16]
+
+    @torch.no_grad()
+    def compute(self, fe, dataset, idxs, device, batch_size=512):
+        from utils.localUpdate import get_loader
+        training = fe.training
+        fe.eval()
+        feats, labels = [], []
+        for images, targets in get_loader(dataset, idxs, batch_size=batch_size):
+            feats.append(fe(images.to(device)).cpu())
+            labels.append(torch.as_tensor(targets))
+        fe.train(training)
+        feats = torch.cat(feats)
+        return feats.half() if self.half else feats, torch.cat(labels).long()
+
+    def get(self, fe, dataset, idxs, device):
+        '''
+        (features, labels) of a shard under the current FE weights
+        '''
+        digest = fe_digest(fe)
+        entries = self.entries.setdefault(digest, {})
+        self.entries.move_to_end(digest)
+        while len(self.entries) > self.versions:
+            self.entries.popitem(last=False)
+        key = self.shard_key(dataset, idxs)
+        if key in entries:
+            return entries[key]
+        path = os.path.join(self.cache_dir, digest + '_' + key) if self.cache_dir else None
+        if path is not None and os.path.exists(path + '_x.npy'):
+            feats, labels = np.load(path + '_x.npy', mmap_mode='r'), torch.from_numpy(np.load(path + '_y.npy'))
+        else:
+            feats, labels = self.compute(fe, dataset, idxs, device)
+            feats = feats.numpy()
+            if path is not None:
+                np.save(path + '_y.npy', labels.numpy())
+                np.save(path + '_x.tmp.npy', feats)
+                os.replace(path + '_x.tmp.npy', path + '_x.npy') # readers never see a partial file
+                feats = np.load(path + '_x.npy', mmap_mode='r')
+        entries[key] = (feats, labels)
+        return entries[key]
+
+
+def get_cache(args):
+    key = (bool(args.feature_cache_half), args.feature_cache_dir or None)
+    if key not in _caches:
+        _caches[key] = FeatureCache(*key)
+    return _caches[key]
+
+
+def feature_loader(args, fe, loader):
+    '''
+    returns (loader, feature extractor) of a LocalUpdate_* train loop:
+    with --feature_cache, a FeatureLoader of the cached features and the identity, else (loader, fe)
+    '''
+    base = getattr(loader, 'iterable', loader) # tqdm-wrapped loaders
+    split = getattr(base, 'dataset', None)
+    if not getattr(args, 'feature_cache', False) or fe is None or not hasattr(split, 'idxs') or not cacheable(split.dataset):
+        return loader, fe
+    feats, labels = get_cache(args).get(fe, split.dataset, split.idxs, args.device)
+    shuffle = base.shuffle if hasattr(base, 'shuffle') else isinstance(base.sampler, RandomSampler) # TensorLoader / DataLoader
+    return FeatureLoader(feats, labels, base.batch_size, shuffle, base.drop_last), lambda x: x
@@ -0,0 +1,150 @@
+'''
+Fused client step of joint rounds (--fused_step True, freeze_gen False)
+
+LocalUpdate_fused trains a client's main net (LocalUpdate / LocalUpdate_header of FeatureFamily) and its generator
+(LocalUpdate_VAE / LocalUpdate_CCVAE / LocalUpdate_DDPM) by one pass over the shard per epoch: every batch is loaded
+once, its common-FE features are computed once, and they feed both the main-net SGD step and the generator Adam step
+(with a frozen FE, LocalUpdate_header, the main net consumes the same features, read from utils/featureCache.py if enabled).
+Main net and generator keep their own epoch counts; the generator's optimizer, epochs (local_epochs) and drop_last
+are those of its update class (a dropped last batch only trains the main net). The synthetic-sample
+epochs of the main net run first, as in LocalUpdate*. Returns ((weight, loss, gen_loss), (gen weight, gen loss, gen optimizer state)).
+GAN generators, DP-SGD (--dp) and vmapped groups keep separate passes.
+'''
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from utils.localUpdate import (LocalUpdate, LocalUpdate_CCVAE, LocalUpdate_DDPM, LocalUpdate_header, LocalUpdate_VAE,
+                               get_loader, loss_function, loss_function_ccvae)
+from utils.featureCache import feature_loader
+from utils.prefetch import prefetch_gen
+
+
+def _vae_loss(net, feats, labels, args):
+    recon_batch, mu, logvar = net(feats, labels)
+    return loss_function(recon_batch.view(-1, int(np.prod(args.img_shape))), feats, mu, logvar)
+
+
+def _ccvae_loss(net, feats, labels, args):
+    pred, mu, logvar = net(feats, F.one_hot(labels, 10).double())
+    recon_loss, kld = loss_function_ccvae(feats, pred, mu, logvar)
+    return recon_loss + kld
+
+
+def _ddpm_loss(net, feats, labels, args):
+    return net(feats.view(-1, args.output_channel, args.img_size, args.img_size), labels)
+
+
+# generator update -> (batch loss, loss report: 'sum' per sample / 'ema')
+GEN_STEPS = {
+    LocalUpdate_VAE: (_vae_loss, 'sum'),
+    LocalUpdate_CCVAE: (_ccvae_loss, 'sum'),
+    LocalUpdate_DDPM: (_ddpm_loss, 'ema'),
+}
+MAIN_UPDATES = (LocalUpdate, LocalUpdate_header)
+
+
+def fusable(args, update, gen_update):
+    return args.fused_step and not args.dp and update in MAIN_UPDATES and gen_update in GEN_STEPS
+
+
+class FusedEncoder(object):
+    '''
+    applies the main-net and generator encoders (utils/codec.py) to the two outputs of a fused step
+    '''
+    def __init__(self, main=None, gen=None):
+        self.main = main
+        self.gen = gen
+
+    def __call__(self, out):
+        main_out, gen_out = out
+        return (self.main(main_out) if self.main is not None else main_out,
+                self.gen(gen_out) if self.gen is not None else gen_out)
+
+
+class LocalUpdate_fused(object):
+    def __init__(self, args, net_com, dataset=None, idxs=None):
+        self.args = args
+        self.feature_extractor = net_com
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True)
+        self.less_samples = len(idxs)//args.local_bs == 0
+        self.mini_bs = len(idxs)
+
+    def train_synthetic(self, net, learning_rate, gennet, header):
+        '''
+        main net on generated features (local_ep_gen epochs), as LocalUpdate / LocalUpdate_header
+        '''
+        args = self.args
+        n = len(self.ldr_train.dataset)
+        iters = max(n//args.local_bs, 1) if header else n//args.local_bs
+        sample_num = self.mini_bs if header and self.less_samples else args.local_bs
+        optimizer = torch.optim.SGD(net.parameters(), lr=learning_rate, momentum=args.momentum, weight_decay=args.weight_decay)
+        gennet.eval()
+        with prefetch_gen(args, gennet, sample_num, args.local_ep_gen*iters) as gennet:
+            epoch_loss = []
+            for iter in range(args.local_ep_gen):
+                batch_loss = []
+                for i in range(iters):
+                    with torch.no_grad():
+                        images, labels = gennet.sample_image(args, sample_num=sample_num)
+                    logits, log_probs = net(images, start_layer='feature')
+                    loss = F.cross_entropy(logits, labels)
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
+                    batch_loss.append(loss.item())
+                if batch_loss:
+                    epoch_loss.append(sum(batch_loss)/len(batch_loss))
+        return sum(epoch_loss) / len(epoch_loss) if epoch_loss else None
+
+    def train(self, net, learning_rate, gen_update, gen_net, gen_opt=None, gennet=None, feature_extractor=None, lr_decay_rate=1.0):
+        '''
+        feature_extractor: frozen FE of LocalUpdate_header (None: LocalUpdate, the main net is trained end to end)
+        '''
+        args = self.args
+        header = feature_extractor is not None
+        gen_loss_fn, report = GEN_STEPS[gen_update]
+        net.train()
+        gen_net.train()
+        self.feature_extractor.eval()
+
+        gen_loss = self.train_synthetic(net, learning_rate, gennet, header) if gennet else None
+
+        optimizer = torch.optim.SGD(net.parameters(), lr=learning_rate, momentum=args.momentum, weight_decay=args.weight_decay)
+        g_optimizer = gen_update.optimizer(gen_net, gen_opt)
+        if gen_update is LocalUpdate_DDPM:
+            g_optimizer.param_groups[0]['lr'] = gen_update.lr*lr_decay_rate
+        ldr_train, fe = feature_loader(args, self.feature_extractor, self.ldr_train) if header else (self.ldr_train, self.feature_extractor)
+
+        main_epochs, g_epochs = args.local_ep, gen_update.local_epochs(args)
+        epoch_loss, g_epoch_loss = [], []
+        for iter in range(max(main_epochs, g_epochs)):
+            train_main, train_gen = iter < main_epochs, iter < g_epochs
+            batch_loss, g_batch_loss, g_sum, loss_ema = [], [], 0., None
+            for images, labels in ldr_train:
+                images, labels = images.to(args.device), labels.to(args.device)
+                step_gen = train_gen and not (gen_update.drop_last and len(labels) < args.local_bs)
+                if header or step_gen:
+                    with torch.no_grad():
+                        feats = fe(images) # shared by main net (header) and generator
+                if train_main:
+                    logits, log_probs = net(feats, start_layer='feature') if header else net(images)
+                    loss = F.cross_entropy(logits, labels)
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
+                    batch_loss.append(loss.item())
+                if step_gen:
+                    g_loss = gen_loss_fn(gen_net, feats, labels, args)
+                    g_optimizer.zero_grad()
+                    g_loss.backward()
+                    g_optimizer.step()
+                    g_sum += g_loss.item()
+                    loss_ema = g_loss.item() if loss_ema is None else 0.95 * loss_ema + 0.05 * g_loss.item()
+                    g_batch_loss.append(loss_ema)
+            if train_main:
+                epoch_loss.append(sum(batch_loss)/len(batch_loss))
+            if train_gen:
+                g_epoch_loss.append(g_sum/len(ldr_train.dataset) if report == 'sum' else sum(g_batch_loss)/len(g_batch_loss))
+        avg_ep_loss = sum(epoch_loss) / len(epoch_loss) if epoch_loss else -1
+        return (net.state_dict(), avg_ep_loss, gen_loss), (gen_net.state_dict(), sum(g_epoch_loss) / len(g_epoch_loss), g_optimizer.state_dict())
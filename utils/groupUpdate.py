@@ -0,0 +1,123 @@
+'''
+Vectorized local training of same-architecture clients (torch.func)
+
+Clients of a model group (dev_spec_idx) start from the same global weights.
+Their parameters are stacked along a new leading dim and all clients of the group are trained
+by one batched forward/backward per step (functional_call + vmap).
+SGD is element-wise, so one optimizer over the stacked tensors equals one optimizer per client,
+and summing the per-client mean losses gives every slice its own client's gradient.
+'''
+import copy
+from collections import OrderedDict
+import torch
+import torch.nn.functional as F
+from torch.func import functional_call, stack_module_state, vmap
+
+from utils.localUpdate import get_loader
+
+
+def group_clients(args, idxs_users, dict_users):
+    '''
+    groups sampled users by (model_idx, shard size), since a vmapped group steps all clients together
+    returns [(model_idx, [idx, ...]), ...]
+    '''
+    groups = OrderedDict()
+    for idx in idxs_users:
+        model_idx = min(idx//(args.num_users//args.num_models), args.num_models-1)
+        groups.setdefault((model_idx, len(dict_users[idx])), []).append(idx)
+    return [(model_idx, users) for (model_idx, _), users in groups.items()]
+
+
+class LocalUpdate_group(object):
+    def __init__(self, args, dataset=None, idxs_group=None):
+        '''
+        idxs_group: list of client index sets of equal size
+        '''
+        self.args = args
+        self.num_clients = len(idxs_group)
+        self.ldr_trains = [get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True) for idxs in idxs_group]
+        size = len(idxs_group[0])
+        if size//args.local_bs == 0:
+            self.iter = 1
+            self.gen_bs = size
+        else:
+            self.iter = size//args.local_bs
+            self.gen_bs = args.local_bs
+
+    def _step(self, fmodel, params, buffers, optimizer, images, labels):
+        '''
+        images: [num_clients, bs, ...], labels: [num_clients*bs, ...]
+        returns per-client losses
+        '''
+        logits, log_probs = vmap(fmodel, randomness='different')(params, buffers, images)
+        loss = F.cross_entropy(logits.flatten(0, 1), labels, reduction='none').view(self.num_clients, -1).mean(1)
+        optimizer.zero_grad()
+        loss.sum().backward()
+        optimizer.step()
+        return loss.detach().cpu().tolist()
+
+    def train(self, net, learning_rate, gennet=None, feature_extractor=None, feature_start=True):
+        '''
+        feature_extractor given: LocalUpdate_header (real samples pass the frozen FE, header is trained)
+        feature_extractor None: LocalUpdate (real samples train the whole net)
+        returns [(weight, loss, gen_loss), ...] in the order of idxs_group
+        '''
+        N = self.num_clients
+        net.train()
+        if feature_extractor is not None:
+            feature_extractor.eval()
+
+        params, buffers = stack_module_state([net] * N)
+        base = copy.deepcopy(net).to('meta')
+
+        def fmodel_feature(p, b, x):
+            return functional_call(base, (p, b), (x,), {'start_layer': 'feature'})
+
+        def fmodel(p, b, x):
+            return functional_call(base, (p, b), (x,))
+
+        optimizer = torch.optim.SGD(params.values(), lr=learning_rate, momentum=self.args.momentum, weight_decay=self.args.weight_decay)
+        gen_loss = [None] * N
+        if gennet:
+            gen_epoch_loss = []
+            gennet.eval()
+            for iter in range(self.args.local_ep_gen): # train by samples generated by generator
+                gen_batch_loss = []
+                for i in range(self.iter):
+                    with torch.no_grad():
+                        images, labels = gennet.sample_image(self.args, sample_num=N*self.gen_bs) # one draw for the whole group
+                    images = images.view(N, self.gen_bs, *images.shape[1:])
+                    gen_batch_loss.append(self._step(fmodel_feature if feature_start else fmodel, params, buffers, optimizer, images, labels))
+                gen_epoch_loss.append([sum(l)/len(l) for l in zip(*gen_batch_loss)])
+            if gen_epoch_loss:
+                gen_loss = [sum(l)/len(l) for l in zip(*gen_epoch_loss)]
+
+        # train and update
+        optimizer = torch.optim.SGD(params.values(), lr=learning_rate, momentum=self.args.momentum, weight_decay=self.args.weight_decay)
+        epoch_loss = []
+        for iter in range(self.args.local_ep):
+            batch_loss = []
+            for batches in zip(*self.ldr_trains):
+                images = torch.stack([b[0] for b in batches]).to(self.args.device)
+                labels = torch.cat([b[1] for b in batches]).to(self.args.device)
+                if feature_extractor is not None:
+                    with torch.no_grad():
+                        images = feature_extractor(images.flatten(0, 1))
+                    images = images.view(N, -1, *images.shape[1:])
+                    batch_loss.append(self._step(fmodel_feature, params, buffers, optimizer, images, labels))
+                else:
+                    batch_loss.append(self._step(fmodel, params, buffers, optimizer, images, labels))
+            epoch_loss.append([sum(l)/len(l) for l in zip(*batch_loss)])
+        if epoch_loss:
+            avg_ep_loss = [sum(l)/len(l) for l in zip(*epoch_loss)]
+        else:
+            avg_ep_loss = [-1] * N
+
+        results = []
+        keys = net.state_dict().keys()
+        for i in range(N):
+            w = OrderedDict()
+            for k in keys:
+                w[k] = params[k][i].detach().clone() if k in params else buffers[k][i].clone()
+            results.append((w, avg_ep_loss[i], gen_loss[i]))
+        return results
@@ -6,20 +6,36 @@ from torch.autograd import Variable
 import numpy as np
 from tqdm import tqdm
 from utils.CGScore import pruning
+from utils.dpsgd import DPSGD
+from utils.prefetch import prefetch_gen
+from utils.featureCache import feature_loader
+from utils.tensorData import TensorData
 
 class DatasetSplit(Dataset):
     def __init__(self, dataset, idxs):
         self.dataset = dataset
-        self.idxs = list(idxs)
+        self.idxs = idxs if isinstance(idxs, np.ndarray) else list(idxs) # int32 arrays of ClientRegistry are kept as is
 
     def __len__(self):
         return len(self.idxs)
 
     def __getitem__(self, item):
-        image, label = self.dataset[self.idxs[item]]
+        image, label = self.dataset[int(self.idxs[item])]
         return image, label
 
 
+def get_loader(dataset, idxs, **kwargs):
+    '''
+    reuses the loader of a ClientRegistry shard across rounds, otherwise builds a new one
+    (a TensorLoader of a pre-tensorized dataset, utils/tensorData.py)
+    '''
+    if isinstance(dataset, TensorData):
+        return dataset.loader(idxs, **kwargs)
+    if hasattr(idxs, 'loader'):
+        return idxs.loader(dataset, **kwargs)
+    return DataLoader(DatasetSplit(dataset, idxs), **kwargs)
+
+
 class FeatDataset(Dataset):
     def __init__(self, images, labels, transform=False):
         super(FeatDataset, self).__init__()
@@ -45,7 +61,7 @@ class LocalUpdate_header_cg(object):
         self.args = args
         self.loss_func = nn.CrossEntropyLoss()
         self.selected_clients = []
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True)
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True)
         self.iter = len(idxs)//args.local_bs
         self.gen_num = int(len(idxs)/(1-args.pruning_ratio))
 
@@ -127,7 +143,7 @@ class LocalUpdate_cg(object):
         self.args = args
         self.loss_func = nn.CrossEntropyLoss()
         self.selected_clients = []
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True)
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True)
         self.iter = len(idxs)//args.local_bs
         self.gen_num = int(len(idxs)/(1-args.pruning_ratio))
 
@@ -206,7 +222,7 @@ class LocalUpdate(object):
     def __init__(self, args, dataset=None, idxs=None):
         self.args = args
         self.loss_func = nn.CrossEntropyLoss()
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True)
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True)
         self.iter = len(idxs)//args.local_bs
         
     def train(self, net, learning_rate, gennet=None, cg_pruning=False, feature_start=True):
@@ -218,26 +234,27 @@ class LocalUpdate(object):
         if gennet:
             gen_epoch_loss = []
             gennet.eval()
-            # print('gen sample iteration',self.iter)
-            for iter in range(self.args.local_ep_gen): # train by samples generated by generator
-                gen_batch_loss = []
+            with prefetch_gen(self.args, gennet, self.args.local_bs, self.args.local_ep_gen*self.iter) as gennet: # next batches sampled while this one trains
+                # print('gen sample iteration',self.iter)
+                for iter in range(self.args.local_ep_gen): # train by samples generated by generator
+                    gen_batch_loss = []
         
-                for i in range(self.iter):
-                    with torch.no_grad():
-                        images, labels = gennet.sample_image(self.args, sample_num=self.args.local_bs) # images.shape (bs, feature^2)
+                    for i in range(self.iter):
+                        with torch.no_grad():
+                            images, labels = gennet.sample_image(self.args, sample_num=self.args.local_bs) # images.shape (bs, feature^2)
                         
-                    net.zero_grad()
-                    if feature_start:
-                        logits, log_probs = net(images, start_layer='feature')
-                    else:
-                        logits, log_probs = net(images)
-                    loss = F.cross_entropy(logits, labels) # net.fc1.weight.grad / net.fc5.weight.grad
-                    optimizer.zero_grad()
-                    loss.backward()
-                    optimizer.step()
-
-                    gen_batch_loss.append(loss.item())
-                gen_epoch_loss.append(sum(gen_batch_loss)/len(gen_batch_loss))     
+                        net.zero_grad()
+                        if feature_start:
+                            logits, log_probs = net(images, start_layer='feature')
+                        else:
+                            logits, log_probs = net(images)
+                        loss = F.cross_entropy(logits, labels) # net.fc1.weight.grad / net.fc5.weight.grad
+                        optimizer.zero_grad()
+                        loss.backward()
+                        optimizer.step()
+
+                        gen_batch_loss.append(loss.item())
+                    gen_epoch_loss.append(sum(gen_batch_loss)/len(gen_batch_loss))     
             # gennet creates feature samples (gennet(, labels))
             if gen_epoch_loss:
                 gen_loss = sum(gen_epoch_loss) / len(gen_epoch_loss)
@@ -269,7 +286,7 @@ class LocalUpdate_onlyGen(object):
         self.args = args
         self.loss_func = nn.CrossEntropyLoss()
         self.selected_clients = []
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True)
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True)
         self.iter = len(idxs)//args.local_bs
         
     def train(self, net, learning_rate, gennet=None, feature_start=True):
@@ -281,25 +298,26 @@ class LocalUpdate_onlyGen(object):
 
         gen_epoch_loss = []
         gennet.eval()
-        # print('gen sample iteration',self.iter)
-        for iter in range(self.args.local_ep_gen): # train by samples generated by generator
-            gen_batch_loss = []
+        with prefetch_gen(self.args, gennet, self.args.local_bs, self.args.local_ep_gen*self.iter) as gennet: # next batches sampled while this one trains
+            # print('gen sample iteration',self.iter)
+            for iter in range(self.args.local_ep_gen): # train by samples generated by generator
+                gen_batch_loss = []
     
-            for i in range(self.iter):
-                with torch.no_grad():
-                    images, labels = gennet.sample_image(self.args, sample_num=self.args.local_bs) # images.shape (bs, feature^2)
-                net.zero_grad()
-                if feature_start: # commNet
-                    logits, log_probs = net(images, start_layer='feature')
-                else:
-                    logits, log_probs = net(images)
-                loss = F.cross_entropy(logits, labels) # net.fc1.weight.grad / net.fc5.weight.grad
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                for i in range(self.iter):
+                    with torch.no_grad():
+                        images, labels = gennet.sample_image(self.args, sample_num=self.args.local_bs) # images.shape (bs, feature^2)
+                    net.zero_grad()
+                    if feature_start: # commNet
+                        logits, log_probs = net(images, start_layer='feature')
+                    else:
+                        logits, log_probs = net(images)
+                    loss = F.cross_entropy(logits, labels) # net.fc1.weight.grad / net.fc5.weight.grad
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
 
-                gen_batch_loss.append(loss.item())
-            gen_epoch_loss.append(sum(gen_batch_loss)/len(gen_batch_loss))     
+                    gen_batch_loss.append(loss.item())
+                gen_epoch_loss.append(sum(gen_batch_loss)/len(gen_batch_loss))     
         # gennet creates feature samples (gennet(, labels))
         if gen_epoch_loss:
             gen_loss = sum(gen_epoch_loss) / len(gen_epoch_loss)
@@ -312,7 +330,7 @@ class LocalUpdate_header(object):
         self.args = args
         self.loss_func = nn.CrossEntropyLoss()
         self.selected_clients = []
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True)
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True)
         if len(idxs)//args.local_bs == 0:
             self.iter = 1
             self.less_samples = True
@@ -331,25 +349,26 @@ class LocalUpdate_header(object):
         if gennet:
             gen_epoch_loss = []
             gennet.eval()
-            # print('gen sample iteration',self.iter)
-            for iter in range(self.args.local_ep_gen): # train by samples generated by generator
-                gen_batch_loss = []
+            with prefetch_gen(self.args, gennet, self.mini_bs if self.less_samples else self.args.local_bs, self.args.local_ep_gen*self.iter) as gennet: # next batches sampled while this one trains
+                # print('gen sample iteration',self.iter)
+                for iter in range(self.args.local_ep_gen): # train by samples generated by generator
+                    gen_batch_loss = []
         
-                for i in range(self.iter):
-                    with torch.no_grad():
-                        if self.less_samples:
-                            images, labels = gennet.sample_image(self.args, sample_num=self.mini_bs) # images.shape (bs, feature^2)                        
-                        else:
-                            images, labels = gennet.sample_image(self.args, sample_num=self.args.local_bs) # images.shape (bs, feature^2)
-                    net.zero_grad()
-                    logits, log_probs = net(images, start_layer='feature')
-                    loss = F.cross_entropy(logits, labels) # net.fc1.weight.grad / net.fc5.weight.grad
-                    optimizer.zero_grad()
-                    loss.backward()
-                    optimizer.step()
+                    for i in range(self.iter):
+                        with torch.no_grad():
+                            if self.less_samples:
+                                images, labels = gennet.sample_image(self.args, sample_num=self.mini_bs) # images.shape (bs, feature^2)                        
+                            else:
+                                images, labels = gennet.sample_image(self.args, sample_num=self.args.local_bs) # images.shape (bs, feature^2)
+                        net.zero_grad()
+                        logits, log_probs = net(images, start_layer='feature')
+                        loss = F.cross_entropy(logits, labels) # net.fc1.weight.grad / net.fc5.weight.grad
+                        optimizer.zero_grad()
+                        loss.backward()
+                        optimizer.step()
 
-                    gen_batch_loss.append(loss.item())
-                gen_epoch_loss.append(sum(gen_batch_loss)/len(gen_batch_loss))     
+                        gen_batch_loss.append(loss.item())
+                    gen_epoch_loss.append(sum(gen_batch_loss)/len(gen_batch_loss))     
             # gennet creates feature samples (gennet(, labels))
             if gen_epoch_loss:
                 gen_loss = sum(gen_epoch_loss) / len(gen_epoch_loss)
@@ -358,10 +377,11 @@ class LocalUpdate_header(object):
         optimizer = torch.optim.SGD(net.parameters(), lr=learning_rate, momentum=self.args.momentum, weight_decay=self.args.weight_decay)
         epoch_loss = []
 
+        ldr_train, feature_extractor = feature_loader(self.args, feature_extractor, self.ldr_train) # cached features of a frozen FE
         for iter in range(self.args.local_ep): # train net performing main-task
             batch_loss = []
 
-            for batch_idx, (images, labels) in enumerate(self.ldr_train):
+            for batch_idx, (images, labels) in enumerate(ldr_train):
                 images, labels = images.to(self.args.device), labels.to(self.args.device)
                 images = feature_extractor(images)
                 net.zero_grad()
@@ -402,30 +422,45 @@ def loss_function(recon_x, x, mu, logvar):
 
 LongTensor = torch.cuda.LongTensor
 class LocalUpdate_VAE(object): # VAE
+    drop_last = True
+
     def __init__(self, args, net_com, dataset=None, idxs=None):
         self.args = args
         self.selected_clients = []
         self.feature_extractor = net_com
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True, drop_last=True)
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True, drop_last=self.drop_last)
+
+    @staticmethod
+    def optimizer(net, opt=None):
+        '''
+        generator optimizer, opt: its state from the client's previous update (also used by utils/fusedUpdate.py)
+        '''
+        optimizer = torch.optim.Adam(net.parameters(), lr=1e-3)
+        if opt:
+            optimizer.load_state_dict(opt)
+        return optimizer
+
+    @staticmethod
+    def local_epochs(args):
+        return args.gen_local_ep
 
     def train(self, net, opt=None):
         net.train()
         self.feature_extractor.eval()
         # train and update
-        optimizer = torch.optim.Adam(net.parameters(), lr=1e-3)
-        if opt:
-            optimizer.load_state_dict(opt)
+        optimizer = self.optimizer(net, opt)
         epoch_loss = []       
 
-        for iter in range(self.args.gen_local_ep):
+        ldr_train, feature_extractor = feature_loader(self.args, self.feature_extractor, self.ldr_train)
+        for iter in range(self.local_epochs(self.args)):
             batch_loss = []
             train_loss = 0
-            for batch_idx, (images, labels) in enumerate(self.ldr_train):
+            for batch_idx, (images, labels) in enumerate(ldr_train):
                 images, labels = images.to(self.args.device), labels.to(self.args.device) # images.shape: torch.Size([batch_size, 1, 28, 28])
                 labels = Variable(labels.type(LongTensor))
                 # labels = one_hot(labels, 10).to(self.args.device)
                 with torch.no_grad():
-                    images = self.feature_extractor(images) # x.view(-1, self.feature_size*self.feature_size) in CVAE.forward 
+                    images = feature_extractor(images) # x.view(-1, self.feature_size*self.feature_size) in CVAE.forward 
                 # images = images.view(-1, 1, self.args.feature_size, self.args.feature_size) # self.args.local_bs
                 # save_image(images.view(self.args.local_bs, 1, 14, 14),
                 #             'imgFedCVAE/' + 'sample_' + '.png')
@@ -448,28 +483,50 @@ def loss_function_ccvae(x, pred, mu, logvar):
     kld = -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp())
     return recon_loss, kld
 
+def ccvae_sample_loss(call, x, label):
+    '''
+    loss of one sample (DPSGD.step)
+    '''
+    pred, mu, logvar = call(x, label)
+    recon_loss, kld = loss_function_ccvae(x, pred, mu, logvar)
+    return recon_loss + kld
+
 class LocalUpdate_CCVAE(object): # CVAE
+    supports_dp = True
+    drop_last = False
+
     def __init__(self, args, net_com, dataset=None, idxs=None):
         self.args = args
         self.selected_clients = []
         self.feature_extractor = net_com
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True)  # , drop_last=True
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True, drop_last=self.drop_last)
+        self.dp = DPSGD.from_args(args)
+
+    @staticmethod
+    def optimizer(net, opt=None):
+        optimizer = torch.optim.Adam(net.parameters(), lr=1e-3, weight_decay=0.001)
+        if opt:
+            optimizer.load_state_dict(opt)
+        return optimizer
+
+    @staticmethod
+    def local_epochs(args):
+        return args.gen_local_ep
 
     def train(self, net, opt=None):
         net.train()
         self.feature_extractor.eval()
         # train and update
-        optimizer = torch.optim.Adam(net.parameters(), lr=1e-3, weight_decay=0.001)
-        if opt:
-            optimizer.load_state_dict(opt)            
+        optimizer = self.optimizer(net, opt)
 
         epoch_loss = []       
-        for iter in range(self.args.gen_local_ep):
+        ldr_train, feature_extractor = feature_loader(self.args, self.feature_extractor, self.ldr_train)
+        for iter in range(self.local_epochs(self.args)):
             batch_loss = []
             train_loss = 0
-            for batch_idx, (images, labels) in enumerate(self.ldr_train):
+            for batch_idx, (images, labels) in enumerate(ldr_train):
                 images = images.to(self.args.device) # images.shape: torch.Size([batch_size, 1, 28, 28])
-                images = self.feature_extractor(images) # x.view(-1, self.feature_size*self.feature_size) in CVAE.forward 
+                images = feature_extractor(images) # x.view(-1, self.feature_size*self.feature_size) in CVAE.forward 
                 label = np.zeros((images.shape[0], 10))
                 label[np.arange(images.shape[0]), labels] = 1
                 label = torch.tensor(label)
@@ -478,11 +535,14 @@ class LocalUpdate_CCVAE(object): # CVAE
                                 
                 # recon_batch, mu, logvar = net(images, labels)
                 optimizer.zero_grad()
-                pred, mu, logvar = net(images, label.to(self.args.device))
-                
-                recon_loss, kld = loss_function_ccvae(images, pred, mu, logvar)
-                loss = recon_loss + kld
-                loss.backward()
+                if self.dp is not None: # per-sample clipped, noised gradients
+                    loss = self.dp.step(net, ccvae_sample_loss, images.detach(), label.to(self.args.device)) * images.shape[0]
+                else:
+                    pred, mu, logvar = net(images, label.to(self.args.device))
+
+                    recon_loss, kld = loss_function_ccvae(images, pred, mu, logvar)
+                    loss = recon_loss + kld
+                    loss.backward()
                 optimizer.step()
                 train_loss += loss.detach().cpu().numpy()
                 batch_loss.append(loss.item())
@@ -492,45 +552,62 @@ class LocalUpdate_CCVAE(object): # CVAE
 
 
 class LocalUpdate_DDPM(object): # DDPM
+    supports_dp = True
+    drop_last = False
+    lr = 1e-4
+
     def __init__(self, args, net_com, dataset=None, idxs=None):
         self.args = args
         self.selected_clients = []
         self.feature_extractor = net_com
-        self.ldr_train = tqdm(DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True)) # , drop_last=True
-        self.lr = 1e-4
+        self.ldr_train = tqdm(get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True, drop_last=self.drop_last))
+        self.dp = DPSGD.from_args(args)
+
+    @classmethod
+    def optimizer(cls, net, opt=None):
+        optim = torch.optim.Adam(net.parameters(), lr=cls.lr)
+        if opt:
+            optim.load_state_dict(opt)
+        return optim
+
+    @staticmethod
+    def local_epochs(args):
+        return args.local_ep
 
     def train(self, net, lr_decay_rate, opt=None):
         net.train()
         self.feature_extractor.eval()
         # train and update
-        optim = torch.optim.Adam(net.parameters(), lr=1e-4)
-        if opt:
-            optim.load_state_dict(opt)
+        optim = self.optimizer(net, opt)
 
         epoch_loss = []
 
-        for iter in range(self.args.local_ep):
+        ldr_train, feature_extractor = feature_loader(self.args, self.feature_extractor, self.ldr_train)
+        for iter in range(self.local_epochs(self.args)):
             optim.param_groups[0]['lr'] = self.lr*lr_decay_rate
             # (1-(self.args.local_ep*(round-1) + iter)/(self.args.local_ep*(self.args.epochs+self.args.wu_epochs)))
             loss_ema = None
             batch_loss = []
             train_loss = 0
-            for images, labels in self.ldr_train:
+            for images, labels in ldr_train:
                 '''
                 images, feature_extractor loss
                 '''
                 images = images.to(self.args.device) # images.shape: torch.Size([batch_size, 1, 28, 28])
                 labels = labels.to(self.args.device)
                 with torch.no_grad():
-                    images = self.feature_extractor(images).view(-1, self.args.output_channel, self.args.img_size, self.args.img_size)
+                    images = feature_extractor(images).view(-1, self.args.output_channel, self.args.img_size, self.args.img_size)
                 # x.view(-1, self.feature_size*self.feature_size) in CVAE.forward 
                 # images = images.view(-1, self.args.output_channel, self.args.img_size, self.args.img_size)
                 # images = images.view(-1, 1, self.args.feature_size, self.args.feature_size) # self.args.local_bs
                 # save_image(images.view(self.args.local_bs, 1, 14, 14),
                 #             'imgFedCVAE/' + 'sample_' + '.png')
                 optim.zero_grad()
-                loss = net(images, labels)
-                loss.backward()
+                if self.dp is not None: # per-sample clipped, noised gradients
+                    loss = self.dp.step(net, lambda call, x, c: call(x, c), images, labels)
+                else:
+                    loss = net(images, labels)
+                    loss.backward()
 
                 if loss_ema is None:
                     loss_ema = loss.item()
@@ -551,12 +628,16 @@ LongTensor = torch.cuda.LongTensor # should be revised for different cuda id
 # img_shape = (1, 14, 14) # feature size
 
 class LocalUpdate_GAN(object): # GAN
+    supports_dp = True # the discriminator (the only net that sees real data) is trained by DP-SGD
+    np_rng = np.random # noise / labels (a thread's RandomState under utils/threadRNG.py)
+
     def __init__(self, args, net_com, dataset=None, idxs=None):
         self.args = args
         self.loss_func = nn.CrossEntropyLoss()
         self.selected_clients = []
         self.feature_extractor = net_com
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True, drop_last=True)
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True, drop_last=True)
+        self.dp = DPSGD.from_args(args)
         
     def train(self, gnet, dnet, optg=None, optd=None):
         gnet.train()
@@ -575,15 +656,16 @@ class LocalUpdate_GAN(object): # GAN
 
         adversarial_loss = torch.nn.MSELoss()
 
+        ldr_train, feature_extractor = feature_loader(self.args, self.feature_extractor, self.ldr_train)
         for iter in range(self.args.gen_local_ep):
             g_batch_loss = []
             # g_train_loss = 0
             d_batch_loss = []
             # d_train_loss = 0
-            for batch_idx, (images, labels) in enumerate(self.ldr_train):
+            for batch_idx, (images, labels) in enumerate(ldr_train):
                 batch_size = images.shape[0]
                 images = images.to(self.args.device)
-                images = self.feature_extractor(images)
+                images = feature_extractor(images)
                 
                 # Adversarial ground truths
                 valid = Variable(FloatTensor(batch_size, 1).fill_(1.0), requires_grad=False).to(self.args.device)
@@ -599,8 +681,8 @@ class LocalUpdate_GAN(object): # GAN
                 optimizerG.zero_grad()
                 
                 # Sample noise and labels as generator input
-                z = Variable(FloatTensor(np.random.normal(0, 1, (batch_size, self.args.latent_dim)))).to(self.args.device)
-                gen_labels = Variable(LongTensor(np.random.randint(0, self.args.num_classes, batch_size))).to(self.args.device)
+                z = Variable(FloatTensor(self.np_rng.normal(0, 1, (batch_size, self.args.latent_dim)))).to(self.args.device)
+                gen_labels = Variable(LongTensor(self.np_rng.randint(0, self.args.num_classes, batch_size))).to(self.args.device)
                 
                 # Generate a batch of images
                 gen_imgs = gnet(z, gen_labels) # 196 (14*14)
@@ -618,16 +700,21 @@ class LocalUpdate_GAN(object): # GAN
                 ----------- '''
                 optimizerD.zero_grad()
                 
-                # Loss for real images
-                validity_real = dnet(real_imgs, labels)
-                d_real_loss = adversarial_loss(validity_real, valid)
-                # Loss for fake images
-                validity_fake = dnet(gen_imgs.detach(), labels) # .detach()
-                d_fake_loss = adversarial_loss(validity_fake, fake)
-                
-                d_loss = (d_real_loss + d_fake_loss) / 2
-                
-                d_loss.backward()
+                if self.dp is not None: # per-sample clipped, noised gradients of (real, fake) pairs
+                    def d_sample_loss(call, real, fake_img, label):
+                        return (adversarial_loss(call(real, label), valid[:1]) + adversarial_loss(call(fake_img, label), fake[:1])) / 2
+                    d_loss = self.dp.step(dnet, d_sample_loss, real_imgs.detach(), gen_imgs.detach(), labels)
+                else:
+                    # Loss for real images
+                    validity_real = dnet(real_imgs, labels)
+                    d_real_loss = adversarial_loss(validity_real, valid)
+                    # Loss for fake images
+                    validity_fake = dnet(gen_imgs.detach(), labels) # .detach()
+                    d_fake_loss = adversarial_loss(validity_fake, fake)
+
+                    d_loss = (d_real_loss + d_fake_loss) / 2
+
+                    d_loss.backward()
                 optimizerD.step()
                 
                 # g_train_loss += g_loss.detach().cpu().numpy()
@@ -652,7 +739,7 @@ class LocalUpdate_DCGAN(object): # DCGAN
         self.args = args
         # self.loss_func = nn.CrossEntropyLoss()
         self.feature_extractor = net_com
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True) # , drop_last=True
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True) # , drop_last=True
         
     def train(self, gnet, dnet, iter, optg=None, optd=None):
         gnet.train()
@@ -702,6 +789,7 @@ class LocalUpdate_DCGAN(object): # DCGAN
         y_real_, y_fake_ = Variable(y_real_.cuda()), Variable(y_fake_.cuda())
         y_real_, y_fake_ = y_real_.to(self.args.device), y_fake_.to(self.args.device)
 
+        ldr_train, feature_extractor = feature_loader(self.args, self.feature_extractor, self.ldr_train)
         for iter in range(self.args.gen_local_ep):
             D_losses = []
             D_real_losses = []
@@ -713,7 +801,7 @@ class LocalUpdate_DCGAN(object): # DCGAN
             y_real_, y_fake_ = Variable(y_real_.cuda()), Variable(y_fake_.cuda())
             y_real_, y_fake_ = y_real_.to(self.args.device), y_fake_.to(self.args.device)
                                     
-            for batch_idx, (x_, y_) in enumerate(self.ldr_train):
+            for batch_idx, (x_, y_) in enumerate(ldr_train):
                 ''' ---------------------------------
                 Train Discriminator
                 maximize log(D(x)) + log(1 - D(G(z)))
@@ -733,7 +821,7 @@ class LocalUpdate_DCGAN(object): # DCGAN
                 x_, y_fill_ = x_.to(self.args.device), y_fill_.to(self.args.device)
                 
                 with torch.no_grad():
-                    x_ = self.feature_extractor(x_)
+                    x_ = feature_extractor(x_)
                 # save_image(x_.view(128, 1, 32, 32), 'imgFedDCGANF/' + 'sample_xx.png', nrow=10)
                 
                 D_result = dnet(x_, y_fill_).squeeze()
@@ -5,6 +5,9 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 import numpy as np
 from tqdm import tqdm
+from utils.localUpdate import get_loader
+from utils.dpsgd import DPSGD
+from utils.prefetch import prefetch_gen
 
 
 class DatasetSplit(Dataset):
@@ -25,7 +28,7 @@ class LocalUpdate(object):
         self.args = args
         self.loss_func = nn.CrossEntropyLoss()
         self.selected_clients = []
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True)
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True)
         if len(idxs)//args.local_bs == 0:
             self.iter = 1
             self.less_samples = True
@@ -43,25 +46,26 @@ class LocalUpdate(object):
         if gennet:
             gen_epoch_loss = []
             gennet.eval()
-            # print('gen sample iteration',self.iter)
-            for iter in range(self.args.local_ep_gen): # train by samples generated by generator
-                gen_batch_loss = []
+            with prefetch_gen(self.args, gennet, self.mini_bs if self.less_samples else self.args.local_bs, self.args.local_ep_gen*self.iter) as gennet: # next batches sampled while this one trains
+                # print('gen sample iteration',self.iter)
+                for iter in range(self.args.local_ep_gen): # train by samples generated by generator
+                    gen_batch_loss = []
         
-                for i in range(self.iter):
-                    with torch.no_grad():
-                        if self.less_samples:
-                            images, labels = gennet.sample_image(self.args, sample_num=self.mini_bs) # images.shape (bs, feature^2)
-                        else:
-                            images, labels = gennet.sample_image(self.args, sample_num=self.args.local_bs) # images.shape (bs, feature^2)
-                    net.zero_grad()
-                    logits, log_probs = net(images)
-                    loss = F.cross_entropy(logits, labels) # net.fc1.weight.grad / net.fc5.weight.grad
-                    optimizer.zero_grad()
-                    loss.backward()
-                    optimizer.step()
-
-                    gen_batch_loss.append(loss.item())
-                gen_epoch_loss.append(sum(gen_batch_loss)/len(gen_batch_loss))     
+                    for i in range(self.iter):
+                        with torch.no_grad():
+                            if self.less_samples:
+                                images, labels = gennet.sample_image(self.args, sample_num=self.mini_bs) # images.shape (bs, feature^2)
+                            else:
+                                images, labels = gennet.sample_image(self.args, sample_num=self.args.local_bs) # images.shape (bs, feature^2)
+                        net.zero_grad()
+                        logits, log_probs = net(images)
+                        loss = F.cross_entropy(logits, labels) # net.fc1.weight.grad / net.fc5.weight.grad
+                        optimizer.zero_grad()
+                        loss.backward()
+                        optimizer.step()
+
+                        gen_batch_loss.append(loss.item())
+                    gen_epoch_loss.append(sum(gen_batch_loss)/len(gen_batch_loss))     
             # gennet creates feature samples (gennet(, labels))
             if gen_epoch_loss:
                 gen_loss = sum(gen_epoch_loss) / len(gen_epoch_loss)
@@ -93,7 +97,7 @@ class LocalUpdate_fedprox(object):
         self.args = args
         self.loss_func = nn.CrossEntropyLoss()
         self.selected_clients = []
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True)
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True)
         
     def train(self, net, learning_rate, gennet=None):
         net.train()
@@ -126,7 +130,7 @@ class LocalUpdate_onlyGen(object):
         self.args = args
         self.loss_func = nn.CrossEntropyLoss()
         self.selected_clients = []
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True)
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True)
         self.iter = len(idxs)//args.local_bs
         
     def train(self, net, learning_rate, gennet=None):
@@ -138,22 +142,23 @@ class LocalUpdate_onlyGen(object):
         if gennet:
             gen_epoch_loss = []
             gennet.eval()
-            # print('gen sample iteration',self.iter)
-            for iter in range(self.args.local_ep): # Enough local epochs for synthetic data
-                gen_batch_loss = []
+            with prefetch_gen(self.args, gennet, self.args.local_bs, self.args.local_ep*self.iter) as gennet: # next batches sampled while this one trains
+                # print('gen sample iteration',self.iter)
+                for iter in range(self.args.local_ep): # Enough local epochs for synthetic data
+                    gen_batch_loss = []
         
-                for i in range(self.iter):
-                    with torch.no_grad():
-                        images, labels = gennet.sample_image(self.args, sample_num=self.args.local_bs) # images.shape (bs, feature^2)
-                    net.zero_grad()
-                    logits, log_probs = net(images)
-                    loss = F.cross_entropy(logits, labels) # net.fc1.weight.grad / net.fc5.weight.grad
-                    optimizer.zero_grad()
-                    loss.backward()
-                    optimizer.step()
-
-                    gen_batch_loss.append(loss.item())
-                gen_epoch_loss.append(sum(gen_batch_loss)/len(gen_batch_loss))     
+                    for i in range(self.iter):
+                        with torch.no_grad():
+                            images, labels = gennet.sample_image(self.args, sample_num=self.args.local_bs) # images.shape (bs, feature^2)
+                        net.zero_grad()
+                        logits, log_probs = net(images)
+                        loss = F.cross_entropy(logits, labels) # net.fc1.weight.grad / net.fc5.weight.grad
+                        optimizer.zero_grad()
+                        loss.backward()
+                        optimizer.step()
+
+                        gen_batch_loss.append(loss.item())
+                    gen_epoch_loss.append(sum(gen_batch_loss)/len(gen_batch_loss))     
             # gennet creates feature samples (gennet(, labels))
             if gen_epoch_loss:
                 gen_loss = sum(gen_epoch_loss) / len(gen_epoch_loss)
@@ -171,12 +176,14 @@ FloatTensor = torch.FloatTensor
 LongTensor = torch.LongTensor
 
 class LocalUpdate_GAN_raw(object): # GAN
+    np_rng = np.random # noise / labels (a thread's RandomState under utils/threadRNG.py)
+
     def __init__(self, args, dataset=None, idxs=None):
         self.args = args
         self.adv_loss = torch.nn.MSELoss().to(args.device)
         # self.adv_loss = torch.nn.BCELoss().to(args.device)        
         self.selected_clients = []
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True) # , drop_last=True
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True) # , drop_last=True
         
     def train(self, gnet, dnet, optg=None, optd=None):
         gnet.train()
@@ -218,8 +225,8 @@ class LocalUpdate_GAN_raw(object): # GAN
                 optimizerG.zero_grad()
                 
                 # Sample noise and labels as generator input
-                z = Variable(FloatTensor(np.random.normal(0, 1, (batch_size, self.args.latent_dim)))).to(self.args.device)
-                gen_labels = Variable(LongTensor(np.random.randint(0, self.args.num_classes, batch_size))).to(self.args.device)
+                z = Variable(FloatTensor(self.np_rng.normal(0, 1, (batch_size, self.args.latent_dim)))).to(self.args.device)
+                gen_labels = Variable(LongTensor(self.np_rng.randint(0, self.args.num_classes, batch_size))).to(self.args.device)
                 
                 # Generate a batch of images
                 gen_imgs = gnet(z, gen_labels)
@@ -286,7 +293,7 @@ def loss_function(recon_x, x, mu, logvar):
 class LocalUpdate_VAE_raw(object): # VAE raw
     def __init__(self, args, dataset=None, idxs=None):
         self.args = args
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True)
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True)
 
     def train(self, net, opt=None):
         net.train()
@@ -324,7 +331,7 @@ class LocalUpdate_VAE_raw(object): # VAE raw
 class LocalUpdate_DDPM_raw(object): # DDPM
     def __init__(self, args, dataset=None, idxs=None):
         self.args = args
-        self.ldr_train = tqdm(DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True))
+        self.ldr_train = tqdm(get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True))
         self.lr = 1e-4
 
     def train(self, net, lr_decay_rate, opt=None):
@@ -368,7 +375,7 @@ class LocalUpdate_DCGAN(object): # DCGAN original
     def __init__(self, args, dataset=None, idxs=None):
         self.args = args
         # self.loss_func = nn.CrossEntropyLoss()
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True) # , drop_last=True
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True) # , drop_last=True
         
     def train(self, gnet, dnet, iter, optg=None, optd=None):
         gnet.train()
@@ -504,11 +511,22 @@ def loss_function_cvae(x, pred, mu, logvar):
     kld = -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp())
     return recon_loss, kld
 
+def cvae_sample_loss(call, x, label):
+    '''
+    loss of one sample (DPSGD.step)
+    '''
+    pred, mu, logvar = call(x, label)
+    recon_loss, kld = loss_function_cvae(x, pred, mu, logvar)
+    return recon_loss + kld
+
 
 class LocalUpdate_CVAE(object): # CVAE raw
+    supports_dp = True
+
     def __init__(self, args, dataset=None, idxs=None):
         self.args = args
-        self.ldr_train = DataLoader(DatasetSplit(dataset, idxs), batch_size=args.local_bs, shuffle=True) # , drop_last=True
+        self.ldr_train = get_loader(dataset, idxs, batch_size=args.local_bs, shuffle=True) # , drop_last=True
+        self.dp = DPSGD.from_args(args)
 
     def train(self, net, opt=None):
         net.train()
@@ -529,11 +547,14 @@ class LocalUpdate_CVAE(object): # CVAE raw
                 # labels = one_hot(labels, 10).to(self.args.device)
                 # recon_batch, mu, logvar = net(images, labels)
                 optimizer.zero_grad()
-                pred, mu, logvar = net(images, label.to(self.args.device))
-                
-                recon_loss, kld = loss_function_cvae(images, pred, mu, logvar)
-                loss = recon_loss + kld
-                loss.backward()
+                if self.dp is not None: # per-sample clipped, noised gradients
+                    loss = self.dp.step(net, cvae_sample_loss, images, label.to(self.args.device)) * images.shape[0]
+                else:
+                    pred, mu, logvar = net(images, label.to(self.args.device))
+
+                    recon_loss, kld = loss_function_cvae(images, pred, mu, logvar)
+                    loss = recon_loss + kld
+                    loss.backward()
                 optimizer.step()
                 
                 train_loss += loss.detach().cpu().numpy()
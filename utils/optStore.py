@@ -0,0 +1,145 @@
+'''
+Spillable per-client optimizer-state store
+
+Drop-in replacement of `opts = [copy.deepcopy(opt) for _ in range(args.num_users)]`:
+opts[idx] / opts[idx] = state work as with the list, so LocalUpdate_*.train(opt=opts[idx]) is unchanged.
+- memory tier: LRU of at most `capacity` states (0: unbounded, i.e., the plain list behaviour)
+- disk tier: evicted moments are written to one memory-mapped file (a row per user),
+  the small rest of the state (step, param_groups) stays in memory
+- compress='fp16'/'bf16': moments are stored in half precision
+  (optimizer.load_state_dict casts them back to the parameter dtype)
+Users that never trained get a copy of the initial state.
+'''
+import copy
+import os
+import tempfile
+from collections import OrderedDict
+import numpy as np
+import torch
+
+MOMENTS = ('exp_avg', 'exp_avg_sq', 'max_exp_avg_sq', 'momentum_buffer')
+DTYPES = {None: (torch.float32, np.float32), 'fp16': (torch.float16, np.float16), 'bf16': (torch.bfloat16, np.int16)}
+
+
+class OptStateStore(object):
+    def __init__(self, init_opt, num_users, capacity=0, compress=None, spill_dir=None):
+        self.init_opt = init_opt
+        self.num_users = num_users
+        self.capacity = capacity
+        self.compress = compress
+        self.spill_dir = spill_dir
+        self.dtype, self.np_dtype = DTYPES[compress]
+        self.mem = OrderedDict()
+        self.meta = {} # spilled users: state without moments
+        self.overflow = {} # spilled users whose layout differs from the memmap layout
+        self.layout = None
+        self.mm = None
+
+    def __len__(self):
+        return self.num_users
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        if idx in self.mem:
+            self.mem.move_to_end(idx)
+            return self.mem[idx]
+        if idx in self.meta:
+            state = self._load(idx)
+        elif idx in self.overflow:
+            state = self.overflow.pop(idx)
+        else:
+            return copy.deepcopy(self.init_opt) # loaded in place by the caller, the template stays intact
+        self._put(idx, state)
+        return state
+
+    def __setitem__(self, idx, state):
+        idx = int(idx)
+        self.meta.pop(idx, None)
+        self.overflow.pop(idx, None)
+        self._put(idx, self._compress(state))
+
+    def _put(self, idx, state):
+        self.mem[idx] = state
+        self.mem.move_to_end(idx)
+        while self.capacity > 0 and len(self.mem) > self.capacity:
+            old, old_state = self.mem.popitem(last=False)
+            self._spill(old, old_state)
+
+    def _compress(self, state):
+        if self.compress is None:
+            return state
+        out = {'state': {}, 'param_groups': state['param_groups']}
+        for pid, s in state['state'].items():
+            out['state'][pid] = {k: v.detach().to('cpu', self.dtype) if k in MOMENTS and torch.is_tensor(v) else v
+                                 for k, v in s.items()}
+        return out
+
+    def _split(self, state):
+        layout, tensors = [], []
+        meta = {'state': {}, 'param_groups': state['param_groups']}
+        for pid in sorted(state['state'].keys()):
+            meta['state'][pid] = {}
+            for k, v in state['state'][pid].items():
+                if k in MOMENTS and torch.is_tensor(v):
+                    layout.append((pid, k, tuple(v.shape)))
+                    tensors.append(v)
+                else:
+                    meta['state'][pid][k] = v
+        return layout, tensors, meta
+
+    def _row(self, idx):
+        row = torch.from_numpy(self.mm[idx])
+        return row.view(torch.bfloat16) if self.compress == 'bf16' else row
+
+    def _spill(self, idx, state):
+        layout, tensors, meta = self._split(state)
+        if not layout:
+            self.overflow[idx] = state
+            return
+        if self.layout is None:
+            self._open(layout)
+        if layout != self.layout:
+            self.overflow[idx] = state
+            return
+        row, off = self._row(idx), 0
+        for t in tensors:
+            n = t.numel()
+            row[off:off+n].copy_(t.reshape(-1))
+            off += n
+        self.meta[idx] = meta
+
+    def _open(self, layout):
+        self.layout = layout
+        total = sum(int(np.prod(shape)) for _, _, shape in layout)
+        fd, path = tempfile.mkstemp(suffix='.opt', dir=self.spill_dir)
+        os.close(fd)
+        self.mm = np.memmap(path, dtype=self.np_dtype, mode='w+', shape=(self.num_users, total))
+
+    def _load(self, idx):
+        meta = self.meta.pop(idx)
+        state = {'state': {pid: dict(s) for pid, s in meta['state'].items()}, 'param_groups': meta['param_groups']}
+        row, off = self._row(idx), 0
+        for pid, k, shape in self.layout:
+            n = int(np.prod(shape))
+            state['state'][pid][k] = row[off:off+n].clone().view(shape)
+            off += n
+        return state
+
+    def __getstate__(self):
+        # checkpoint / cache: the memory tier in LRU order, spilled users as their raw memmap rows
+        # (read without going through the LRU; the memmap file itself is not pickled)
+        spilled = {idx: (meta, np.array(self.mm[idx])) for idx, meta in self.meta.items()}
+        return {'init_opt': self.init_opt, 'num_users': self.num_users, 'capacity': self.capacity,
+                'compress': self.compress, 'spill_dir': self.spill_dir, 'mem': list(self.mem.items()),
+                'overflow': dict(self.overflow), 'layout': self.layout, 'spilled': spilled}
+
+    def __setstate__(self, d):
+        self.__init__(d['init_opt'], d['num_users'], d['capacity'], d['compress'], d['spill_dir'])
+        if d['spilled']:
+            self._open(d['layout'])
+            for idx, (meta, row) in d['spilled'].items():
+                self.mm[idx] = row
+                self.meta[idx] = meta
+        self.overflow.update(d['overflow'])
+        for idx, state in d['mem']:
+            self._put(idx, state)
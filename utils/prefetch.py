@@ -0,0 +1,107 @@
+'''
+Background prefetch of generator batches
+
+--gen_prefetch K: in the local_ep_gen loop of LocalUpdate / LocalUpdate_header / LocalUpdate_onlyGen (feature and raw),
+the generator is wrapped by a PrefetchGen whose thread produces the client's synthetic batches up to K ahead,
+so sampling (DDPM's n_T passes, CCVAE32's decoder) overlaps with the main net's forward / backward.
+- same sample_image(args, sample_num) -> (images, labels) contract; a request of another size is sampled directly
+- on CUDA the thread samples on its own stream (the consumer waits on an event per batch)
+- torch's intra-op pool is process-wide: on CPU the two threads share --worker_threads / the default thread budget
+- the thread's random draws (noise, labels) come from its own generators seeded from the job's RNG (utils/threadRNG.py),
+  so the training thread's draws and a run under --rs stay reproducible; generators sampling with numpy
+  (numpy_rng, e.g. mlp_generators/GAN.py) get a RandomState of the thread as sample_image(..., rng=)
+- prefetch_gen is a context manager: the thread is stopped when the loop ends or raises
+Shared sample banks (utils/sampleBank.py) are cheap gathers and are not prefetched.
+'''
+import queue
+import threading
+from contextlib import contextmanager
+
+import torch
+
+from utils.sampleBank import SampleBank
+from utils.threadRNG import ThreadRNG
+
+
+class PrefetchGen(object):
+    def __init__(self, gennet, args, sample_num, count, depth=2):
+        '''
+        count: batches of sample_num the train loop consumes
+        '''
+        self.gennet = gennet
+        self.args = args
+        self.sample_num = sample_num
+        self.remaining = count
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.rng = ThreadRNG(int(torch.randint(2**62, (1,)))) # seed drawn from the job's RNG on the training thread
+        self.sample_kwargs = dict(rng=self.rng.numpy) if getattr(gennet, 'numpy_rng', False) else {}
+        cuda = torch.cuda.is_available() and 'cuda' in str(args.device)
+        self.stream = torch.cuda.Stream(device=args.device) if cuda else None
+        self.thread = threading.Thread(target=self.produce, args=(count,), daemon=True)
+        self.thread.start()
+
+    def produce(self, count):
+        try:
+            with torch.no_grad(), self.rng: # grad mode and torch function modes are per thread
+                for _ in range(count):
+                    if self.stream is not None:
+                        with torch.cuda.stream(self.stream):
+                            images, labels = self.gennet.sample_image(self.args, sample_num=self.sample_num, **self.sample_kwargs)
+                            event = torch.cuda.Event()
+                            event.record(self.stream)
+                    else:
+                        images, labels = self.gennet.sample_image(self.args, sample_num=self.sample_num, **self.sample_kwargs)
+                        event = None
+                    if not self.put((images, labels, event)):
+                        return
+        except Exception as e: # raised by the consumer
+            self.put(e)
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def eval(self):
+        return self
+
+    def sample_image(self, args, sample_num=0):
+        if sample_num != self.sample_num or self.remaining <= 0:
+            return self.gennet.sample_image(args, sample_num=sample_num)
+        self.remaining -= 1
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        images, labels, event = item
+        if event is not None:
+            current = torch.cuda.current_stream(images.device)
+            current.wait_event(event)
+            images.record_stream(current)
+            if torch.is_tensor(labels) and labels.is_cuda:
+                labels.record_stream(current)
+        return images, labels
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+
+@contextmanager
+def prefetch_gen(args, gennet, sample_num, count):
+    '''
+    gennet wrapped by a PrefetchGen with --gen_prefetch (closed on exit), else gennet
+    '''
+    depth = getattr(args, 'gen_prefetch', 0)
+    if depth <= 0 or gennet is None or isinstance(gennet, SampleBank) or count <= 0:
+        yield gennet
+        return
+    prefetch = PrefetchGen(gennet, args, sample_num, count, depth)
+    try:
+        yield prefetch
+    finally:
+        prefetch.close()
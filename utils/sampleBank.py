@@ -0,0 +1,61 @@
+'''
+Shared synthetic-sample bank
+
+--sample_bank N: in joint rounds clients get a SampleBank instead of the generator (gennet of LocalUpdate* / LocalUpdate_group).
+The bank is a label-indexed pool of N generator outputs, produced in batches of --bank_batch (one generator forward
+per batch, n_T UNet passes for DDPM) when the generator version changes (utils/versionedState.py digest)
+or every --bank_refresh rounds (0: on a new version only). sample_image(args, sample_num) has the generator's contract
+(images, labels in the generator's format) and draws uniform labels, then a stored sample of each label, by one gather.
+The pool is read-only and shared by the clients of a round (shared memory with worker processes).
+'''
+import torch
+
+
+class SampleBank(object):
+    def __init__(self, size, batch_size=1000, refresh=0):
+        self.size = size
+        self.batch_size = batch_size
+        self.refresh = refresh
+        self.version, self.built = None, None
+        self.images, self.labels = None, None
+
+    def update(self, gennet, args, version, round):
+        '''
+        rebuilds the pool from gennet if its version changed or the refresh period passed, returns the bank
+        '''
+        stale = self.refresh > 0 and self.built is not None and round - self.built >= self.refresh
+        if version != self.version or stale:
+            self.build(gennet, args)
+            self.version, self.built = version, round
+        return self
+
+    @torch.no_grad()
+    def build(self, gennet, args):
+        training = gennet.training
+        gennet.eval()
+        images, labels = [], []
+        for start in range(0, self.size, self.batch_size):
+            x, y = gennet.sample_image(args, sample_num=min(self.batch_size, self.size - start))
+            images.append(x)
+            labels.append(y)
+        gennet.train(training)
+        images, labels = torch.cat(images), torch.cat(labels)
+        classes = labels.argmax(1) if labels.dim() > 1 else labels # one-hot (CVAE) or indices
+        order = torch.argsort(classes)
+        self.images, self.labels = images[order].contiguous(), labels[order].contiguous()
+        counts = torch.bincount(classes, minlength=args.num_classes).to(self.images.device)
+        self.starts = torch.cumsum(counts, 0) - counts
+        self.counts = counts
+        self.present = torch.nonzero(counts).view(-1)
+        if self.images.device.type == 'cpu':
+            for t in (self.images, self.labels, self.starts, self.counts, self.present):
+                t.share_memory_()
+
+    def eval(self):
+        return self
+
+    def sample_image(self, args, sample_num=0):
+        device = self.images.device
+        c = self.present[torch.randint(len(self.present), (sample_num,), device=device)]
+        idx = self.starts[c] + (torch.rand(sample_num, device=device) * self.counts[c]).long()
+        return self.images[idx], self.labels[idx]
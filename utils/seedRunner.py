@@ -0,0 +1,118 @@
+'''
+Concurrent multi-seed runner
+
+Replaces the serial `for i in range(args.num_experiment): ... main(); args.rs += 1` loop.
+Every seed runs main() in its own forked process with a partitioned intra-op thread budget.
+The module-level dataset of the script is shared copy-on-write (read-only) by all seeds,
+and args / RNG states are private to each process, so seeds cannot interfere.
+A seed whose process dies without a result (e.g., OOM kill) is recorded as failed with its exit code.
+'''
+import os
+import csv
+import random
+from multiprocessing.connection import wait
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+def seed_all(seed):
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed) # if use multi-GPU
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def _run_seed(main, args, seed, num_threads, conn):
+    torch.set_num_threads(num_threads)
+    args.rs = seed
+    seed_all(seed)
+    try:
+        conn.send((main(), None))
+    except Exception as e:
+        conn.send((None, repr(e)))
+        raise
+
+
+def run_seeds(main, args, num_parallel, num_threads=0, table=None):
+    '''
+    main: the script's main() (reads the script globals, e.g., args and dataset_train)
+    runs seeds args.rs, ..., args.rs+num_experiment-1, at most num_parallel at a time
+    table: csv path of the results table (seed, result)
+    returns results in seed order (None for failed seeds)
+    '''
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        raise RuntimeError('run_seeds forks the process; CUDA must not be initialized before')
+    num_parallel = max(1, min(num_parallel, args.num_experiment))
+    if num_threads <= 0:
+        num_threads = max(1, torch.get_num_threads() // num_parallel)
+
+    ctx = mp.get_context('fork')
+    seeds = [args.rs + i for i in range(args.num_experiment)]
+    pending = list(seeds)
+    running = {} # seed -> (process, receiving end of its pipe)
+    results = {}
+
+    while pending or running:
+        while pending and len(running) < num_parallel:
+            seed = pending.pop(0)
+            reader, writer = ctx.Pipe(duplex=False)
+            p = ctx.Process(target=_run_seed, args=(main, args, seed, num_threads, writer))
+            p.start()
+            writer.close()
+            running[seed] = (p, reader)
+        ready = wait([r for _, r in running.values()] + [p.sentinel for p, _ in running.values()])
+        for seed, (p, reader) in list(running.items()):
+            if reader not in ready and p.sentinel not in ready:
+                continue
+            try:
+                result, err = reader.recv() if reader.poll() else (None, 'exited without a result')
+            except EOFError: # died before sending
+                result, err = None, 'exited without a result'
+            p.join()
+            reader.close()
+            del running[seed]
+            if result is None and p.exitcode:
+                err = '{} (exit code {})'.format(err, p.exitcode)
+            results[seed] = result
+            if err is not None:
+                print('Seed {} failed: {}'.format(seed, err))
+            print('Seed {} done: {}'.format(seed, result))
+
+    results = [results[seed] for seed in seeds]
+    done = [r for r in results if r is not None]
+    print('{:>6} | {}'.format('seed', 'result'))
+    for seed, result in zip(seeds, results):
+        print('{:>6} | {}'.format(seed, result))
+    if done:
+        print('{:>6} | {:.2f} +- {:.2f}'.format('mean', float(np.mean(done)), float(np.std(done))))
+
+    if table:
+        os.makedirs(os.path.dirname(table) or '.', exist_ok=True)
+        with open(table, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['seed', 'result'])
+            for seed, result in zip(seeds, results):
+                writer.writerow([seed, result])
+    return results
+
+
+def run_experiments(main, args, table=None):
+    '''
+    __main__ of the GeFL scripts: seeds run concurrently (--parallel_seeds > 1) or one after another
+    '''
+    if args.parallel_seeds > 1:
+        results = run_seeds(main, args, args.parallel_seeds, args.seed_threads, table=table)
+        print(results)
+        return results
+
+    results = []
+    for i in range(args.num_experiment):
+        seed_all(args.rs)
+        # torch.backends.cudnn.deterministic = True
+        # torch.backends.cudnn.benchmark = False
+        results.append(main())
+        args.rs = args.rs+1
+        print(results)
+    return results
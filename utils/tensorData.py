@@ -0,0 +1,85 @@
+'''
+Pre-tensorized datasets
+
+--tensor_data True: the train / generator / test datasets are run through their transforms once
+(PIL conversion, ToTensor, Resize, Normalize) into one contiguous tensor (fp16 with --tensor_data_half) and a label tensor.
+get_loader / test_img then return a TensorLoader: a shard's batches are gathered by fancy-indexing with one permutation
+per epoch, with no per-item __getitem__, collate or DataLoader workers.
+Datasets with random train transforms (e.g., cifar10 crop / flip) are kept as they are.
+'''
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from utils.featureCache import cacheable
+
+
+class TensorData(Dataset):
+    def __init__(self, dataset, half=False, batch_size=1024):
+        data, targets = [], []
+        for x, y in DataLoader(dataset, batch_size=batch_size):
+            data.append(x.half() if half else x)
+            targets.append(torch.as_tensor(y))
+        self.data = torch.cat(data).contiguous()
+        self.targets = torch.cat(targets).long()
+        self.root = getattr(dataset, 'root', None)
+        self.transform = None
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, item):
+        return self.data[item].float(), int(self.targets[item])
+
+    def loader(self, idxs=None, batch_size=1, shuffle=False, drop_last=False):
+        return TensorLoader(self, idxs, batch_size, shuffle, drop_last)
+
+
+class TensorSplit(Dataset):
+    '''
+    a shard of a TensorData (dataset / idxs as DatasetSplit)
+    '''
+    def __init__(self, dataset, idxs):
+        self.dataset = dataset
+        self.idxs = idxs
+
+    def __len__(self):
+        return len(self.idxs)
+
+    def __getitem__(self, item):
+        return self.dataset[int(self.idxs[item])]
+
+
+class TensorLoader(object):
+    def __init__(self, data, idxs=None, batch_size=1, shuffle=False, drop_last=False):
+        idxs = getattr(idxs, 'idxs', idxs) # ClientRegistry shards
+        idxs = np.arange(len(data)) if idxs is None else np.asarray(idxs if isinstance(idxs, np.ndarray) else list(idxs))
+        self.data = data
+        self.index = torch.as_tensor(idxs.astype(np.int64))
+        self.dataset = TensorSplit(data, idxs)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        n = len(self.index)
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+    def __iter__(self):
+        n = len(self.index)
+        index = self.index[torch.randperm(n)] if self.shuffle else self.index
+        for b in range(len(self)):
+            sel = index[b*self.batch_size:(b+1)*self.batch_size]
+            yield self.data.data[sel].float(), self.data.targets[sel]
+
+
+def tensorize(dataset, half=False):
+    '''
+    TensorData of dataset (as it is if its transforms are random or it is already tensorized)
+    '''
+    if isinstance(dataset, TensorData):
+        return dataset
+    if not cacheable(dataset):
+        print('tensor_data: {} has random transforms, kept as it is'.format(type(dataset).__name__))
+        return dataset
+    return TensorData(dataset, half=half)
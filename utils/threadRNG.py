@@ -0,0 +1,91 @@
+'''
+Per-thread random streams
+
+torch's default generator and numpy's global RandomState are process-wide: threads that train or sample
+concurrently (overlap lanes of utils/executor.py, the prefetch thread of utils/prefetch.py) would interleave their draws
+in scheduling order. A thread that enters a ThreadRNG draws from generators of its own instead:
+- torch random factories / in-place samplers (randn, randint, randperm, Tensor.random_, ...) and dropout,
+  through a torch function mode (modes are thread-local), so loaders' shuffling and model noise are covered
+- numpy: ThreadRNG.numpy is a RandomState of the thread; code that samples with numpy takes it explicitly
+  (LocalUpdate*.np_rng, sample_image(..., rng=) of generators with numpy_rng, through NumpyRNGGen)
+'''
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.overrides import TorchFunctionMode
+
+
+class ThreadRNG(TorchFunctionMode):
+    FACTORIES = (torch.randn, torch.rand, torch.randint, torch.randperm, torch.normal, torch.bernoulli, torch.multinomial,
+                 torch.Tensor.random_, torch.Tensor.normal_, torch.Tensor.uniform_, torch.Tensor.bernoulli_,
+                 torch.Tensor.exponential_, torch.Tensor.geometric_, torch.Tensor.log_normal_, torch.Tensor.cauchy_)
+    LIKE = {torch.randn_like: torch.randn, torch.rand_like: torch.rand}
+
+    def __init__(self, seed):
+        super().__init__()
+        self.seed = seed
+        self.generators = {}
+        self.numpy = np.random.RandomState(seed % 2**32)
+
+    def generator(self, device):
+        device = torch.device('cpu' if device is None else device)
+        if device.type == 'cuda' and device.index is None:
+            device = torch.device('cuda', torch.cuda.current_device())
+        if device not in self.generators:
+            self.generators[device] = torch.Generator(device=device)
+            self.generators[device].manual_seed(self.seed)
+        return self.generators[device]
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = dict(kwargs or {})
+        if func is F.dropout:
+            return self.dropout(*args, **kwargs)
+        if kwargs.get('generator') is None:
+            tensors = [a for a in args if torch.is_tensor(a)]
+            device = kwargs.get('device') or (tensors[0].device if tensors else None)
+            if func in self.LIKE:
+                x = args[0]
+                return self.LIKE[func](x.shape, dtype=kwargs.get('dtype') or x.dtype, device=device,
+                                       generator=self.generator(device))
+            if func in self.FACTORIES:
+                kwargs['generator'] = self.generator(device)
+        return func(*args, **kwargs)
+
+    def dropout(self, input, p=0.5, training=True, inplace=False):
+        if not training or p == 0:
+            return input
+        mask = torch.empty_like(input).bernoulli_(1 - p, generator=self.generator(input.device))
+        if p == 1:
+            return input.mul_(mask) if inplace else input * mask
+        return input.mul_(mask).div_(1 - p) if inplace else input * mask / (1 - p)
+
+
+class NumpyRNGGen(object):
+    '''
+    generator whose sample_image draws from numpy (numpy_rng), sampling with rng unless the caller passes its own
+    '''
+    numpy_rng = True
+
+    def __init__(self, gennet, rng):
+        self.gennet = gennet
+        self.rng = rng
+
+    def __getattr__(self, name):
+        return getattr(self.gennet, name)
+
+    def eval(self):
+        self.gennet.eval()
+        return self
+
+    def sample_image(self, args, sample_num=0, rng=None):
+        return self.gennet.sample_image(args, sample_num=sample_num, rng=self.rng if rng is None else rng)
+
+
+def thread_kwargs(rng, train_kwargs):
+    '''
+    train() kwargs of a job run under rng: numpy-sampling generators are wrapped by a NumpyRNGGen
+    '''
+    gennet = train_kwargs.get('gennet')
+    if gennet is not None and getattr(gennet, 'numpy_rng', False):
+        return dict(train_kwargs, gennet=NumpyRNGGen(gennet, rng.numpy))
+    return train_kwargs
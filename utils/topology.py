@@ -0,0 +1,161 @@
+'''
+Hierarchical (client -> edge -> cloud) aggregation
+
+Topology: which edge aggregator every client belongs to and how many rounds edges run between cloud syncs
+    --num_edges E: clients are split into E contiguous blocks (edge = idx*E//num_users), --edge_sync P
+    --topology file.json: {"edges": [[client, ...], ...], "sync_period": P}
+EdgeTier keeps the main nets of every edge. In a round, clients start from (and are aggregated into) their edge's weights,
+edges run FedAvg_FE / FedAvg_frozen_FE / FedAvg_FE_raw over their clients (RunningAvg_FE, finalized concurrently),
+and every P rounds the cloud averages the edge models, weighted by the clients they aggregated since the last sync,
+with the same common-FE / private split, and sends the result back to all edges.
+The generator is still averaged over all clients every round (edges forward their partial sums).
+Communication rows are split per tier (comm.csv column tier): 'client' (client <-> edge) and 'cloud' (edge <-> cloud, client = edge id).
+'''
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.commMeter import nbytes
+
+
+class Topology(object):
+    def __init__(self, edges, sync_period=1):
+        '''
+        edges: list of client lists
+        '''
+        self.edges = [list(map(int, clients)) for clients in edges]
+        self.sync_period = max(int(sync_period), 1)
+        self.edge = {}
+        for e, clients in enumerate(self.edges):
+            for idx in clients:
+                self.edge[idx] = e
+
+    @classmethod
+    def from_args(cls, args):
+        '''
+        None without --topology / --num_edges
+        '''
+        if args.topology:
+            with open(args.topology) as f:
+                spec = json.load(f)
+            return cls(spec['edges'], spec.get('sync_period', args.edge_sync))
+        if args.num_edges > 0:
+            edges = [[] for _ in range(args.num_edges)]
+            for idx in range(args.num_users):
+                edges[idx * args.num_edges // args.num_users].append(idx)
+            return cls(edges, args.edge_sync)
+        return None
+
+    def __len__(self):
+        return len(self.edges)
+
+    def edge_of(self, idx):
+        return self.edge[int(idx)]
+
+
+class EdgeTier(object):
+    '''
+    main nets of the edges between cloud syncs; start_round() returns the round's aggregate,
+    clients are routed to their edge's RunningAvg_FE by aggregator(idx, model_idx)
+    '''
+    def __init__(self, engine, topology):
+        self.engine = engine
+        self.topology = topology
+        self.pool = ThreadPoolExecutor(len(topology))
+        self.reset()
+
+    def reset(self):
+        '''
+        every edge starts from the cloud weights (start of a phase)
+        '''
+        engine, n = self.engine, len(self.topology)
+        self.ws = [list(engine.ws_glob) for _ in range(n)]
+        self.wc = [engine.w_comm for _ in range(n)]
+        self.counts = [[0] * engine.args.num_models for _ in range(n)] # clients aggregated since the last sync
+        self.aggs = None
+
+    def state(self):
+        '''
+        edge weights and client counts since the last cloud sync (checkpoint, saved at the end of a round)
+        '''
+        return dict(ws=self.ws, wc=self.wc, counts=self.counts)
+
+    def load_state(self, state):
+        self.ws, self.wc, self.counts = state['ws'], state['wc'], state['counts']
+        self.aggs = None
+
+    def name(self, idx, model_idx):
+        '''
+        versioned name (utils/versionedState.py) of the weights client idx downloads
+        '''
+        return ('main', self.topology.edge_of(idx), model_idx)
+
+    def weights(self, idx, model_idx):
+        return self.ws[self.topology.edge_of(idx)][model_idx]
+
+    def start_round(self, phase):
+        engine = self.engine
+        self.phase = phase
+        self.aggs = [engine.family.aggregator(engine, phase, self.ws[e], self.wc[e]) for e in range(len(self.topology))]
+        self.round_counts = [[0] * engine.args.num_models for _ in range(len(self.topology))]
+        return self
+
+    def aggregator(self, idx, model_idx):
+        e = self.topology.edge_of(idx)
+        with self.engine.comm.lock:
+            self.round_counts[e][model_idx] += 1
+        return self.aggs[e]
+
+    def all_reduce(self):
+        for agg in self.aggs:
+            agg.all_reduce()
+        m = self.engine.args.num_models
+        flat = self.engine.dist.sum([n for counts in self.round_counts for n in counts])
+        self.round_counts = [list(map(int, flat[e*m:(e+1)*m])) for e in range(len(self.topology))]
+
+    def finalize(self, iter, last):
+        '''
+        edge aggregation (edges finalized concurrently); every sync_period rounds (and at last) the cloud sync
+        returns True if the cloud weights (engine.ws_glob, w_comm) were updated
+        '''
+        engine, n = self.engine, len(self.topology)
+        active = [e for e in range(n) if any(self.round_counts[e])]
+        for e, (ws, wc) in zip(active, self.pool.map(lambda e: self.aggs[e].finalize(), active)):
+            self.ws[e], self.wc[e] = ws, wc
+        for e in active:
+            self.counts[e] = [a + b for a, b in zip(self.counts[e], self.round_counts[e])]
+        self.aggs = None
+        if iter % self.topology.sync_period != 0 and iter != last:
+            return False
+
+        # edges weighted by the clients they aggregated since the last sync
+        cloud = engine.family.aggregator(engine, self.phase)
+        for e in range(n):
+            for j, count in enumerate(self.counts[e]):
+                if count:
+                    cloud.add(self.ws[e][j], count, model_idx=j)
+                    if engine.is_main:
+                        engine.comm.add_main(e, 'up', self.ws[e][j], tier='cloud')
+        engine.ws_glob, engine.w_comm = cloud.finalize()
+        if engine.is_main:
+            for e in range(n):
+                for j, w in enumerate(engine.ws_glob):
+                    engine.comm.add_main(e, 'down', w, engine.versions.fetch(('edge', e), ('main', j), w), tier='cloud')
+        self.reset()
+        return True
+
+    def forward_gen(self, users, w_glob):
+        '''
+        accounts the generator between edges and cloud: partial sums of the edges with participants up, new weights down
+        '''
+        engine = self.engine
+        if not engine.is_main:
+            return
+        edges = set(self.topology.edge_of(idx) for idx in users)
+        for e in range(len(self.topology)):
+            for k, w in w_glob.items():
+                if e in edges:
+                    engine.comm.add(e, 'up', k, nbytes(w), tier='cloud')
+                engine.comm.add(e, 'down', k, nbytes(w, engine.versions.fetch(('edge', e), ('gen', k), w)), tier='cloud')
+
+    def close(self):
+        self.pool.shutdown()
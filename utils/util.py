@@ -2,6 +2,7 @@
 # from math import ceil as up
 from torch.utils.data import DataLoader
 import torch
+from utils.tensorData import TensorData
 import torch.nn.functional as F
 import logging
 import copy
@@ -22,7 +23,10 @@ def test_img(net_g, datatest, args):
     test_loss = 0
     correct = 0
 
-    data_loader = DataLoader(datatest, batch_size=args.bs)
+    if isinstance(datatest, TensorData):
+        data_loader = datatest.loader(batch_size=args.bs)
+    else:
+        data_loader = DataLoader(datatest, batch_size=args.bs)
     with torch.no_grad():
       for idx, (data, target) in enumerate(data_loader):
           if 'cuda' in args.device:
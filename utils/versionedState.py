@@ -0,0 +1,74 @@
+'''
+Versioned global state
+
+Every published state dict (a main net ('main', model_idx), the generator ('gen', 'gen') / discriminator ('gen', 'dis'))
+is versioned per tensor: a tensor's version changes when aggregation replaces it by a new tensor or modifies it in place
+(torch's in-place counter). Frozen components (w_comm with freeze_FE, gen_w_glob with freeze_gen) and the weights of model
+groups without participants are the same tensors round after round, so they keep their versions.
+- fetch(client, name, w): the keys the client has to download, i.e. changed since the version it saw last
+  (--delta_download False: always all keys)
+- key_versions(name): per-tensor versions, used by ModelWorkspace.load to skip copying unchanged tensors into live modules
+- digest(name): version hash of a component
+- state(current) / load_state(state): checkpointed versions; after a resume, the first publish of a component
+  adopts the restored weights as its checkpointed version
+'''
+import hashlib
+
+
+class VersionedState(object):
+    def __init__(self, delta_download=True):
+        self.delta_download = delta_download
+        self.refs = {} # name -> {k: (tensor, in-place counter)} (kept, so identities are not reused)
+        self.versions = {} # name -> {k: version}
+        self.version = {} # name -> version of the component
+        self.seen = {} # (client, name) -> version
+        self.adopt = set() # restored components whose tensors are not known yet
+
+    def publish(self, name, w):
+        '''
+        registers w as the current state of name, returns the component's version
+        '''
+        refs = self.refs.setdefault(name, {})
+        versions = self.versions.setdefault(name, {})
+        if name in self.adopt:
+            self.adopt.discard(name)
+            refs.update((k, (t, t._version)) for k, t in w.items())
+            return self.version[name]
+        changed = [k for k, t in w.items() if k not in refs or refs[k][0] is not t or refs[k][1] != t._version]
+        if changed or name not in self.version:
+            self.version[name] = self.version.get(name, 0) + 1
+            for k in changed:
+                refs[k] = (w[k], w[k]._version)
+                versions[k] = self.version[name]
+        return self.version[name]
+
+    def key_versions(self, name, w):
+        self.publish(name, w)
+        return self.versions[name]
+
+    def fetch(self, client, name, w):
+        '''
+        returns the keys of w the client downloads and records the version it now holds
+        '''
+        version = self.publish(name, w)
+        since = self.seen.get((client, name), 0) if self.delta_download else 0
+        self.seen[(client, name)] = version
+        return [k for k in w.keys() if self.versions[name][k] > since]
+
+    def state(self, current):
+        '''
+        current: {name: state dict} of the components as they are now (published first, as the next fetch would)
+        '''
+        for name, w in current.items():
+            if name in self.version:
+                self.publish(name, w)
+        return dict(versions=self.versions, version=self.version, seen=self.seen)
+
+    def load_state(self, state):
+        self.versions, self.version, self.seen = state['versions'], state['version'], state['seen']
+        self.refs = {}
+        self.adopt = set(self.version)
+
+    def digest(self, name):
+        versions = self.versions.get(name, {})
+        return hashlib.sha1(repr((name, sorted(versions.items()))).encode()).hexdigest()[:12]
@@ -0,0 +1,103 @@
+'''
+Reusable per-architecture model workspace
+
+Instead of copy.deepcopy(model) for every client, one live module is kept per key
+(e.g. model_idx of CNN2..CNN5c, 'gen', 'dis') and each client's weights are copied into it in place.
+Weights returned by train() alias the live module, so snapshot() them once into the aggregation buffer
+before the next client checks the module out.
+lazy() defers the checkout to the moment a job actually runs (e.g., on an executor lane thread).
+With a VersionedState (utils/versionedState.py), load() only copies tensors whose global version changed
+or that were modified in place (e.g., trained) since they were loaded into the module.
+'''
+import copy
+from collections import OrderedDict
+import torch
+
+
+def snapshot(w):
+    '''
+    detached copy of a state dict (replaces copy.deepcopy(weight))
+    '''
+    return OrderedDict((k, v.detach().clone()) for k, v in w.items())
+
+
+class Checkout(object):
+    def __init__(self, workspace, key, net, w, name=None):
+        self.workspace = workspace
+        self.key = key
+        self.net = net
+        self.w = w
+        self.name = name
+
+    def get(self):
+        return self.workspace.checkout(self.key, self.net, self.w, self.name)
+
+
+def resolve(kwargs):
+    '''
+    replaces lazy checkouts in train() kwargs by the live modules
+    '''
+    return {k: v.get() if isinstance(v, Checkout) else v for k, v in kwargs.items()}
+
+
+class ModelWorkspace(object):
+    def __init__(self, device, enabled=True, versions=None):
+        '''
+        enabled=False: checkout() falls back to copy.deepcopy (e.g., for process-pool execution,
+        where nets are pickled after all clients are submitted)
+        versions: VersionedState of the published global weights (None: always load every tensor)
+        '''
+        self.device = device
+        self.enabled = enabled
+        self.versions = versions
+        self.nets = {}
+        self.loaded = {} # id of a live module -> {k: (name, version, in-place counter)}
+
+    def load(self, live, w, name=None):
+        '''
+        loads w into live; with a version name, only tensors that changed since they were loaded
+        '''
+        if name is None or self.versions is None:
+            live.load_state_dict(w)
+            self.loaded.pop(id(live), None)
+            return live
+        versions = self.versions.key_versions(name, w)
+        loaded = self.loaded.setdefault(id(live), {})
+        with torch.no_grad():
+            for k, t in live.state_dict().items():
+                if loaded.get(k) != (name, versions[k], t._version):
+                    t.copy_(w[k])
+                    loaded[k] = (name, versions[k], t._version)
+        return live
+
+    def checkout(self, key, net, w=None, name=None):
+        '''
+        key: architecture id
+        net: template module (only deep-copied on the first checkout of key)
+        w: state dict loaded in place into the live module (default: net's own weights)
+        name: version name of w in the VersionedState (e.g., ('main', model_idx))
+        '''
+        if not self.enabled:
+            net = copy.deepcopy(net).to(self.device)
+            if w is not None:
+                net.load_state_dict(w)
+            return net
+
+        if key not in self.nets:
+            self.nets[key] = copy.deepcopy(net).to(self.device)
+            if w is None:
+                return self.nets[key]
+        live = self.nets[key]
+        if w is None:
+            live.load_state_dict(net.state_dict())
+            self.loaded.pop(id(live), None)
+            return live
+        return self.load(live, w, name)
+
+    def lazy(self, key, net, w=None, name=None):
+        return Checkout(self, key, net, w, name)
+
+    def clear(self):
+        for net in self.nets.values():
+            self.loaded.pop(id(net), None)
+        self.nets = {}